@@ -11,6 +11,13 @@ import logging
 import argparse
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+import job_artifacts # connection summary queries and archive scanning
+import sqlite3 # local analytics index
+import datetime
+import json
+import time # job status follow
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, parse_qs # expiry of pre-signed URLs
 
 #
 # API CONFIGURATION SECTION
@@ -149,6 +156,24 @@ AWS_API_DATA = [
     }
 ]
 
+#
+# LOCAL CONFIGURATION SECTION
+#
+LOCAL_DATA_DIR = Path.home() / '.website_downloader' # holds local databases
+LOCAL_INDEX_DB = LOCAL_DATA_DIR / 'index.sqlite' # analytics index of downloaded job archives
+JOB_STATUS_WAIT = 20 # seconds each job status request long polls on the API
+JOB_STATUS_STALE = 10800 # seconds without a job status change after which a job is given up on. Same as the SQS VisibilityTimeout.
+LOCAL_JOURNAL_DB = LOCAL_DATA_DIR / 'journal.sqlite' # every submitted job so downloads survive the client being stopped
+JOURNAL_PENDING_STATES = ('submitted', 'downloading') # journal states picked up by --resume
+DOWNLOAD_WORKERS = 8 # jobs downloaded at the same time
+AUTO_REGION_TIMEOUT = 10 # seconds a region may take to report its load for --awsregion auto
+AUTO_REGION_BOOT_SECONDS = 240 # estimated seconds from scaling out to a new worker receiving its job
+AUTO_REGION_JOB_SECONDS = 300 # estimated seconds a worker is busy with a job
+AUTO_REGION_ERROR_WINDOW = 3600 # seconds API errors of a region count against it
+AUTO_REGION_ERROR_PENALTY = 300 # seconds added to the expected completion of a region per recent API error
+HEDGE_AFTER_SECONDS = 900 # default seconds a hedged job is given to complete before it is submitted to the next region
+HEDGE_POLL_INTERVAL = 15 # seconds between job status checks of hedged jobs
+
 #
 # Script Starts Below
 #
@@ -300,8 +325,84 @@ def sqs_autoscaling_stats(apikey, apiurl, apiregion):
 
     return
 
+def region_load(apikey, apiurl):
+    """
+    Collects the queue and autoscaling state of a region through the AWS Gateway API
+
+    Args:
+        apikey (str): AWS API key for url
+        apiurl (str): AWS API url
+    Returns:
+        dict with waiting, working, workers and max_workers
+    Raises:
+        requests.RequestException or ValueError when the region did not answer
+    """
+    load = {}
+    for request_body in ({'sqs_queue_stats': True}, {'autoscaling_status': True}):
+        r = requests.post(apiurl, headers={'x-api-key': apikey}, json=request_body, timeout=AUTO_REGION_TIMEOUT)
+        if r.status_code != requests.codes.ok:
+            raise ValueError(f"HTTP {r.status_code}: {r.text[:200]}")
+        load.update(r.json()['message'])
+    return {'waiting': int(load['ApproximateNumberOfMessages']),
+            'working': int(load['ApproximateNumberOfMessagesNotVisible']),
+            'workers': int(load['DesiredCapacity']),
+            'max_workers': int(load['MaxSize'])}
+
+def estimate_start_seconds(load):
+    """
+    Estimates the seconds until a job submitted now starts. Workers run one job each and are replaced after it, so
+    the job needs a worker to boot and waits for running jobs to finish when the autoscaling group is at MaxSize.
+
+    Args:
+        load (dict): see region_load()
+    Returns:
+        float, inf when the region cannot run a job
+    """
+    if load['max_workers'] <= 0:
+        return float('inf')
+    free = max(0, load['max_workers'] - load['working']) # workers that can take a waiting job without one finishing first
+    position = load['waiting'] + 1 # this job is behind every job already waiting
+    if position <= free:
+        return AUTO_REGION_BOOT_SECONDS
+    rounds = -(-(position - free) // load['max_workers']) # every round of finishing jobs frees all workers
+    return rounds * AUTO_REGION_JOB_SECONDS + AUTO_REGION_BOOT_SECONDS
+
+def rank_regions(db_path, allowed=None):
+    """
+    Ranks the configured regions by the expected completion time of a job submitted now. The load of all regions is
+    queried at the same time. Recent API errors of a region, kept in the journal, are added as a penalty.
+    Regions which do not answer are recorded as errors and left out.
 
-def submit_website_download_job(apikey, apiurl, input_url, input_useragent, input_recursivelevel, input_forceipver, input_wgetmode):
+    Args:
+        db_path (str): path of the SQLite journal
+        allowed (list): region names to choose from. None allows every configured region.
+    Returns:
+        list of tuples (region, apikey, apiurl), best first. Empty when no region answered.
+    """
+    targets = [(region, data['key'], data['url']) for item in available_apis() for region, data in item.items() if not allowed or region in allowed]
+    errors = recent_region_errors(db_path, time.time() - AUTO_REGION_ERROR_WINDOW)
+    ranked = []
+    with ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+        futures = {executor.submit(region_load, apikey, apiurl): (region, apikey, apiurl) for region, apikey, apiurl in targets}
+        for future in as_completed(futures):
+            region = futures[future][0]
+            try:
+                load = future.result()
+            except Exception as e:
+                logging.error(f"ERROR reading the load of {region}: {e}")
+                journal_region_error(db_path, region, str(e))
+                continue
+            start = estimate_start_seconds(load)
+            ranked.append((start + AUTO_REGION_JOB_SECONDS + errors.get(region, 0) * AUTO_REGION_ERROR_PENALTY, start, load, futures[future]))
+    ranked.sort(key=lambda candidate: (candidate[0], candidate[2]['waiting'], [target[0] for target in targets].index(candidate[3][0])))
+
+    print("{:<16} {:>8} {:>8} {:>8} {:>8} {:>7} {:>10} {:>12}".format("REGION", "WAITING", "WORKING", "WORKERS", "MAX", "ERRORS", "START (s)", "COMPLETE (s)"))
+    for expected, start, load, target in ranked:
+        print("{:<16} {:>8} {:>8} {:>8} {:>8} {:>7} {:>10} {:>12}".format(target[0], load['waiting'], load['working'], load['workers'], load['max_workers'],
+                                                                       errors.get(target[0], 0), round(start), round(expected)))
+    return [target for expected, start, load, target in ranked if expected != float('inf')]
+
+def submit_website_download_job(apikey, apiurl, input_url, input_useragent, input_recursivelevel, input_forceipver, input_wgetmode, input_maxbytes=None, input_maxfiles=None, input_maxseconds=None, input_engine="wget", input_basejob=None, input_shards=None):
     """
     Connects to AWS Gateway API to to submit a website download job
 
@@ -313,11 +414,19 @@ def submit_website_download_job(apikey, apiurl, input_url, input_useragent, inpu
         input_recursivelevel (str): 1-9
         input_forceipver (str): ipv6 or ipv4
         input_wgetmode (str): singlepage or recursive
+        input_maxbytes (int): optional quota of downloaded bytes. None uses the deployment default.
+        input_maxfiles (int): optional quota of downloaded files. None uses the deployment default.
+        input_maxseconds (int): optional quota of crawl seconds. None uses the deployment default.
+        input_engine (str): wget or crawler
+        input_basejob (str): optional job id of an earlier job in the same region. Only what changed since is downloaded.
+        input_shards (int): optional number of workers a recursive crawl is split across
 
     Returns:
-         touple s3_link, s3_filename
+         touple s3_link, s3_filename, proxylog_link, job_id
            s3_link (str): AWS S3 pre-signed URL to download file from S3
            s3_filename (str): Name of file within S3 e.g. 33fbce02-20e6-4120-b955-c79cc4126c0e.tar.gz'
+           proxylog_link (str): AWS S3 pre-signed URL to download the proxy.log connection summary sidecar. None if not provided by the API.
+           job_id (str): Job id for --job-status e.g. 33fbce02-20e6-4120-b955-c79cc4126c0e. None if not provided by the API.
     """
 
     # Body going to the API
@@ -331,6 +440,14 @@ def submit_website_download_job(apikey, apiurl, input_url, input_useragent, inpu
     request_body['downloadjob_details']['recursivelevel'] = input_recursivelevel
     request_body['downloadjob_details']['forceipver'] = input_forceipver
     request_body['downloadjob_details']['wgetmode'] = input_wgetmode
+    request_body['downloadjob_details']['maxbytes'] = input_maxbytes
+    request_body['downloadjob_details']['maxfiles'] = input_maxfiles
+    request_body['downloadjob_details']['maxseconds'] = input_maxseconds
+    request_body['downloadjob_details']['engine'] = input_engine
+    if input_basejob:
+        request_body['downloadjob_details']['basejob'] = input_basejob
+    if input_shards:
+        request_body['downloadjob_details']['shards'] = input_shards
 
     r = requests.post(apiurl,
                              headers={'x-api-key': apikey},
@@ -346,45 +463,263 @@ def submit_website_download_job(apikey, apiurl, input_url, input_useragent, inpu
 
         s3_link = response_dict["url"]
         s3_filename = response_dict["filename"]
+        proxylog_link = response_dict.get("proxylog_url")
+        job_id = response_dict.get("jobid")
 
     else: # something wrong
         logging.error(r.text)
         s3_link = None
         s3_filename = None
+        proxylog_link = None
+        job_id = None
+
+    return s3_link, s3_filename, proxylog_link, job_id
+
+def get_job_status(apikey, apiurl, job_id, wait=0, since=0):
+    """
+    Connects to AWS Gateway API to get the status of a download job
 
-    return s3_link, s3_filename
+    Args:
+        apikey (str): AWS API key for url
+        apiurl (str): AWS API url
+        job_id (str): job id returned when the job was submitted
+        wait (int): seconds the API waits for a status newer than since
+        since (float): updated value of the last status seen
+
+    Returns:
+        dict of job status or None if the API did not provide one
+
+        Example: {'jobid': '33fbce02-20e6-4120-b955-c79cc4126c0e', 'region': 'eu-west-1', 'state': 'crawling', 'phase': 'crawl', 'bytes': 1048576, 'files': 12, 'error': None, 'updated': 1620000000.0}
+    """
+    request_body = {}
+    request_body['jobstatus'] = True
+    request_body['jobstatus_details'] = {'jobid': job_id, 'wait': wait, 'since': since}
+
+    try:
+        r = requests.post(apiurl,
+                                 headers={'x-api-key': apikey},
+                                 json=request_body,
+                                 timeout=wait + 15
+                                )
+    except Exception as e:
+        logging.error(e)
+        return None
+
+    if r.status_code == requests.codes.ok:
+        return r.json()['message']
+
+    logging.error(r.text)
+    return None
+
+def print_job_status(status):
+    """
+    Prints a job status on one line
+
+    Args:
+        status (dict): job status as returned by get_job_status()
+    Returns:
+        None but prints output to stdout
+    """
+    line = f"* Job {status['jobid']} {status['region']}: {status['state']}"
+    if status.get('phase'):
+        line += f" ({status['phase']})"
+    if status.get('files') or status.get('bytes'):
+        line += f" {status.get('files', 0)} files {status.get('bytes', 0) >> 20}MB"
+    if status.get('attempt', 1) > 1:
+        line += f" attempt {status['attempt']}"
+    if status.get('truncated'):
+        line += f" partial: {status['truncated']}"
+    if status.get('error'):
+        line += f" error: {status['error']}"
+    print(line)
+    return
+
+def wait_for_job(apikey, apiurl, job_id):
+    """
+    Follows the job status until the job completed or failed. Each change is printed.
+
+    Args:
+        apikey (str): AWS API key for url
+        apiurl (str): AWS API url
+        job_id (str): job id returned when the job was submitted
+
+    Returns:
+        dict of the last job status. None if the API does not provide a job status.
+    """
+    status, since = None, 0
+    last_change = time.monotonic()
+    while True:
+        latest = get_job_status(apikey, apiurl, job_id, wait=JOB_STATUS_WAIT, since=since)
+        if not latest:
+            return status
+        if status is None or latest['updated'] != since: # the first status may not be newer e.g. updated 0 of an unknown job
+            status, since, last_change = latest, latest['updated'], time.monotonic()
+            print_job_status(status)
+        if status['state'] in ('complete', 'failed', 'cancelled', 'unknown'):
+            return status
+        if time.monotonic() - last_change > JOB_STATUS_STALE:
+            print(f"* Job {job_id} has not changed state for {JOB_STATUS_STALE} seconds. Giving up.")
+            return status
+
+def cancel_job(apikey, apiurl, job_id):
+    """
+    Connects to AWS Gateway API to cancel a job that no worker received yet
+
+    Args:
+        apikey (str): AWS API key for url
+        apiurl (str): AWS API url
+        job_id (str): job id returned when the job was submitted
+
+    Returns:
+        dict of the job status after the attempt, its state is cancelled when the job was cancelled. None if the API did not provide one.
+    """
+    request_body = {}
+    request_body['canceljob'] = True
+    request_body['canceljob_details'] = {'jobid': job_id}
+
+    try:
+        r = requests.post(apiurl, headers={'x-api-key': apikey}, json=request_body, timeout=15)
+    except Exception as e:
+        logging.error(e)
+        return None
+
+    if r.status_code == requests.codes.ok:
+        return r.json()['message']
+
+    logging.error(r.text)
+    return None
+
+def hedged_submission(db_path, parameters, submit_args, first_region, allowed, hedge, hedge_after):
+    """
+    Submits the same job to up to hedge regions, one after another. The next best region gets the job when no job
+    completed within hedge_after seconds of the last submission or when every job submitted so far failed. The first
+    job to complete wins. The other jobs are cancelled if no worker received them yet or are left to run and kept in
+    the journal as hedged.
+
+    Args:
+        db_path (str): path of the SQLite journal
+        parameters (dict): job options as journaled
+        submit_args (dict): keyword arguments of submit_website_download_job() without the API
+        first_region (str): region of the first job. None uses the best region of rank_regions().
+        allowed (list): regions rank_regions() may choose from. None allows every configured region.
+        hedge (int): regions the job is submitted to at most
+        hedge_after (int): seconds
+    Returns:
+        list with the journal filename of the job that completed. Empty when no job completed.
+    """
+    jobs = [] # submitted jobs with their last status
+    tried, exhausted = set(), False # regions the job was submitted to and whether any is left
+    last_submission = last_change = time.monotonic()
+    while True:
+        active = [job for job in jobs if job['state'] not in ('failed', 'cancelled')]
+        can_hedge = len(tried) < hedge and not exhausted
+        if can_hedge and (not active or time.monotonic() - last_submission >= hedge_after):
+            if first_region and not tried:
+                candidates = [(first_region, *get_api_info(region_name=first_region)[1:3])]
+            else:
+                candidates = [target for target in rank_regions(db_path, allowed=allowed) if target[0] not in tried]
+            if candidates:
+                region, apikey, apiurl = candidates[0]
+                tried.add(region)
+                print(f"* Submitting job for {region}" + (f" (hedge {len(tried)} of {hedge})" if jobs else ""))
+                job_file_url, job_filename, proxylog_url, job_id = submit_website_download_job(apikey=apikey, apiurl=apiurl, **submit_args)
+                if job_file_url and job_filename and job_id:
+                    journal_submission(db_path, region, parameters, job_file_url, job_filename, proxylog_url, job_id)
+                    jobs.append({'region': region, 'apikey': apikey, 'apiurl': apiurl, 'filename': job_filename, 'job_id': job_id, 'state': 'queued', 'updated': 0})
+                else:
+                    journal_region_error(db_path, region, "Job submission failed")
+                last_submission = last_change = time.monotonic()
+                continue
+            exhausted, can_hedge = True, False # no region left to hedge to
+
+        if not active and not can_hedge:
+            print("* No hedged job completed")
+            return []
+        if time.monotonic() - last_change > JOB_STATUS_STALE:
+            print(f"* No hedged job changed state for {JOB_STATUS_STALE} seconds. Giving up.")
+            return []
+
+        winner = None
+        for job in active:
+            status = get_job_status(job['apikey'], job['apiurl'], job['job_id'])
+            if status and status['updated'] != job['updated']:
+                job.update(state=status['state'], updated=status['updated'])
+                last_change = time.monotonic()
+                print_job_status(status)
+            if job['state'] == 'complete':
+                winner = job
+                break
+        if winner:
+            break
+        time.sleep(HEDGE_POLL_INTERVAL)
+
+    for job in jobs:
+        if job is winner or job['state'] in ('failed', 'cancelled'):
+            continue
+        status = cancel_job(job['apikey'], job['apiurl'], job['job_id'])
+        if status and status['state'] == 'cancelled':
+            print(f"* Cancelled the job in {job['region']}")
+            journal_update(db_path, job['filename'], state='cancelled')
+        else: # a worker has it. Its result can still be fetched with --job-status.
+            print(f"* Job {job['job_id']} in {job['region']} is left to finish")
+            journal_update(db_path, job['filename'], state='hedged')
+    print(f"* {winner['region']} completed the job first")
+    return [winner['filename']]
 
 def download_file(signed_url, output_filename):
     """Downloads file from an AWS S3 signed URL.
     The URL will exist before the job and its file is uploaded to S3.
     This code continuously checks if the file is available using a back_off interval.
+    The file is written as <output_filename>.part and renamed once complete. An existing .part file from an
+    interrupted download is continued with a HTTP Range request.
 
     Args:
         signed_url (str):
         output_filename (str):
 
     Returns:
-        None but prints output to stdout
+        int bytes of the downloaded file or None if it was not downloaded. Also prints output to stdout.
     """
     print(f"* Continously checking for download availability at URL: {signed_url}")
 
     filetest = Path(output_filename) # create pathlib object
     if filetest.is_file(): # file exists
         print("Error: Output file already exists. Will not overwrite. Provided URL is still valid to download job results.")
-        return
+        return None
+
+    partial = Path(output_filename + '.part')
+    received = partial.stat().st_size if partial.is_file() else 0
 
     http = requests.Session()
     retries = Retry(total=12, backoff_factor=10, status_forcelist=[404])
     http.mount("https://", HTTPAdapter(max_retries=retries))
 
     try:
-        response = http.get(signed_url, timeout=5)
+        response = http.get(signed_url, timeout=5, stream=True, headers={'Range': f'bytes={received}-'} if received else None)
         logging.debug(response.headers)
 
-        if response.status_code == requests.codes.ok:
-            with open(output_filename, 'wb') as w:
-                w.write(response.content)
+        if response.status_code == 416: # .part already holds the whole file
+            partial.rename(filetest)
             print(f"* Job results downloaded to: {filetest.absolute()}")
+            return filetest.stat().st_size
+
+        if response.status_code in (requests.codes.ok, requests.codes.partial_content):
+            if received and response.status_code == requests.codes.partial_content:
+                print(f"* Continuing interrupted download at {received / (1 << 20):.1f}MB")
+            with open(partial, 'ab' if response.status_code == requests.codes.partial_content else 'wb') as w:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    w.write(chunk)
+            partial.rename(filetest)
+            print(f"* Job results downloaded to: {filetest.absolute()}")
+            if response.headers.get('x-amz-meta-timings'): # set by the worker. Upload time itself is only in the Cloudwatch metrics.
+                print_job_timings(json.loads(response.headers['x-amz-meta-timings']))
+            if response.headers.get('x-amz-meta-resources'): # set by the worker. Samples up to compression.
+                print_job_resources(json.loads(response.headers['x-amz-meta-resources']))
+            if response.headers.get('x-amz-meta-truncated'): # set by the worker when a quota stopped the crawl
+                print(f"* Warning: Job results are partial. The crawl was stopped because the {response.headers['x-amz-meta-truncated']}. See truncated.json in the archive.")
+            if response.headers.get('x-amz-meta-incremental'): # set by the worker for incremental recrawls
+                print(f"* Incremental job: {response.headers['x-amz-meta-incremental']}. Rebuild the full tree with --rebuild.")
+            return filetest.stat().st_size
         else:
             logging.error(f"Unknown error. Unable to download content from link. HTTP status code: {response.status_code}")
 
@@ -392,6 +727,586 @@ def download_file(signed_url, output_filename):
         logging.error(e)
         print("Unable to download job results from URL. This could be because the job is still running or because the job has failed. Try the URL again later and if it still does not work, the job likely failed. Contact your system administrator.")
 
+    return None
+
+def print_job_timings(timings):
+    """
+    Prints how long each phase of the job took on the worker
+
+    Args:
+        timings (dict): phase name -> seconds e.g. {'startup': 1.2, 'proxy_check': 0.01, 'sqs_receive': 0.3, 'crawl': 12.5}
+    Returns:
+        None but prints output to stdout
+    """
+    total = sum(timings.values()) or 1
+    print("* Job phase timings:")
+    for phase, seconds in timings.items():
+        print(f"    {phase:<22} {seconds:>10.2f}s {seconds / total:>6.1%}")
+    return
+
+def print_job_resources(resources):
+    """
+    Prints the resource use of the worker during the job. resources.csv in the archive has every sample.
+
+    Args:
+        resources (dict): summary of the resource samples of the worker
+    Returns:
+        None but prints output to stdout
+    """
+    peaks = resources.get('peak_phases', {})
+    print(f"* Worker resources ({resources['samples']} samples):")
+    print(f"    CPU busy {resources['cpu_busy_pct_mean']}% mean, {resources['cpu_busy_pct_max']}% max. Most user time in {peaks.get('cpu_user_pct', '-')}")
+    print(f"    CPU steal {resources['cpu_steal_pct_max']}% max ({peaks.get('cpu_steal_pct', '-')}), iowait {resources['cpu_iowait_pct_max']}% max ({peaks.get('cpu_iowait_pct', '-')})")
+    print(f"    Memory available {resources['mem_available_mb_min']}MB min, swap used {resources['swap_used_mb_max']}MB max. RSS max wget {resources['rss_wget_mb_max']}MB, sslsplit {resources['rss_sslsplit_mb_max']}MB, python {resources['rss_python_mb_max']}MB")
+    print(f"    Disk read {resources['disk_read_mb']}MB, written {resources['disk_write_mb']}MB ({peaks.get('disk_write_kbps', '-')}). Free space {resources['free_mb_min']}MB min")
+    print(f"    Network received {resources['net_rx_mb']}MB ({peaks.get('net_rx_kbps', '-')}), sent {resources['net_tx_mb']}MB ({peaks.get('net_tx_kbps', '-')})")
+    return
+
+def download_sidecar(signed_url, output_filename, description="Connection summary"):
+    """Downloads a small sidecar file (e.g. the proxy.log connection summary) from an AWS S3 signed URL.
+    The worker uploads sidecars before the job tar.gz so a single attempt is made once the tar.gz was downloaded.
+
+    Args:
+        signed_url (str):
+        output_filename (str):
+        description (str): what the sidecar is, for the output
+
+    Returns:
+        None but prints output to stdout
+    """
+    if not signed_url:
+        return
+
+    if Path(output_filename).is_file():
+        print(f"Error: Output file {output_filename} already exists. Will not overwrite.")
+        return
+
+    try:
+        response = requests.get(signed_url, timeout=30)
+        if response.status_code == requests.codes.ok:
+            with open(output_filename, 'wb') as w:
+                w.write(response.content)
+            print(f"* {description} downloaded to: {Path(output_filename).absolute()}")
+        else:
+            logging.debug(f"{description} not available. HTTP status code: {response.status_code}")
+    except Exception as e:
+        logging.error(e)
+
+    return
+
+def query_connections(paths, ip=None, sni=None, host=None, since=None, until=None):
+    """
+    Prints the connections of many jobs that match all of the provided predicates.
+    Reads the proxy.log connection summary sidecars (*.proxy_log.csv.gz) or, when a job has no sidecar, streams it out of the job tar.gz.
+
+    Args:
+        paths (list): files or directories containing sidecars and job archives
+        ip (str): destination IP address
+        sni (str): TLS SNI
+        host (str): HTTP Host header
+        since (str): ISO 8601 UTC timestamp e.g. 2021-05-02T17:05:05Z
+        until (str): ISO 8601 UTC timestamp
+    Returns:
+        None but prints output to stdout
+    """
+    print("{:<50} {:<20} {:<6} {:<40} {:<6} {:<40} {:<7} {:<6} {:<10} {}".format("JOB", "TIMESTAMP", "PROTO", "DESTINATION", "PORT", "SNI/HOST", "METHOD", "STATUS", "BYTES", "URI"))
+    matches = 0
+    for job_name, record in job_artifacts.query_connection_summaries(paths, ip=ip, sni=sni, host=host, since=since, until=until):
+        print("{:<50} {:<20} {:<6} {:<40} {:<6} {:<40} {:<7} {:<6} {:<10} {}".format(job_name,
+                                                                                   record['timestamp'] or '-',
+                                                                                   record['proto'] or '-',
+                                                                                   record['dst_ip'] or '-',
+                                                                                   record['dst_port'] or '-',
+                                                                                   record['sni'] or record['host'] or '-',
+                                                                                   record['method'] or '-',
+                                                                                   record['status'] or '-',
+                                                                                   record['bytes'] or '-',
+                                                                                   record['uri'] or '-'))
+        matches += 1
+    print(f"* {matches} matching connections")
+    return
+
+def open_index(db_path):
+    """
+    Opens (and creates when needed) the local SQLite analytics index of job archives.
+
+    Args:
+        db_path (str): path of the SQLite database
+    Returns:
+        sqlite3.Connection
+    """
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(db_path))
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            archive_path TEXT NOT NULL,
+            archive_sha256 TEXT NOT NULL UNIQUE,
+            archive_bytes INTEGER NOT NULL,
+            indexed_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS observations (
+            job_id INTEGER NOT NULL REFERENCES jobs(id),
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL COLLATE NOCASE,
+            detail TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS observations_value ON observations (value);
+    """)
+    return db
+
+def find_archives(paths):
+    """Returns the job tar.gz files of a list of files and directories containing them"""
+    archives = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            archives.extend(sorted(path.glob('*.tar.gz')))
+        elif path.is_file():
+            archives.append(path)
+    return archives
+
+def index_archives(paths, db_path=LOCAL_INDEX_DB, workers=None):
+    """
+    Adds job archives to the local analytics index.
+    Archives are streamed (never extracted to disk) in parallel worker processes. An archive whose sha256 is already
+    in the index is skipped.
+
+    Args:
+        paths (list): job tar.gz files or directories containing them
+        db_path (str): path of the SQLite database
+        workers (int): number of worker processes. Default is the number of CPUs.
+    Returns:
+        None but prints output to stdout
+    """
+    archives = find_archives(paths)
+
+    db = open_index(db_path)
+    known_checksums = {row[0] for row in db.execute("SELECT archive_sha256 FROM jobs")}
+    indexed, skipped = 0, 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job_artifacts.scan_job_archive, str(archive), known_checksums): archive for archive in archives}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Unable to index {futures[future]}: {e}")
+                continue
+
+            if result['skipped'] or result['sha256'] in known_checksums:
+                skipped += 1
+                continue
+
+            with db: # one transaction per archive
+                cursor = db.execute("INSERT INTO jobs (name, archive_path, archive_sha256, archive_bytes, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                                    (result['name'], result['path'], result['sha256'], result['bytes'], datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z'))
+                db.executemany("INSERT INTO observations (job_id, kind, value, detail) VALUES (?, ?, ?, ?)",
+                               [(cursor.lastrowid, kind, value, detail) for kind, value, detail in result['observations']])
+            known_checksums.add(result['sha256'])
+            indexed += 1
+            print(f"* Indexed {result['name']} ({len(result['observations'])} observations)")
+
+    db.close()
+    print(f"* {indexed} archives indexed, {skipped} already indexed")
+    return
+
+def diff_archives(paths, workers=None):
+    """
+    Compares jobs of the same URL from different regions e.g. of --awsregion all-regions. Prints which regions saw
+    which variant of every downloaded file and of the leaf certificates of every host that is not the same everywhere.
+    Archives are streamed (never extracted to disk) and hashed in parallel worker processes.
+
+    Args:
+        paths (list): job tar.gz files or directories containing them
+        workers (int): number of worker processes. Default is the number of CPUs.
+    Returns:
+        None but prints output to stdout
+    """
+    archives = find_archives(paths)
+    if len(archives) < 2:
+        print("Error: --diff needs at least two job archives")
+        return
+
+    fingerprints = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job_artifacts.fingerprint_job_archive, str(archive)): archive for archive in archives}
+        for future in as_completed(futures):
+            try:
+                fingerprints.append(future.result())
+            except Exception as e:
+                logging.error(f"Unable to read {futures[future]}: {e}")
+    fingerprints.sort(key=lambda fingerprint: (fingerprint['region'], fingerprint['name']))
+
+    print(f"* Compared {len(fingerprints)} jobs")
+    for number, fingerprint in enumerate(fingerprints, 1):
+        print("{:>4} {:<16} {:<50} {} files, {} hosts with certificates".format(number, fingerprint['region'], fingerprint['name'], len(fingerprint['files']), len(fingerprint['certificates'])))
+    rows, counts = job_artifacts.diff_fingerprints(fingerprints)
+    print("{:<5} {} {}".format("KIND", " ".join(f"{number:>2}" for number in range(1, len(fingerprints) + 1)), "FILE/HOST"))
+    for kind, key, variants in rows:
+        print("{:<5} {} {}".format(kind, " ".join(f"{variant:>2}" for variant in variants), key))
+    print(f"* Files: {counts['file']['same']} the same in every job, {counts['file']['different']} differ. "
+          f"Certificates: {counts['cert']['same']} hosts the same in every job, {counts['cert']['different']} differ. "
+          f"Letters are variants, {job_artifacts.VARIANT_MISSING} is not seen.")
+    return
+
+def compare_timings(paths, workers=None):
+    """
+    Compares the network timings of jobs e.g. of --awsregion all-regions. Prints the request latencies and throughput of
+    every job and the median time to first byte of every host per job. Only the timing summaries are read from the
+    archives, in parallel worker processes.
+
+    Args:
+        paths (list): job tar.gz files or directories containing them
+        workers (int): number of worker processes. Default is the number of CPUs.
+    Returns:
+        None but prints output to stdout
+    """
+    archives = find_archives(paths)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job_artifacts.read_archive_timing_summary, str(archive)): archive for archive in archives}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Unable to read {futures[future]}: {e}")
+                continue
+            if result['summary'] is None:
+                print(f"* {result['name']} has no network timings")
+                continue
+            results.append(result)
+    if not results:
+        print("Error: --timing found no job archives with network timings")
+        return
+    results.sort(key=lambda result: (result['region'], result['name']))
+
+    def cell(value):
+        return "-" if value is None else str(round(value))
+
+    print("{:>4} {:<16} {:>9} {:>14} {:>10} {:>10} {:>10} {}".format("", "REGION", "REQUESTS", "DNS-READY p50", "TTFB p50", "TTFB p95", "KB/s p50", "JOB"))
+    for number, result in enumerate(results, 1):
+        summary = result['summary']['all']
+        print("{:>4} {:<16} {:>9} {:>14} {:>10} {:>10} {:>10} {}".format(number, result['region'], summary['requests'], cell(summary['dns_ready_ms_p50']),
+                                                                        cell(summary['ttfb_ms_p50']), cell(summary['ttfb_ms_p95']), cell(summary['kbps_p50']), result['name']))
+    if len(results) > 1:
+        hosts = sorted(set().union(*(result['summary']['hosts'] for result in results)))
+        print("{} {}".format(" ".join(f"{number:>7}" for number in range(1, len(results) + 1)), "HOST (TTFB p50 ms)"))
+        for host in hosts:
+            print("{} {}".format(" ".join(f"{cell(result['summary']['hosts'].get(host, {}).get('ttfb_ms_p50')):>7}" for result in results), host))
+    print("* Milliseconds. DNS-READY is from the DNS answer to the connection being ready, which includes the TCP and TLS handshakes.")
+    return
+
+def search_index(value, db_path=LOCAL_INDEX_DB):
+    """
+    Looks up a value in the local analytics index and prints every job that saw it.
+    The value is matched exactly (case-insensitive) against hosts, IPs, URLs, certificate fingerprints and file hashes.
+
+    Args:
+        value (str): e.g. www.google.com, 172.217.161.36, F0487A59653433F8A192C6C4FB9ACCC5AD0CB3E2 or a sha256
+        db_path (str): path of the SQLite database
+    Returns:
+        None but prints output to stdout
+    """
+    if not Path(db_path).is_file():
+        print(f"Error: No index found at {db_path}. Create one with --index.")
+        return
+
+    db = open_index(db_path)
+    rows = db.execute("""SELECT jobs.name, observations.kind, observations.detail, jobs.archive_path
+                         FROM observations JOIN jobs ON jobs.id = observations.job_id
+                         WHERE observations.value = ?
+                         ORDER BY jobs.name""", (value,)).fetchall()
+    db.close()
+
+    print("{:<50} {:<12} {:<40} {}".format("JOB", "KIND", "DETAIL", "ARCHIVE"))
+    for name, kind, detail, archive_path in rows:
+        print("{:<50} {:<12} {:<40} {}".format(name, kind, detail or '-', archive_path))
+    print(f"* {len(rows)} matches")
+    return
+
+def rebuild_job_tree(archive_path, output_dir=None):
+    """
+    Rebuilds the full downloaded tree (wget_saved/) of an incremental job from its archive and the archives of the
+    jobs it was built on. Those must be in the same directory as archive_path.
+    A sharded job is rebuilt from its manifest sidecar and the archives of the coordinator and its shards.
+
+    Args:
+        archive_path (str): job tar.gz or <jobid>-<region>.manifest.json.gz
+        output_dir (str): directory to create. Default: <jobid>-<region>-full next to the current directory.
+    Returns:
+        None but prints output to stdout
+    """
+    if archive_path.endswith(job_artifacts.MANIFEST_SUFFIX):
+        with open(archive_path, 'rb') as manifest_f:
+            manifest = job_artifacts.read_manifest(manifest_f)
+    else:
+        manifest = job_artifacts.read_archive_manifest(archive_path)
+    if not manifest:
+        print(f"Error: {archive_path} has no manifest. It was created before incremental recrawls existed.")
+        return
+
+    output_dir = output_dir or job_artifacts.job_name_from_path(archive_path) + '-full'
+    if Path(output_dir).exists():
+        print(f"Error: Output directory {output_dir} already exists. Will not overwrite.")
+        return
+
+    try:
+        files, written = job_artifacts.rebuild_tree(manifest, str(Path(archive_path).parent), output_dir)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+
+    print(f"* Rebuilt {files} files ({written / (1 << 20):.1f}MB) of {manifest['job']} in {Path(output_dir).absolute()}")
+    if manifest.get('shards'):
+        print(f"* Sharded job of {len(manifest['shards']) - 1} shards")
+    if manifest['base']:
+        changes = manifest['changes']
+        print(f"* {len(changes['added'])} added and {len(changes['changed'])} changed since {manifest['base']}. {len(set(job_artifacts.manifest_files_by_job(manifest)) - {manifest['job']})} earlier jobs were used.")
+    return
+
+def presigned_url_expiry(signed_url):
+    """
+    Reads when an AWS S3 pre-signed URL stops working
+
+    Args:
+        signed_url (str): Signature Version 4 (X-Amz-Date and X-Amz-Expires) or 2 (Expires) pre-signed URL
+    Returns:
+        float unix time or None if the URL does not say
+    """
+    query = parse_qs(urlparse(signed_url).query)
+    try:
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            signed = datetime.datetime.strptime(query['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+            return signed.timestamp() + int(query['X-Amz-Expires'][0])
+        if 'Expires' in query:
+            return float(query['Expires'][0])
+    except ValueError:
+        pass
+    return None
+
+def open_journal(db_path):
+    """
+    Opens (and creates when needed) the local SQLite journal of submitted jobs.
+    Each caller opens its own connection so the journal can be updated from download threads.
+
+    Args:
+        db_path (str): path of the SQLite database
+    Returns:
+        sqlite3.Connection
+    """
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(db_path), timeout=30)
+    db.row_factory = sqlite3.Row
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS submissions (
+            filename TEXT PRIMARY KEY,
+            job_id TEXT,
+            region TEXT NOT NULL,
+            parameters TEXT NOT NULL,
+            url TEXT NOT NULL,
+            proxylog_url TEXT,
+            url_expires REAL,
+            output_path TEXT NOT NULL,
+            state TEXT NOT NULL,
+            bytes_received INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            submitted_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS submissions_state ON submissions (state);
+        CREATE TABLE IF NOT EXISTS region_errors (
+            region TEXT NOT NULL,
+            failed_at REAL NOT NULL,
+            error TEXT
+        );
+    """)
+    return db
+
+def journal_submission(db_path, region, parameters, url, filename, proxylog_url, job_id):
+    """
+    Records a submitted job in the journal before anything is downloaded
+
+    Args:
+        db_path (str): path of the SQLite database
+        region (str): AWS region the job was submitted to
+        parameters (dict): job options as sent to the API
+        url (str): pre-signed URL of the job tar.gz
+        filename (str): name of the job tar.gz e.g. 33fbce02-20e6-4120-b955-c79cc4126c0e-eu-west-1.tar.gz
+        proxylog_url (str): pre-signed URL of the connection summary or None
+        job_id (str): job id or None if not provided by the API
+    Returns:
+        None
+    """
+    now = datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    db = open_journal(db_path)
+    with db:
+        db.execute("INSERT OR REPLACE INTO submissions (filename, job_id, region, parameters, url, proxylog_url, url_expires, output_path, state, submitted_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'submitted', ?, ?)",
+                   (filename, job_id, region, json.dumps(parameters), url, proxylog_url, presigned_url_expiry(url), str(Path(filename).absolute()), now, now))
+    db.close()
+    return
+
+def journal_region_error(db_path, region, error):
+    """
+    Records an API error of a region. Recent errors count against the region in --awsregion auto.
+
+    Args:
+        db_path (str): path of the SQLite database
+        region (str): AWS region
+        error (str): what went wrong
+    Returns:
+        None
+    """
+    db = open_journal(db_path)
+    with db:
+        db.execute("INSERT INTO region_errors (region, failed_at, error) VALUES (?, ?, ?)", (region, time.time(), error))
+    db.close()
+    return
+
+def recent_region_errors(db_path, since):
+    """
+    Counts the API errors of every region since a point in time
+
+    Args:
+        db_path (str): path of the SQLite database
+        since (float): epoch seconds
+    Returns:
+        dict region -> number of errors
+    """
+    db = open_journal(db_path)
+    errors = {row['region']: row['errors'] for row in db.execute("SELECT region, COUNT(*) AS errors FROM region_errors WHERE failed_at >= ? GROUP BY region", (since,))}
+    db.close()
+    return errors
+
+def journal_update(db_path, filename, **fields):
+    """
+    Updates columns of a journal entry e.g. journal_update(db_path, filename, state='downloaded', bytes_received=1024)
+
+    Args:
+        db_path (str): path of the SQLite database
+        filename (str): journal entry
+    Returns:
+        None
+    """
+    fields['updated_at'] = datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    db = open_journal(db_path)
+    with db:
+        db.execute(f"UPDATE submissions SET {', '.join(column + ' = ?' for column in fields)} WHERE filename = ?", (*fields.values(), filename))
+    db.close()
+    return
+
+def download_journal_entry(db_path, entry):
+    """
+    Waits for a journaled job and downloads its results, keeping the journal up to date.
+    Expired pre-signed URLs are renewed through the job status API of the region.
+
+    Args:
+        db_path (str): path of the SQLite database
+        entry (dict): journal row
+    Returns:
+        str final journal state: downloaded, failed or expired. submitted when the download should be retried later.
+    """
+    filename, output_path = entry['filename'], entry['output_path']
+    api = next((data for item in available_apis() for region, data in item.items() if region == entry['region']), None)
+
+    if Path(output_path).is_file(): # downloaded before the journal was updated
+        journal_update(db_path, filename, state='downloaded', bytes_received=Path(output_path).stat().st_size)
+        return 'downloaded'
+
+    url, proxylog_url = entry['url'], entry['proxylog_url']
+    job_status = wait_for_job(apikey=api['key'], apiurl=api['url'], job_id=entry['job_id']) if api and entry['job_id'] else None
+    if job_status and job_status['state'] == 'failed': # nothing to download from a failed job
+        journal_update(db_path, filename, state='failed', error=job_status.get('error'))
+        return 'failed'
+    if job_status and job_status.get('url'): # a complete job comes with fresh pre-signed URLs
+        url, proxylog_url = job_status['url'], job_status.get('proxylog_url')
+        journal_update(db_path, filename, url=url, proxylog_url=proxylog_url, url_expires=presigned_url_expiry(url))
+
+    expires = presigned_url_expiry(url)
+    if expires and expires < time.time():
+        print(f"* Download link of {filename} expired and the job status API did not provide a new one")
+        journal_update(db_path, filename, state='expired')
+        return 'expired'
+
+    journal_update(db_path, filename, state='downloading')
+    received = download_file(signed_url=url, output_filename=output_path)
+    if received is None:
+        partial = Path(output_path + '.part')
+        journal_update(db_path, filename, state='submitted', bytes_received=partial.stat().st_size if partial.is_file() else 0)
+        return 'submitted'
+    journal_update(db_path, filename, state='downloaded', bytes_received=received)
+    download_sidecar(signed_url=proxylog_url, output_filename=output_path.replace('.tar.gz', job_artifacts.CONNECTION_SUMMARY_SUFFIX))
+
+    if job_status and job_status.get('shard_urls'): # the rest of a sharded job is in the archives of its shards
+        for shard_job, shard_url in job_status['shard_urls'].items():
+            if download_file(signed_url=shard_url, output_filename=str(Path(output_path).with_name(shard_job + '.tar.gz'))) is None:
+                print(f"* Shard {shard_job} of {filename} was not downloaded")
+        manifest_path = output_path.replace('.tar.gz', job_artifacts.MANIFEST_SUFFIX)
+        download_sidecar(signed_url=job_status.get('manifest_url'), output_filename=manifest_path, description="Sharded job manifest")
+        print(f"* Sharded job of {len(job_status['shard_urls'])} shards. Rebuild the full tree with --rebuild {manifest_path}")
+    return 'downloaded'
+
+def download_journal_entries(db_path, filenames=None):
+    """
+    Downloads journaled jobs concurrently
+
+    Args:
+        db_path (str): path of the SQLite database
+        filenames (list): journal entries to download. None downloads every entry that is still pending.
+    Returns:
+        None but prints output to stdout
+    """
+    db = open_journal(db_path)
+    if filenames is None:
+        entries = db.execute(f"SELECT * FROM submissions WHERE state IN ({', '.join('?' for _ in JOURNAL_PENDING_STATES)}) ORDER BY submitted_at", JOURNAL_PENDING_STATES).fetchall()
+    else:
+        entries = [row for row in db.execute("SELECT * FROM submissions").fetchall() if row['filename'] in filenames]
+    db.close()
+    entries = [dict(row) for row in entries]
+
+    if filenames is None:
+        print(f"* Resuming {len(entries)} pending downloads")
+    if not entries:
+        return
+
+    states = {}
+    with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(entries))) as executor:
+        futures = {executor.submit(download_journal_entry, db_path, entry): entry['filename'] for entry in entries}
+        for future in as_completed(futures):
+            try:
+                state = future.result()
+            except Exception as e:
+                logging.error(f"ERROR downloading {futures[future]}: {e}")
+                state = 'submitted'
+            states[state] = states.get(state, 0) + 1
+    if len(entries) > 1 or filenames is None:
+        print("* " + ", ".join(f"{count} {state}" for state, count in sorted(states.items())).replace(' submitted', ' still pending (run --resume later)'))
+    return
+
+def list_journal(db_path):
+    """
+    Prints every job in the journal
+
+    Args:
+        db_path (str): path of the SQLite database
+    Returns:
+        None but prints output to stdout
+    """
+    if not Path(db_path).is_file():
+        print(f"Error: No journal found at {db_path}. Jobs are journaled when submitted.")
+        return
+
+    db = open_journal(db_path)
+    rows = db.execute("SELECT * FROM submissions ORDER BY submitted_at").fetchall()
+    db.close()
+
+    print("{:<21} {:<38} {:<15} {:<12} {:>10} {:<21} {}".format("SUBMITTED", "JOB ID", "REGION", "STATE", "MB", "LINK EXPIRES", "URL"))
+    for row in rows:
+        parameters = json.loads(row['parameters'])
+        expires = datetime.datetime.utcfromtimestamp(row['url_expires']).isoformat(timespec='seconds') + 'Z' if row['url_expires'] else '-'
+        print("{:<21} {:<38} {:<15} {:<12} {:>10.1f} {:<21} {}".format(row['submitted_at'], row['job_id'] or row['filename'], row['region'], row['state'],
+                                                                      row['bytes_received'] / (1 << 20), expires, parameters.get('url', '-')))
+    print(f"* {len(rows)} jobs. {sum(row['state'] in JOURNAL_PENDING_STATES for row in rows)} pending downloads (resume with --resume)")
     return
 
 def main():
@@ -466,10 +1381,57 @@ Examples:\n\
                         metavar='<1-9>',
                         help='Use with recursive download type. A number to define the level of recursion. The higher the number, the more recursion.')
 
+    groupB.add_argument('--engine',
+                        required=False,
+                        dest='in_engine',
+                        default='wget',
+                        choices=['wget', 'crawler'],
+                        help='Download engine. wget (default) fetches one URL at a time. crawler is the built-in concurrent crawler with the same output layout.')
+
+    groupB.add_argument('--maxsize',
+                        action='store',
+                        required=False,
+                        type=int,
+                        dest='in_maxsize',
+                        metavar='<MB>',
+                        help='Optional. Stop the download after this many megabytes. Partial results are still provided. Default and ceiling are set by the deployment.')
+
+    groupB.add_argument('--maxfiles',
+                        action='store',
+                        required=False,
+                        type=int,
+                        dest='in_maxfiles',
+                        metavar='<count>',
+                        help='Optional. Stop the download after this many files. Partial results are still provided. Default and ceiling are set by the deployment.')
+
+    groupB.add_argument('--maxtime',
+                        action='store',
+                        required=False,
+                        type=int,
+                        dest='in_maxtime',
+                        metavar='<seconds>',
+                        help='Optional. Stop the download after this many seconds. Partial results are still provided. Default and ceiling are set by the deployment.')
+
+    groupB.add_argument('--incremental',
+                        action='store',
+                        required=False,
+                        dest='in_incremental',
+                        metavar='<job id>',
+                        help='Optional. Job id of an earlier job of the same URL in the same --awsregion. Only files changed since that job are downloaded and archived (conditional requests) while the traffic capture is complete. Rebuild the full tree with --rebuild.')
+
+    groupB.add_argument('--shards',
+                        action='store',
+                        required=False,
+                        type=int,
+                        dest='in_shards',
+                        metavar='<count>',
+                        help='Optional. Split a recursive crawl with the crawler engine across this many workers. Each shard is archived separately and downloaded with the job. Rebuild the full tree with --rebuild.')
+
     groupB.add_argument('--awsregion',
                         required=False,
                         dest='in_awsregion',
                         choices=['all-regions',
+                                 'auto',
                                  'us-east-2',
                                  'us-east-1',
                                  'us-west-1',
@@ -495,7 +1457,32 @@ Examples:\n\
                                  'sa-east-1',
                                  'us-gov-east-1',
                                  'us-gov-west-1'],
-                        help='AWS region to conduct download from. See --regionoptions for enabled regions.')
+                        help='AWS region to conduct download from. See --regionoptions for enabled regions. auto submits to the enabled region expected to complete the job first from its queue and workers.')
+
+    groupB.add_argument('--hedge',
+                        action='store',
+                        required=False,
+                        type=int,
+                        dest='in_hedge',
+                        metavar='<regions>',
+                        help='Optional. Submit the job to up to this many regions, one after another, until one completes it. The next best region gets the job when it did not complete within --hedge-after seconds or failed. The first result is downloaded and the other jobs are cancelled if still queued.')
+
+    groupB.add_argument('--hedge-after',
+                        action='store',
+                        required=False,
+                        type=int,
+                        default=HEDGE_AFTER_SECONDS,
+                        dest='in_hedgeafter',
+                        metavar='<seconds>',
+                        help=f'Optional. Seconds a hedged job is given before the next region gets it. Default is {HEDGE_AFTER_SECONDS}.')
+
+    groupB.add_argument('--auto-regions',
+                        action='store',
+                        required=False,
+                        nargs='+',
+                        dest='in_autoregions',
+                        metavar='<region>',
+                        help='Optional. Regions --awsregion auto may choose from. Default is every enabled region.')
 
     groupC = parser.add_argument_group("Additonal Features")
     groupC.add_argument('--useragentoptions',
@@ -510,12 +1497,130 @@ Examples:\n\
                         action='store_true',
                         help='Display overall application status')
 
+    groupC.add_argument('--job-status',
+                        required=False,
+                        dest='in_jobstatus',
+                        metavar='<job id>',
+                        help='Display the state of a download job e.g. queued, crawling, uploading, complete or failed. Requires --awsregion.')
+
+    groupC.add_argument('--follow',
+                        required=False,
+                        dest='in_follow',
+                        action='store_true',
+                        help='Use with --job-status. Keep displaying state changes until the job completed or failed.')
+
     groupC.add_argument('--regionoptions',
                         required=False,
                         dest='in_regionoptions',
                         action='store_true',
                         help='Display which AWS regions are available to use this script ')
 
+    groupD = parser.add_argument_group("Connection Query")
+    groupD.add_argument('--query-connections',
+                        required=False,
+                        dest='in_queryconnections',
+                        nargs='+',
+                        metavar='<path>',
+                        help='Query the proxy.log connection summaries of downloaded jobs. Accepts *.proxy_log.csv.gz sidecars, job tar.gz files or directories containing them.')
+
+    groupD.add_argument('--ip',
+                        required=False,
+                        dest='in_ip',
+                        metavar='',
+                        help='Use with --query-connections. Destination IP address to match.')
+
+    groupD.add_argument('--sni',
+                        required=False,
+                        dest='in_sni',
+                        metavar='',
+                        help='Use with --query-connections. TLS SNI to match.')
+
+    groupD.add_argument('--host',
+                        required=False,
+                        dest='in_host',
+                        metavar='',
+                        help='Use with --query-connections. HTTP Host header to match.')
+
+    groupD.add_argument('--since',
+                        required=False,
+                        dest='in_since',
+                        metavar='<timestamp>',
+                        help='Use with --query-connections. Only connections at or after this UTC time e.g. 2021-05-02T17:05:05Z')
+
+    groupD.add_argument('--until',
+                        required=False,
+                        dest='in_until',
+                        metavar='<timestamp>',
+                        help='Use with --query-connections. Only connections at or before this UTC time e.g. 2021-05-02T18:00:00Z')
+
+    groupE = parser.add_argument_group("Local Index")
+    groupE.add_argument('--index',
+                        required=False,
+                        dest='in_index',
+                        nargs='+',
+                        metavar='<path>',
+                        help='Add downloaded job tar.gz files (or directories containing them) to the local analytics index. Already indexed archives are skipped.')
+
+    groupE.add_argument('--search',
+                        required=False,
+                        dest='in_search',
+                        metavar='<value>',
+                        help='Find every indexed job that saw a host, IP, URL, certificate fingerprint (sha1 or sha256) or downloaded file sha256')
+
+    groupE.add_argument('--index-db',
+                        required=False,
+                        dest='in_indexdb',
+                        default=str(LOCAL_INDEX_DB),
+                        metavar='<path>',
+                        help=f'Location of the local analytics index. Default: {LOCAL_INDEX_DB}')
+
+    groupE.add_argument('--diff',
+                        required=False,
+                        dest='in_diff',
+                        nargs='+',
+                        metavar='<path>',
+                        help='Compare job tar.gz files (or directories containing them) of the same URL from different regions. Shows which regions saw which variant of the downloaded files and leaf certificates.')
+
+    groupE.add_argument('--timing',
+                        required=False,
+                        dest='in_timing',
+                        nargs='+',
+                        metavar='<path>',
+                        help='Compare the network timings (time to first byte, DNS to connection ready, throughput) of job tar.gz files or directories containing them e.g. from different regions.')
+
+    groupF = parser.add_argument_group("Job Journal")
+    groupF.add_argument('--resume',
+                        required=False,
+                        dest='in_resume',
+                        action='store_true',
+                        help='Download every submitted job whose results were not downloaded yet e.g. because the client was stopped')
+
+    groupF.add_argument('--list-jobs',
+                        required=False,
+                        dest='in_listjobs',
+                        action='store_true',
+                        help='Display every submitted job with its state and download link expiry')
+
+    groupF.add_argument('--journal-db',
+                        required=False,
+                        dest='in_journaldb',
+                        default=str(LOCAL_JOURNAL_DB),
+                        metavar='<path>',
+                        help=f'Location of the local job journal. Default: {LOCAL_JOURNAL_DB}')
+
+    groupG = parser.add_argument_group("Incremental Recrawl")
+    groupG.add_argument('--rebuild',
+                        required=False,
+                        dest='in_rebuild',
+                        metavar='<job tar.gz or manifest.json.gz>',
+                        help='Rebuild the full downloaded tree of an incremental job or, from its manifest.json.gz, of a sharded job. The archives of the jobs it was built on must be in the same directory.')
+
+    groupG.add_argument('--rebuild-dir',
+                        required=False,
+                        dest='in_rebuilddir',
+                        metavar='<path>',
+                        help='Use with --rebuild. Directory to create. Default: <jobid>-<region>-full')
+
     args = parser.parse_args()
 
     if args.in_downloadtype and not args.in_awsregion:
@@ -542,41 +1647,94 @@ Examples:\n\
     if args.in_downloadtype == "recursive" and not args.in_recursivelevel:
         parser.error("Download type rescursive requires --recursivelevel")
 
+    if (args.in_maxsize or args.in_maxfiles or args.in_maxtime) and not args.in_downloadtype:
+        parser.error("--maxsize, --maxfiles and --maxtime must be used with --type")
+
+    if args.in_autoregions and args.in_awsregion != "auto" and not args.in_hedge:
+        parser.error("--auto-regions requires --awsregion auto or --hedge")
+
+    if args.in_hedge is not None and (args.in_hedge < 2 or not args.in_downloadtype or args.in_awsregion == "all-regions" or args.in_incremental):
+        parser.error("--hedge must be at least 2 and used with --type and --awsregion auto or a region. It cannot be used with --incremental.")
+
+    if args.in_hedgeafter < 1:
+        parser.error("--hedge-after must be at least 1 second")
+
+    if args.in_autoregions and any(not get_api_info(region_name=region)[0] for region in args.in_autoregions):
+        parser.error("--auto-regions must only list enabled regions. See --regionoptions for enabled regions.")
+
+    if args.in_incremental and (not args.in_downloadtype or args.in_awsregion in ("all-regions", "auto")):
+        parser.error("--incremental must be used with --type and the --awsregion of the earlier job")
+
+    if args.in_shards and (args.in_downloadtype != "recursive" or args.in_engine != "crawler" or args.in_incremental):
+        parser.error("--shards requires --type recursive and --engine crawler and cannot be used with --incremental")
+
+    if args.in_rebuilddir and not args.in_rebuild:
+        parser.error("--rebuild-dir requires --rebuild")
+
     if args.in_status and not args.in_awsregion:
         parser.error("Status requires --awsregion")
 
     if args.in_useragentoptions and not args.in_awsregion:
         parser.error("User agent options requires --awsregion")
 
-    if not args.in_downloadtype and not args.in_useragentoptions and not args.in_status and not args.in_awsregion and not args.in_regionoptions:
+    if args.in_jobstatus and (not args.in_awsregion or args.in_awsregion in ("all-regions", "auto")):
+        parser.error("Job status requires the --awsregion the job was submitted to")
+
+    if args.in_follow and not args.in_jobstatus:
+        parser.error("--follow requires --job-status")
+
+    if (args.in_ip or args.in_sni or args.in_host or args.in_since or args.in_until) and not args.in_queryconnections:
+        parser.error("--ip, --sni, --host, --since and --until require --query-connections")
+
+    if not args.in_downloadtype and not args.in_useragentoptions and not args.in_status and not args.in_jobstatus and not args.in_awsregion and not args.in_regionoptions and not args.in_queryconnections and not args.in_index and not args.in_search and not args.in_diff and not args.in_timing and not args.in_resume and not args.in_listjobs and not args.in_rebuild:
         parser.error("Improper combination of options.")
 
     if args.in_awsregion:
         api_info = get_api_info(region_name=args.in_awsregion)
-        if api_info[0] == False and not args.in_awsregion == "all-regions": # True if api is enabled for the region provided by the user
+        if api_info[0] == False and not args.in_awsregion in ("all-regions", "auto"): # True if api is enabled for the region provided by the user
             parser.error("Provided AWS Region is not enabled. See --regionoptions for enabled regions.")
 
     # Submit Download Job
     if args.in_downloadtype and args.in_awsregion and args.in_url and args.in_useragent and args.in_ipversion:
+        quotas = {'input_maxbytes': args.in_maxsize << 20 if args.in_maxsize else None,
+                  'input_maxfiles': args.in_maxfiles,
+                  'input_maxseconds': args.in_maxtime,
+                  'input_engine': args.in_engine,
+                  'input_basejob': args.in_incremental,
+                  'input_shards': args.in_shards}
+        parameters = {'url': args.in_url, 'useragent': args.in_useragent, 'recursivelevel': args.in_recursivelevel, 'ipversion': args.in_ipversion, 'type': args.in_downloadtype, **quotas}
         if args.in_awsregion == "all-regions":
-            download_urls_list = [] # holds list of all pre-signed URLs that need to be downloaded
-            for item in available_apis(): # kick off download jobs for each region
-                for region, data in item.items():
-                    print(f'Submitting job for {region}')
-                    job_file_url, job_filename = submit_website_download_job(apikey=data['key'], apiurl=data['url'], input_url=args.in_url, input_useragent=args.in_useragent, input_recursivelevel=args.in_recursivelevel, input_forceipver=args.in_ipversion, input_wgetmode=args.in_downloadtype)
-                    if job_file_url and job_filename: # Download file
-                        download_urls_list.append((job_file_url, job_filename)) # add touple to list
-            # Download files
-            for url, filename in download_urls_list:
-                download_file(signed_url=url, output_filename=filename)
+            targets = [(region, data['key'], data['url']) for item in available_apis() for region, data in item.items()]
+        elif args.in_awsregion == "auto" and not args.in_hedge:
+            targets = rank_regions(args.in_journaldb, allowed=args.in_autoregions)[:1]
+            if not targets:
+                print("Error: No region reported its load. Choose a region with --awsregion.")
+            else:
+                print(f'Submitting job for {targets[0][0]}')
         else:
-            job_file_url, job_filename = submit_website_download_job(apikey=api_info[1], apiurl=api_info[2], input_url=args.in_url, input_useragent=args.in_useragent, input_recursivelevel=args.in_recursivelevel, input_forceipver=args.in_ipversion, input_wgetmode=args.in_downloadtype)
-            if job_file_url and job_filename: # Download file
-                download_file(signed_url=job_file_url, output_filename=job_filename)
+            targets = [(api_info[3], api_info[1], api_info[2])]
+        submitted = [] # journal entries to download
+        if args.in_hedge:
+            submitted = hedged_submission(args.in_journaldb, parameters, dict(input_url=args.in_url, input_useragent=args.in_useragent, input_recursivelevel=args.in_recursivelevel, input_forceipver=args.in_ipversion, input_wgetmode=args.in_downloadtype, **quotas),
+                                          first_region=None if args.in_awsregion == "auto" else args.in_awsregion, allowed=args.in_autoregions,
+                                          hedge=args.in_hedge, hedge_after=args.in_hedgeafter)
+            targets = [] # submitted already
+        for region, apikey, apiurl in targets: # kick off download jobs for each region
+            if len(targets) > 1:
+                print(f'Submitting job for {region}')
+            job_file_url, job_filename, proxylog_url, job_id = submit_website_download_job(apikey=apikey, apiurl=apiurl, input_url=args.in_url, input_useragent=args.in_useragent, input_recursivelevel=args.in_recursivelevel, input_forceipver=args.in_ipversion, input_wgetmode=args.in_downloadtype, **quotas)
+            if job_file_url and job_filename: # journaled first so the download survives the client being stopped
+                journal_submission(args.in_journaldb, region, parameters, job_file_url, job_filename, proxylog_url, job_id)
+                submitted.append(job_filename)
+        # Download files
+        download_journal_entries(args.in_journaldb, filenames=submitted)
+        if len(submitted) > 1:
+            print(f"* Compare the regions with: --diff {' '.join(submitted)}")
+            print(f"* Compare their network timings with: --timing {' '.join(submitted)}")
 
     # UA options
     if args.in_useragentoptions and args.in_awsregion:
-        if args.in_awsregion == "all-regions":
+        if args.in_awsregion in ("all-regions", "auto"):
             for item in available_apis():
                 for region, data in item.items():
                     display_useragent_options(apikey=data['key'], apiurl=data['url'], apiregion=region)
@@ -589,9 +1747,20 @@ Examples:\n\
             for item in available_apis():
                 for region, data in item.items():
                     sqs_autoscaling_stats(apikey=data['key'], apiurl=data['url'], apiregion=region)
+        elif args.in_awsregion == "auto": # the ranking a submission would use
+            rank_regions(args.in_journaldb, allowed=args.in_autoregions)
         else:
             sqs_autoscaling_stats(apikey=api_info[1], apiurl=api_info[2], apiregion=api_info[3])
 
+    # Get Job Status
+    if args.in_jobstatus and args.in_awsregion:
+        if args.in_follow:
+            wait_for_job(apikey=api_info[1], apiurl=api_info[2], job_id=args.in_jobstatus)
+        else:
+            job_status = get_job_status(apikey=api_info[1], apiurl=api_info[2], job_id=args.in_jobstatus)
+            if job_status:
+                print_job_status(job_status)
+
     # Show enabled AWS Regions
     if args.in_regionoptions:
         print("{:20s} {:30s} {:20s}".format("Region Name", "AWS Region", "Status"))
@@ -600,5 +1769,33 @@ Examples:\n\
                 if data['key'] and data['url']:
                     print("{:20s} {:30s} {:20s}".format(region, data['name'], "API Enabled"))
 
+    # Query connection summaries of downloaded jobs
+    if args.in_queryconnections:
+        query_connections(paths=args.in_queryconnections, ip=args.in_ip, sni=args.in_sni, host=args.in_host, since=args.in_since, until=args.in_until)
+
+    # Local analytics index
+    if args.in_index:
+        index_archives(paths=args.in_index, db_path=args.in_indexdb)
+
+    if args.in_search:
+        search_index(value=args.in_search, db_path=args.in_indexdb)
+
+    if args.in_diff:
+        diff_archives(paths=args.in_diff)
+
+    if args.in_timing:
+        compare_timings(paths=args.in_timing)
+
+    # Local job journal
+    if args.in_listjobs:
+        list_journal(db_path=args.in_journaldb)
+
+    if args.in_resume:
+        download_journal_entries(db_path=args.in_journaldb)
+
+    # Incremental recrawl
+    if args.in_rebuild:
+        rebuild_job_tree(archive_path=args.in_rebuild, output_dir=args.in_rebuilddir)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,610 @@
+#!/usr/bin/python3
+# Built in Python 3.8
+__author__ = "Kemp Langhorne"
+__copyright__ = "Copyright (C) 2021 AskKemp.com"
+__license__ = "agpl-3.0"
+
+# Concurrent asyncio crawler used by server_application.py as an alternative to Wget.
+# It must run as user proxy_client so that iptables sends its traffic through SSLsplit.
+# Only the Python standard library is used as it runs outside of the application's environment.
+#
+# Output mimics Wget so the archive format and the log handling of server_application.py stay the same:
+#   * files are saved in the same layout as Wget --force-directories under --directory-prefix
+#   * stdout has the Wget lines "Saving to:", "saved", "FINISHED" and "Downloaded:"
+#   * the exit code follows the Wget exit codes
+#
+# Shards of a sharded recursive job share the set of crawled URLs through --claim-url, a service of the worker on
+# localhost. The coordinator of such a job writes the links it did not follow with --frontier.
+
+import argparse
+import asyncio
+import datetime
+import email.utils # conditional request dates
+import errno
+import html.parser
+import json
+import os
+import re
+import signal
+import socket
+import ssl
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit, unquote
+
+MAX_REDIRECTS = 20 # same as Wget
+REQUEST_TIMEOUT = 60 # seconds without progress before a request is given up
+PARSE_MAX_BYTES = 10 << 20 # HTML and CSS larger than this are saved but not parsed for links
+CHUNK_SIZE = 1 << 16
+
+# Wget exit codes. With the exception of 0 the lower number takes precedence.
+EXIT_OK = 0
+EXIT_IO = 3
+EXIT_NETWORK = 4
+EXIT_SERVER = 8
+
+# HTML attributes that reference page requisites (Wget --page-requisites)
+REQUISITE_ATTRIBUTES = {
+    'img': ('src', 'srcset', 'lowsrc'),
+    'script': ('src',),
+    'link': ('href',), # filtered on rel below
+    'source': ('src', 'srcset'),
+    'video': ('src', 'poster'),
+    'audio': ('src',),
+    'track': ('src',),
+    'embed': ('src',),
+    'object': ('data',),
+    'input': ('src',),
+    'iframe': ('src',),
+    'frame': ('src',),
+    'body': ('background',),
+    'table': ('background',),
+    'td': ('background',),
+}
+# HTML attributes that reference other documents which are only followed by recursive mode
+LINK_ATTRIBUTES = {
+    'a': ('href',),
+    'area': ('href',),
+    'link': ('href',),
+}
+REQUISITE_LINK_REL = ('stylesheet', 'icon', 'shortcut', 'apple-touch-icon', 'preload', 'manifest', 'mask-icon')
+CSS_URL_RE = re.compile(r'''url\(\s*['"]?([^'")\s]+)['"]?\s*\)|@import\s+['"]([^'"]+)['"]''', re.IGNORECASE)
+
+
+def timestamp():
+    """Wget style time stamp"""
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def out(line):
+    """Writes a line to stdout right away so server_application.py sees progress in real-time"""
+    print(line, flush=True)
+
+def local_path(prefix, url):
+    """
+    Translates a URL into the file name Wget --force-directories would use.
+    e.g. https://www.google.com/images/a.png?x=1 -> <prefix>/www.google.com/images/a.png?x=1
+
+    Args:
+        prefix (str): --directory-prefix
+        url (str): absolute URL
+    Returns:
+        pathlib.Path
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    default_port = 443 if parts.scheme == 'https' else 80
+    if parts.port and parts.port != default_port:
+        host = f'{host}:{parts.port}'
+
+    segments = [unquote(segment) for segment in parts.path.split('/')]
+    segments = [segment.replace('/', '%2F') for segment in segments if segment not in ('', '.', '..')] # no escaping the prefix
+    if not segments or parts.path.endswith('/'):
+        segments.append('index.html')
+    if parts.query:
+        segments[-1] = segments[-1] + '?' + parts.query
+    return Path(prefix, host, *segments)
+
+def normalize_url(base, reference):
+    """
+    Resolves a reference found in a document against its URL.
+
+    Returns:
+        str absolute http(s) URL without fragment or None when the reference is not crawlable
+    """
+    reference = reference.strip()
+    if not reference or reference.startswith(('data:', 'javascript:', 'mailto:', 'tel:', '#')):
+        return None
+    url = urljoin(base, reference).split('#', 1)[0]
+    if urlsplit(url).scheme not in ('http', 'https'):
+        return None
+    return url
+
+
+class LinkExtractor(html.parser.HTMLParser):
+    """Collects requisite and link references from an HTML document"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.requisites = []
+        self.links = []
+        self.base = None
+        self._in_style = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'base' and attrs.get('href'):
+            self.base = attrs['href']
+        if tag == 'style':
+            self._in_style = True
+        if attrs.get('style'):
+            self.requisites.extend(css_references(attrs['style']))
+
+        rel = (attrs.get('rel') or '').lower().split()
+        for attribute in REQUISITE_ATTRIBUTES.get(tag, ()):
+            value = attrs.get(attribute)
+            if not value:
+                continue
+            if tag == 'link' and not any(r in REQUISITE_LINK_REL for r in rel):
+                continue
+            if attribute.endswith('srcset'):
+                self.requisites.extend(candidate.split()[0] for candidate in value.split(',') if candidate.strip())
+            else:
+                self.requisites.append(value)
+
+        for attribute in LINK_ATTRIBUTES.get(tag, ()):
+            if attrs.get(attribute):
+                self.links.append(attrs[attribute])
+
+    def handle_endtag(self, tag):
+        if tag == 'style':
+            self._in_style = False
+
+    def handle_data(self, data):
+        if self._in_style:
+            self.requisites.extend(css_references(data))
+
+def css_references(text):
+    """Returns the url() and @import references of CSS text"""
+    return [match.group(1) or match.group(2) for match in CSS_URL_RE.finditer(text)]
+
+
+class ConnectionPool:
+    """
+    HTTP/1.1 keep-alive connections shared by all crawl tasks.
+    Connections are limited per host (scheme, host, port) and idle ones are reused.
+    """
+
+    def __init__(self, per_host, family, user_agent):
+        self.per_host = per_host
+        self.family = family
+        self.user_agent = user_agent
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False # same as Wget --no-check-certificate
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self._idle = {}
+        self._limits = {}
+
+    def _key(self, url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return await asyncio.open_connection(host, port, ssl=self.ssl_context, server_hostname=host, family=self.family)
+        return await asyncio.open_connection(host, port, family=self.family)
+
+    def close(self):
+        for connections in self._idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    async def get(self, url, save_path=None, extra_headers=None):
+        """
+        GET a URL. A 200 response body is streamed to save_path. Any other body is discarded.
+
+        Args:
+            url (str): absolute URL
+            save_path (pathlib.Path): where to save a successful response
+            extra_headers (dict): additional request headers e.g. If-Modified-Since
+        Returns:
+            tuple (status int, headers dict with lower case keys, int bytes saved)
+        """
+        key = self._key(url)
+        limit = self._limits.setdefault(key, asyncio.Semaphore(self.per_host))
+        async with limit:
+            reused = bool(self._idle.get(key))
+            try:
+                return await self._request(key, url, save_path, extra_headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused: # a reused keep-alive connection may have been closed by the server. Retry once.
+                    raise
+                return await self._request(key, url, save_path, extra_headers)
+
+    async def _request(self, key, url, save_path, extra_headers=None):
+        idle = self._idle.setdefault(key, [])
+        reader, writer = idle.pop() if idle else await self._connect(key)
+        parts = urlsplit(url)
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        host_header = parts.netloc.rsplit('@', 1)[-1]
+
+        request = (f"GET {target} HTTP/1.1\r\n"
+                   f"Host: {host_header}\r\n"
+                   f"User-Agent: {self.user_agent}\r\n"
+                   "Accept: */*\r\n"
+                   "Accept-Encoding: identity\r\n"
+                   + "".join(f"{name}: {value}\r\n" for name, value in (extra_headers or {}).items()) +
+                   "Connection: Keep-Alive\r\n\r\n")
+        try:
+            writer.write(request.encode('latin-1', errors='replace'))
+            await writer.drain()
+
+            status_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            if not status_line:
+                raise ConnectionError("Connection closed before response")
+            version, status = status_line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+            sink = None
+            if status == 200 and save_path is not None:
+                sink = open_for_saving(save_path)
+            try:
+                saved, clean_end = await read_body(reader, headers, status, sink)
+            except BaseException:
+                if sink: # an incomplete file would be kept by a --no-clobber run
+                    sink.close()
+                    Path(sink.name).unlink(missing_ok=True)
+                raise
+            finally:
+                if sink:
+                    sink.close()
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive and clean_end:
+            self._idle[key].append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, saved
+
+def open_for_saving(save_path):
+    """Opens the file a response is saved to. A directory with the same name gets an index.html inside like Wget."""
+    if save_path.is_dir():
+        save_path = save_path / 'index.html'
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    return open(save_path, 'wb')
+
+async def read_body(reader, headers, status, sink):
+    """
+    Reads a response body writing it to sink when provided.
+
+    Returns:
+        tuple (bytes read, bool connection can be reused)
+    """
+    if status in (204, 304) or 100 <= status < 200:
+        return 0, True
+
+    total = 0
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)) not in (b'\r\n', b'\n', b''): # trailers
+                    pass
+                return total, True
+            remaining = size
+            while remaining:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, CHUNK_SIZE)), REQUEST_TIMEOUT)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(chunk)
+                total += len(chunk)
+                if sink:
+                    sink.write(chunk)
+            await reader.readline() # CRLF after each chunk
+
+    if 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining:
+            chunk = await asyncio.wait_for(reader.read(min(remaining, CHUNK_SIZE)), REQUEST_TIMEOUT)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            total += len(chunk)
+            if sink:
+                sink.write(chunk)
+        return total, True
+
+    # Body ends when the server closes the connection
+    while True:
+        chunk = await asyncio.wait_for(reader.read(CHUNK_SIZE), REQUEST_TIMEOUT)
+        if not chunk:
+            return total, False
+        total += len(chunk)
+        if sink:
+            sink.write(chunk)
+
+
+class Crawler:
+    """
+    Frontier of URLs crawled by a fixed number of tasks.
+
+    singlepage: the URL and all of its requisites on any host (Wget --page-requisites --span-hosts)
+    recursive:  links and requisites on the host of the URL up to level deep (Wget --recursive --level)
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.start_host = urlsplit(args.seeds[0]).hostname
+        family = socket.AF_INET if args.ipversion == 'ipv4' else socket.AF_INET6 if args.ipversion == 'ipv6' else socket.AF_UNSPEC
+        self.pool = ConnectionPool(args.per_host, family, args.user_agent)
+        self.seen = set()
+        self.queue = None
+        self.workers = []
+        self.exit_code = EXIT_OK
+        self.files = 0
+        self.bytes = 0
+        self.stopping = False
+        self.frontier = {} # recursive mode URLs beyond --level. Ordered set.
+        self.validators = {} # path within --directory-prefix -> ETag for --timestamping
+        if args.validators and Path(args.validators).is_file():
+            with open(args.validators) as validators_f:
+                self.validators = json.load(validators_f)
+
+    def set_exit_code(self, code):
+        if self.exit_code == EXIT_OK or code < self.exit_code:
+            self.exit_code = code
+
+    def enqueue(self, url, depth, requisite):
+        if url in self.seen or self.stopping:
+            return
+        if self.args.mode == 'recursive':
+            if urlsplit(url).hostname != self.start_host:
+                return
+            if depth > self.args.level:
+                self.frontier[url] = None
+                return
+        elif not requisite: # singlepage does not follow links
+            return
+        self.seen.add(url)
+        self.queue.put_nowait((url, depth))
+
+    def conditional_headers(self, save_path):
+        """
+        Request headers of Wget --timestamping for a file that was downloaded before.
+        The file time is the Last-Modified of the earlier download and the ETag comes from --validators.
+
+        Returns:
+            tuple (pathlib.Path of the existing file or None, dict of headers)
+        """
+        existing = save_path / 'index.html' if save_path.is_dir() else save_path
+        if not self.args.timestamping or not existing.is_file():
+            return None, {}
+        headers = {'If-Modified-Since': email.utils.formatdate(existing.stat().st_mtime, usegmt=True)}
+        etag = self.validators.get(existing.relative_to(self.args.directory_prefix).as_posix())
+        if etag:
+            headers['If-None-Match'] = etag
+        return existing, headers
+
+    async def fetch(self, url, depth):
+        save_path = local_path(self.args.directory_prefix, url)
+        location = url
+        started = time.monotonic()
+        out(f"--{timestamp()}--  {url}")
+        existing, conditional = self.conditional_headers(save_path)
+        kept = save_path / 'index.html' if save_path.is_dir() else save_path
+
+        if self.args.no_clobber and kept.is_file(): # kept from an earlier run. Parsed for links like Wget does.
+            out(f"File '{kept}' already there; not retrieving.")
+            status, headers, saved = None, {}, kept.stat().st_size
+            save_path = kept
+        else:
+            for _ in range(MAX_REDIRECTS + 1):
+                try:
+                    status, headers, saved = await self.pool.get(location, save_path, conditional)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                    out(f"Unable to fetch {location}: {e!r}")
+                    self.set_exit_code(EXIT_IO if getattr(e, 'errno', None) in (errno.ENOSPC, errno.EDQUOT) else EXIT_NETWORK) # a full workspace is moved to disk by the worker
+                    return
+                if 300 <= status < 400 and headers.get('location'):
+                    location = urljoin(location, headers['location'])
+                    out(f"Location: {location} [following]")
+                    continue
+                break
+
+        if status is None: # kept by --no-clobber
+            pass
+        elif status == 304 and existing: # unchanged. The earlier copy is still parsed for links like Wget does.
+            out(f"File '{existing}' not modified on server. Omitting download.")
+            save_path, saved = existing, existing.stat().st_size
+        elif status != 200:
+            out(f"{timestamp()} ERROR {status}.")
+            self.set_exit_code(EXIT_SERVER)
+            return
+        else:
+            if save_path.is_dir():
+                save_path = save_path / 'index.html'
+            elapsed = max(time.monotonic() - started, 0.001)
+            self.remember_validators(save_path, headers) # before "saved" like Wget. The file is final once it is reported.
+            out(f"Saving to: '{save_path}'")
+            out(f"{timestamp()} ({saved / elapsed / 1024:.2f} KB/s) - '{save_path}' saved [{saved}]")
+            self.files += 1
+            self.bytes += saved
+
+        content_type = headers.get('content-type', '').lower()
+        if saved > PARSE_MAX_BYTES:
+            return
+        if 'html' in content_type or save_path.suffix in ('.html', '.htm'):
+            extractor = LinkExtractor()
+            try:
+                extractor.feed(save_path.read_text(errors='replace'))
+            except Exception as e:
+                out(f"Unable to parse {location}: {e!r}")
+                return
+            base = urljoin(location, extractor.base) if extractor.base else location
+            for reference in extractor.requisites:
+                next_url = normalize_url(base, reference)
+                if next_url:
+                    self.enqueue(next_url, depth + 1, requisite=True)
+            for reference in extractor.links:
+                next_url = normalize_url(base, reference)
+                if next_url:
+                    self.enqueue(next_url, depth + 1, requisite=False)
+        elif 'css' in content_type or save_path.suffix == '.css':
+            for reference in css_references(save_path.read_text(errors='replace')):
+                next_url = normalize_url(location, reference)
+                if next_url:
+                    self.enqueue(next_url, depth + 1, requisite=True)
+
+    def remember_validators(self, save_path, headers):
+        """Keeps what a later --timestamping crawl sends: Last-Modified as the file time (like Wget) and the ETag"""
+        try:
+            modified = email.utils.parsedate_to_datetime(headers['last-modified']).timestamp() if headers.get('last-modified') else None
+        except (TypeError, ValueError):
+            modified = None
+        if modified:
+            os.utime(save_path, (modified, modified))
+        name = save_path.relative_to(self.args.directory_prefix).as_posix()
+        if headers.get('etag'):
+            self.validators[name] = headers['etag']
+        else:
+            self.validators.pop(name, None)
+
+    async def claim(self, url):
+        """
+        Asks the --claim-url service whether this crawler is the first shard to crawl url.
+        The URL is crawled anyway when the service cannot be reached as a duplicate is better than a gap.
+
+        Returns:
+            bool
+        """
+        parts = urlsplit(self.args.claim_url)
+        body = url.encode('utf-8')
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(parts.hostname, parts.port or 80), REQUEST_TIMEOUT)
+            try:
+                writer.write(f"POST {parts.path or '/'} HTTP/1.0\r\nHost: {parts.netloc}\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            finally:
+                writer.close()
+            if status_line.split()[1] == b'409':
+                out(f"{url} is crawled by another shard. Skipping.")
+                return False
+            return True
+        except (OSError, asyncio.TimeoutError, IndexError) as e:
+            out(f"Unable to claim {url}: {e!r}")
+            return True
+
+    async def worker(self):
+        while True:
+            url, depth = await self.queue.get()
+            try:
+                if not self.stopping and (not self.args.claim_url or await self.claim(url)):
+                    await self.fetch(url, depth)
+            except OSError as e:
+                out(f"Unable to save {url}: {e!r}")
+                self.set_exit_code(EXIT_IO)
+            finally:
+                self.queue.task_done()
+
+    def stop(self):
+        """
+        SIGTERM/SIGINT handler. The first signal drops the rest of the frontier and lets running requests end.
+        A second signal also cancels the running requests.
+        """
+        if self.stopping:
+            out(f"{timestamp()} Stop requested again. Cancelling running requests.")
+            for task in self.workers:
+                task.cancel()
+            return
+        out(f"{timestamp()} Stop requested. Finishing running requests.")
+        self.stopping = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+
+        started = time.monotonic()
+        for url in self.args.seeds:
+            if url not in self.seen:
+                self.seen.add(url)
+                self.queue.put_nowait((url, 0))
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.args.concurrency)]
+        await self.queue.join()
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.pool.close()
+        if self.args.validators:
+            try:
+                with open(self.args.validators, 'w') as validators_f:
+                    json.dump(self.validators, validators_f)
+            except OSError as e:
+                out(f"Unable to save {self.args.validators}: {e!r}")
+                self.set_exit_code(EXIT_IO)
+        if self.args.frontier:
+            try:
+                with open(self.args.frontier, 'w') as frontier_f:
+                    json.dump([url for url in self.frontier if url not in self.seen], frontier_f)
+            except OSError as e:
+                out(f"Unable to save {self.args.frontier}: {e!r}")
+                self.set_exit_code(EXIT_IO)
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        out(f"FINISHED --{timestamp()}--")
+        out(f"Total wall clock time: {elapsed:.1f}s")
+        out(f"Downloaded: {self.files} files, {self.bytes / 1048576:.1f}M in {elapsed:.1f}s ({self.bytes / elapsed / 1048576:.2f} MB/s)")
+        return self.exit_code
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent website crawler with Wget compatible output. Run as proxy_client.')
+    parser.add_argument('--mode', required=True, choices=['singlepage', 'recursive'], help='singlepage downloads the page requisites. recursive follows links on the same host.')
+    parser.add_argument('--level', type=int, default=5, help='Recursion depth of recursive mode')
+    parser.add_argument('--ipversion', choices=['ipv4', 'ipv6'], help='Only connect to IPv4 or IPv6 addresses')
+    parser.add_argument('--user-agent', required=True, help='User-Agent header')
+    parser.add_argument('--directory-prefix', required=True, help='Location to save files')
+    parser.add_argument('--concurrency', type=int, default=32, help='Requests in flight across all hosts')
+    parser.add_argument('--per-host', type=int, default=6, help='Connections per host')
+    parser.add_argument('--timestamping', action='store_true', help='Only download files that changed since the copy already in --directory-prefix (Wget --timestamping)')
+    parser.add_argument('--no-clobber', action='store_true', help='Keep files already in --directory-prefix and only parse them for links (Wget --no-clobber)')
+    parser.add_argument('--validators', help='JSON file of ETags of the files in --directory-prefix. Read before and written after the crawl.')
+    parser.add_argument('--input-file', help='File of URLs to crawl, one per line, in addition to the url arguments (Wget --input-file). All must be on one host in recursive mode.')
+    parser.add_argument('--frontier', help='Recursive mode: JSON file the links beyond --level are written to')
+    parser.add_argument('--claim-url', help='http://127.0.0.1:<port>/<path> of the service a URL is claimed at before it is crawled. A 409 reply means another shard crawls it.')
+    parser.add_argument('url', nargs='*', help='URL to crawl')
+    args = parser.parse_args()
+
+    args.seeds = list(args.url)
+    if args.input_file:
+        with open(args.input_file) as input_f:
+            args.seeds.extend(line.strip() for line in input_f if line.strip())
+    if not args.seeds:
+        parser.error("a url or --input-file is required")
+    if args.level < 0:
+        parser.error("--level must be 0 or more")
+    if args.no_clobber and args.timestamping:
+        parser.error("--no-clobber and --timestamping cannot be used together")
+
+    sys.exit(asyncio.run(Crawler(args).run()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+# Built in Python 3.8
+__author__ = "Kemp Langhorne"
+__copyright__ = "Copyright (C) 2021 AskKemp.com"
+__license__ = "agpl-3.0"
+
+# Caching and recording DNS stub resolver for the crawl of a job.
+# server_install.sh redirects the DNS queries of proxy_client to it with iptables so Wget and crawler.py
+# are answered from a cache and every query and its answer is written to dns.jsonl in the job archive.
+# Used by server_application.py so only the Python standard library may be used here.
+
+import json
+import random
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DNS_RECORD_NAME = "dns.jsonl" # name inside the job archive
+UPSTREAM_TIMEOUT = 2 # seconds to wait for the upstream resolver per try
+UPSTREAM_TRIES = 2 # UDP is retried once before the query is answered with SERVFAIL
+CACHE_MAX_TTL = 300 # seconds an answer is cached at most. Jobs are short and names of CDNs change often.
+CACHE_NEGATIVE_TTL = 30 # seconds NXDOMAIN and empty answers are cached
+PREFETCH_MAX_HOSTS = 50 # hosts of the first page resolved ahead of the crawl
+PREFETCH_MAX_BYTES = 1 << 20 # read of the first page for its hosts
+PREFETCH_CONCURRENCY = 8 # prefetch queries in flight
+VPC_RESOLVER = "169.254.169.253" # Amazon provided DNS. Used when /etc/resolv.conf has no nameserver.
+
+TYPE_NAMES = {1: 'A', 2: 'NS', 5: 'CNAME', 6: 'SOA', 12: 'PTR', 15: 'MX', 16: 'TXT', 28: 'AAAA', 33: 'SRV', 65: 'HTTPS'}
+RCODE_NAMES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+TYPE_A = 1
+TYPE_AAAA = 28
+# Address type answered empty for each forced IP version so names only resolve to the addresses the job may connect to
+FORCED_EMPTY_TYPE = {'ipv4': TYPE_AAAA, 'ipv6': TYPE_A}
+
+_HOST_RE = re.compile(r'''(?:https?:)?//([A-Za-z0-9](?:[A-Za-z0-9.-]{0,251}[A-Za-z0-9])?)(?=[:/"'\s?#)]|$)''')
+
+
+#
+# DNS messages (RFC 1035)
+#
+def read_name(message, offset):
+    """
+    Reads a possibly compressed domain name
+
+    Args:
+        message (bytes): DNS message
+        offset (int): start of the name
+    Returns:
+        tuple of the name (str, lower case without trailing dot) and the offset after it
+    Raises:
+        ValueError: when the name runs past the message or loops
+    """
+    labels = []
+    end = None
+    for _ in range(128): # a name has at most 127 labels. More means a pointer loop.
+        if offset >= len(message):
+            raise ValueError("name past end of message")
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from("!H", message, offset)[0] & 0x3FFF
+        elif length == 0:
+            return ".".join(labels).lower(), end if end is not None else offset + 1
+        else:
+            labels.append(message[offset + 1:offset + 1 + length].decode('ascii', errors='replace'))
+            offset += 1 + length
+    raise ValueError("name compression loop")
+
+
+def parse_question(message):
+    """
+    Reads the header and first question of a query
+
+    Args:
+        message (bytes): DNS query
+    Returns:
+        tuple of id, flags, name, type, class and the offset after the question
+    Raises:
+        ValueError: when the message is not a query with a question
+    """
+    if len(message) < 12:
+        raise ValueError("message shorter than header")
+    query_id, flags, questions = struct.unpack_from("!HHH", message)
+    if flags & 0x8000 or questions < 1:
+        raise ValueError("not a query")
+    name, offset = read_name(message, 12)
+    qtype, qclass = struct.unpack_from("!HH", message, offset)
+    return query_id, flags, name, qtype, qclass, offset + 4
+
+
+def parse_answers(message):
+    """
+    Reads the rcode and the answer section of a response
+
+    Args:
+        message (bytes): DNS response
+    Returns:
+        tuple of the rcode (int) and a list of dicts with name, type, ttl and data. data is the address of A and
+        AAAA, the target of CNAME and the rdata length of other types.
+    Raises:
+        ValueError: when the message is malformed
+    """
+    if len(message) < 12:
+        raise ValueError("message shorter than header")
+    flags, questions, answer_count = struct.unpack_from("!HHH", message, 2)
+    offset = 12
+    for _ in range(questions):
+        offset = read_name(message, offset)[1] + 4
+    answers = []
+    for _ in range(answer_count):
+        name, offset = read_name(message, offset)
+        rtype, rclass, ttl, length = struct.unpack_from("!HHIH", message, offset)
+        offset += 10
+        rdata = message[offset:offset + length]
+        if rtype == TYPE_A and length == 4:
+            data = socket.inet_ntop(socket.AF_INET, rdata)
+        elif rtype == TYPE_AAAA and length == 16:
+            data = socket.inet_ntop(socket.AF_INET6, rdata)
+        elif rtype == 5:
+            data = read_name(message, offset)[0]
+        else:
+            data = f"{length} bytes"
+        answers.append({'name': name, 'type': TYPE_NAMES.get(rtype, str(rtype)), 'ttl': ttl, 'data': data})
+        offset += length
+    return flags & 0x000F, answers
+
+
+def build_query(name, qtype):
+    """Encodes a recursive query for one name and type"""
+    labels = b"".join(bytes([len(label)]) + label.encode('ascii') for label in name.strip(".").split(".") if label)
+    return struct.pack("!HHHHHH", random.getrandbits(16), 0x0100, 1, 0, 0, 0) + labels + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+def build_empty_response(query, question_end, rcode=0, truncated=False):
+    """
+    Answers a query without records. NOERROR without records is the NODATA answer of a name that has no records of the type.
+
+    Args:
+        query (bytes): DNS query
+        question_end (int): offset after the first question
+        rcode (int): response code. SERVFAIL is 2.
+        truncated (bool): sets TC so the client asks again over TCP
+    Returns:
+        bytes of the response
+    """
+    query_id, flags = struct.unpack_from("!HH", query)
+    flags = 0x8000 | (flags & 0x0100) | 0x0080 | rcode # response, recursion desired copied, recursion available
+    if truncated:
+        flags |= 0x0200
+    return struct.pack("!HHHHHH", query_id, flags, 1, 0, 0, 0) + query[12:question_end]
+
+
+def has_edns(query):
+    """True when the query has an additional record i.e. an EDNS OPT record that allows UDP responses over 512 bytes"""
+    return len(query) >= 12 and struct.unpack_from("!H", query, 10)[0] > 0
+
+
+def upstream_nameserver(resolv_conf="/etc/resolv.conf"):
+    """First nameserver of resolv.conf or the Amazon provided DNS"""
+    try:
+        with open(resolv_conf) as resolv_f:
+            for line in resolv_f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except OSError:
+        pass
+    return VPC_RESOLVER
+
+
+def hosts_in_page(path, limit=PREFETCH_MAX_HOSTS):
+    """
+    Host names of the absolute and protocol relative URLs of a downloaded page in order of appearance
+
+    Args:
+        path (str): HTML or CSS file
+        limit (int): most hosts returned
+    Returns:
+        list of str
+    """
+    hosts = {}
+    try:
+        with open(path, errors='replace') as page_f:
+            text = page_f.read(PREFETCH_MAX_BYTES)
+    except OSError:
+        return []
+    for match in _HOST_RE.finditer(text):
+        host = match.group(1).lower()
+        if "." in host and not host.replace(".", "").isdigit():
+            hosts[host] = None
+            if len(hosts) >= limit:
+                break
+    return list(hosts)
+
+
+#
+# Resolver
+#
+class RecordingResolver:
+    """
+    Answers the DNS queries of the crawl from a cache filled by the upstream resolver. Queries for the address type of
+    the IP version the job does not use are answered empty. Every query is appended to the record file with its source:
+    upstream, cache, forced (answered empty), prefetch or error.
+    """
+
+    def __init__(self, record_path, force_ip_version=None, upstream=None, port=5353):
+        self.record_path = record_path
+        self.forced_empty_type = FORCED_EMPTY_TYPE.get(force_ip_version)
+        self.upstream = upstream or upstream_nameserver()
+        self.port = port
+        self.cache = {} # (name, type, class) -> (expires, response without id)
+        self.lock = threading.Lock()
+        self.stats = {'queries': 0, 'cache': 0, 'upstream': 0, 'forced': 0, 'prefetch': 0, 'error': 0}
+        self.servers = []
+
+    def start(self):
+        """
+        Serves UDP and TCP on localhost IPv4 and, when available, IPv6
+
+        Returns:
+            None
+        Raises:
+            OSError: when the IPv4 port cannot be bound
+        """
+        resolver = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                response = resolver.answer(data, "udp")
+                if response:
+                    if len(response) > 512 and not has_edns(data): # cached from TCP. The client asks again over TCP.
+                        response = build_empty_response(data, parse_question(data)[5], truncated=True)
+                    sock.sendto(response, self.client_address)
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.settimeout(UPSTREAM_TIMEOUT * UPSTREAM_TRIES)
+                try:
+                    while True:
+                        length = self.request.recv(2)
+                        if len(length) < 2:
+                            return
+                        data = recv_exactly(self.request, struct.unpack("!H", length)[0])
+                        response = resolver.answer(data, "tcp")
+                        if not response:
+                            return
+                        self.request.sendall(struct.pack("!H", len(response)) + response)
+                except OSError:
+                    return
+
+        class UDPServer(socketserver.ThreadingUDPServer):
+            daemon_threads = True
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True # not for UDP where it lets a second server bind the same port
+
+        class UDPServer6(UDPServer):
+            address_family = socket.AF_INET6
+
+        class TCPServer6(TCPServer):
+            address_family = socket.AF_INET6
+
+        for udp_class, tcp_class, host in ((UDPServer, TCPServer, "127.0.0.1"), (UDPServer6, TCPServer6, "::1")):
+            for server_class, handler in ((udp_class, UDPHandler), (tcp_class, TCPHandler)):
+                try:
+                    server = server_class((host, self.port), handler)
+                except OSError:
+                    if host == "::1": # IPv6 disabled on the host
+                        continue
+                    self.stop()
+                    raise
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                self.servers.append(server)
+
+    def stop(self):
+        """Stops serving"""
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def answer(self, query, transport, source=None):
+        """
+        Answers one query from the cache, empty when forced or from upstream and records it
+
+        Args:
+            query (bytes): DNS query
+            transport (str): udp or tcp
+            source (str): prefetch for queries of prefetch()
+        Returns:
+            bytes of the response or None for a message that is not a query
+        """
+        started = time.monotonic()
+        try:
+            query_id, flags, name, qtype, qclass, question_end = parse_question(query)
+        except (ValueError, struct.error):
+            return None
+        key = (name, qtype, qclass)
+        answers, response = None, None
+        if qtype == self.forced_empty_type:
+            response, source = build_empty_response(query, question_end), "forced"
+        else:
+            with self.lock:
+                cached = self.cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                response, source = struct.pack("!H", query_id) + cached[1], source or "cache"
+            else:
+                response = self.forward(query, transport)
+                if response:
+                    source = source or "upstream"
+                    try:
+                        rcode, answers = parse_answers(response)
+                    except (ValueError, struct.error):
+                        rcode, answers = None, None
+                    if rcode in (0, 3) and not struct.unpack_from("!H", response, 2)[0] & 0x0200: # not truncated
+                        ttl = min([answer['ttl'] for answer in answers] or [CACHE_NEGATIVE_TTL])
+                        with self.lock:
+                            self.cache[key] = (time.monotonic() + min(ttl, CACHE_MAX_TTL), response[2:])
+                else:
+                    response, source = build_empty_response(query, question_end, rcode=2), "error"
+        if answers is None:
+            try:
+                answers = parse_answers(response)[1]
+            except (ValueError, struct.error):
+                answers = []
+        self.record({'ts': round(time.time(), 3),
+                     'transport': transport,
+                     'name': name,
+                     'type': TYPE_NAMES.get(qtype, str(qtype)),
+                     'rcode': RCODE_NAMES.get(struct.unpack_from("!H", response, 2)[0] & 0x000F, "OTHER"),
+                     'answers': answers,
+                     'source': source,
+                     'ms': round((time.monotonic() - started) * 1000, 2)})
+        return response
+
+    def forward(self, query, transport):
+        """
+        Sends a query to the upstream resolver
+
+        Args:
+            query (bytes): DNS query
+            transport (str): udp or tcp
+        Returns:
+            bytes of the response or None when upstream did not answer
+        """
+        family = socket.AF_INET6 if ":" in self.upstream else socket.AF_INET
+        for _ in range(UPSTREAM_TRIES if transport == "udp" else 1):
+            try:
+                if transport == "tcp":
+                    with socket.create_connection((self.upstream, 53), timeout=UPSTREAM_TIMEOUT) as sock:
+                        sock.sendall(struct.pack("!H", len(query)) + query)
+                        return recv_exactly(sock, struct.unpack("!H", recv_exactly(sock, 2))[0])
+                with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                    sock.settimeout(UPSTREAM_TIMEOUT)
+                    sock.sendto(query, (self.upstream, 53))
+                    response = sock.recv(65535)
+                    while response[:2] != query[:2]: # stray answer of an earlier try
+                        response = sock.recv(65535)
+                    return response
+            except OSError:
+                continue
+        return None
+
+    def prefetch(self, hosts):
+        """
+        Resolves hosts into the cache so the crawl finds them there. Returns once all are resolved.
+
+        Args:
+            hosts (list): host names
+        Returns:
+            None
+        """
+        queries = []
+        for host in hosts:
+            for qtype in (TYPE_A, TYPE_AAAA):
+                if qtype != self.forced_empty_type:
+                    try:
+                        queries.append(build_query(host, qtype))
+                    except (UnicodeEncodeError, ValueError): # label over 63 characters or not ASCII
+                        break
+        with ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY) as executor:
+            list(executor.map(lambda query: self.answer(query, "udp", source="prefetch"), queries))
+
+    def record(self, entry):
+        """Appends one query to the record file. Opened per query so the file follows a job workspace that moved."""
+        with self.lock:
+            self.stats['queries'] += 1
+            self.stats[entry['source']] += 1
+            try:
+                with open(self.record_path, "a") as record_f:
+                    record_f.write(json.dumps(entry, separators=(',', ':')) + "\n")
+            except OSError:
+                pass
+
+
+def recv_exactly(sock, length):
+    """Reads length bytes from a stream socket. Raises ConnectionError when it closes early."""
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
@@ -0,0 +1,1350 @@
+#!/usr/bin/python3
+# Built in Python 3.8
+__author__ = "Kemp Langhorne"
+__copyright__ = "Copyright (C) 2021 AskKemp.com"
+__license__ = "agpl-3.0"
+
+# Helpers for writing and reading the artifacts that make up a job result.
+# Shared by server_application.py (writer) and client.py (reader) so only the
+# Python standard library may be used here.
+
+import base64
+import csv
+import gzip
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import re
+import shutil
+import socket
+import stat
+import struct
+import queue
+import subprocess
+import tarfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+#
+# SSLsplit connect log (proxy.log) summary
+#
+# Fixed schema of the connection summary. Order matters as it is the column order of the CSV.
+CONNECTION_COLUMNS = ('timestamp', 'proto', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'sni', 'host', 'method', 'uri', 'status', 'bytes', 'server_cert')
+CONNECTION_INT_COLUMNS = ('src_port', 'dst_port', 'status', 'bytes')
+CONNECTION_SUMMARY_NAME = "proxy_log.csv.gz" # name inside the job archive
+CONNECTION_SUMMARY_SUFFIX = ".proxy_log.csv.gz" # suffix of the S3 sidecar object e.g. <jobid>-<region>.proxy_log.csv.gz
+
+_TIMESTAMP_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_BRACKET_ADDR_RE = re.compile(r'^\[(?P<ip>[^\]]*)\]:(?P<port>\S+)$')
+_KEY_VALUE_KEYS = ('sni', 'names', 'sproto', 'dproto', 'origcrt', 'usedcrt', 'user', 'group', 'extif', 'pid', 'ocsp')
+
+
+def parse_proxy_log_line(line):
+    """
+    Parses one line of the SSLsplit connect log into the fixed connection schema.
+
+    Handles the tcp, ssl, http and https line types with or without the leading
+    "YYYY-MM-DD HH:MM:SS UTC" timestamp and with either "host port" or "[host]:port" addresses.
+
+    Args:
+        line (str): single line from proxy.log
+    Returns:
+        dict with keys of CONNECTION_COLUMNS (values are str, '' when not present) or None if the line is not a connection
+    """
+    tokens = line.split()
+    record = dict.fromkeys(CONNECTION_COLUMNS, '')
+
+    if len(tokens) >= 3 and _TIMESTAMP_RE.match(tokens[0]) and tokens[2] == 'UTC':
+        record['timestamp'] = f'{tokens[0]}T{tokens[1]}Z'
+        tokens = tokens[3:]
+
+    if len(tokens) < 3:
+        return None
+
+    record['proto'] = tokens[0]
+    tokens = tokens[1:]
+
+    # Addresses
+    src = _BRACKET_ADDR_RE.match(tokens[0])
+    dst = _BRACKET_ADDR_RE.match(tokens[1])
+    if src and dst:
+        record['src_ip'], record['src_port'] = src.group('ip'), src.group('port')
+        record['dst_ip'], record['dst_port'] = dst.group('ip'), dst.group('port')
+        tokens = tokens[2:]
+    elif len(tokens) >= 4:
+        record['src_ip'], record['src_port'], record['dst_ip'], record['dst_port'] = tokens[:4]
+        tokens = tokens[4:]
+    else:
+        return None
+
+    # key:value section e.g. sni:www.google.com origcrt:F048...
+    positional = []
+    for token in tokens:
+        key, sep, value = token.partition(':')
+        if sep and key in _KEY_VALUE_KEYS:
+            if key == 'sni':
+                record['sni'] = value
+            elif key == 'origcrt':
+                record['server_cert'] = value
+        else:
+            positional.append(token)
+
+    # http and https lines end with: host method uri status content-length
+    if record['proto'] in ('http', 'https') and len(positional) >= 5:
+        record['host'], record['method'], record['uri'], record['status'], record['bytes'] = positional[:5]
+
+    for key, value in record.items():
+        if value == '-':
+            record[key] = ''
+
+    return record
+
+def write_connection_summary(proxy_log_path, output_path):
+    """
+    Converts the SSLsplit connect log into a gzip compressed CSV with the fixed CONNECTION_COLUMNS schema.
+    Rows keep the order of proxy.log which is chronological.
+
+    Args:
+        proxy_log_path (str): path to proxy.log
+        output_path (str): path of the .csv.gz to write
+    Returns:
+        int number of connection rows written
+    """
+    rows = 0
+    with open(proxy_log_path, 'r', errors='replace') as log_f, gzip.open(output_path, 'wt', newline='') as out_f:
+        writer = csv.writer(out_f)
+        writer.writerow(CONNECTION_COLUMNS)
+        for line in log_f:
+            record = parse_proxy_log_line(line)
+            if record:
+                writer.writerow([record[column] for column in CONNECTION_COLUMNS])
+                rows += 1
+    return rows
+
+def _typed_connection(row):
+    """Converts a CSV row of strings into a dict with int columns converted. Empty values become None."""
+    record = {}
+    for column, value in zip(CONNECTION_COLUMNS, row):
+        if value == '':
+            record[column] = None
+        elif column in CONNECTION_INT_COLUMNS:
+            try:
+                record[column] = int(value)
+            except ValueError:
+                record[column] = None
+        else:
+            record[column] = value
+    return record
+
+def read_connection_summary(fileobj, ip=None, sni=None, host=None, since=None, until=None):
+    """
+    Streams rows from a connection summary applying the predicates while reading.
+
+    The predicates are pushed down in two ways. A raw line that does not contain every requested literal value
+    is skipped before it is decoded. Rows are chronological so reading stops at the first row after until.
+
+    Args:
+        fileobj: binary file object of a .csv.gz connection summary
+        ip (str): destination IP address to match
+        sni (str): TLS SNI to match
+        host (str): HTTP Host header to match
+        since (str): ISO 8601 UTC timestamp e.g. 2021-05-02T17:05:05Z. Rows before it are skipped.
+        until (str): ISO 8601 UTC timestamp. Rows after it are skipped.
+    Returns:
+        generator of dicts with CONNECTION_COLUMNS keys
+    """
+    literals = [value for value in (ip, sni, host) if value]
+
+    with gzip.open(fileobj, 'rt', newline='') as summary_f:
+        header = next(csv.reader([summary_f.readline()]), None)
+        if tuple(header or ()) != CONNECTION_COLUMNS:
+            raise ValueError(f"Unexpected connection summary columns: {header}")
+
+        for line in summary_f:
+            if not all(value in line for value in literals): # cheap check before csv decoding
+                continue
+            record = _typed_connection(next(csv.reader([line])))
+            if until and record['timestamp'] and record['timestamp'] > until:
+                break
+            if since and (not record['timestamp'] or record['timestamp'] < since):
+                continue
+            if ip and record['dst_ip'] != ip:
+                continue
+            if sni and record['sni'] != sni:
+                continue
+            if host and record['host'] != host:
+                continue
+            yield record
+
+def _connection_summary_sources(paths):
+    """
+    Expands files and directories into the connection summaries to query.
+    A sidecar .proxy_log.csv.gz is preferred over the job archive of the same job.
+
+    Args:
+        paths (list): str paths to sidecar files, job archives or directories containing them
+    Returns:
+        list of pathlib.Path
+    """
+    sources = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            sidecars = sorted(path.glob('*' + CONNECTION_SUMMARY_SUFFIX))
+            jobs_with_sidecar = {p.name[:-len(CONNECTION_SUMMARY_SUFFIX)] for p in sidecars}
+            archives = [p for p in sorted(path.glob('*.tar.gz')) if p.name[:-len('.tar.gz')] not in jobs_with_sidecar]
+            sources.extend(sidecars + archives)
+        elif path.is_file():
+            sources.append(path)
+    return sources
+
+def job_name_from_path(path):
+    """Returns the <jobid>-<region> portion of a job archive or sidecar file name"""
+    name = Path(path).name
+    for suffix in (CONNECTION_SUMMARY_SUFFIX, MANIFEST_SUFFIX, '.tar.gz'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def query_connection_summaries(paths, ip=None, sni=None, host=None, since=None, until=None):
+    """
+    Queries the connection summaries of many jobs.
+    Sidecar files are read directly. Job archives are streamed and only their proxy_log.csv.gz member is read.
+
+    Args:
+        paths (list): str paths to sidecar files, job archives or directories containing them
+        ip, sni, host, since, until: see read_connection_summary()
+    Returns:
+        generator of tuple (job name, dict of connection)
+    """
+    for source in _connection_summary_sources(paths):
+        job_name = job_name_from_path(source)
+        if source.name.endswith('.tar.gz'):
+            with tarfile.open(source, mode='r|gz') as archive:
+                for member in archive:
+                    if member.isfile() and member.name.endswith('/' + CONNECTION_SUMMARY_NAME):
+                        summary_bytes = io.BytesIO(archive.extractfile(member).read())
+                        for record in read_connection_summary(summary_bytes, ip, sni, host, since, until):
+                            yield job_name, record
+                        break
+        else:
+            with open(source, 'rb') as summary_f:
+                for record in read_connection_summary(summary_f, ip, sni, host, since, until):
+                    yield job_name, record
+
+#
+# Job post-processing. Run by server_application.py after the crawl and by replay_job.py.
+#
+_FINGERPRINT_RE = re.compile(r'^[0-9A-Fa-f]{40}$')
+_PEM_CERTIFICATE_RE = re.compile(rb'-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----', re.DOTALL)
+PIPELINE_MEMBER_BYTES = 32 << 20 # uncompressed bytes of downloaded files per gzip member of a pipelined archive
+PIPELINE_POLL_INTERVAL = 2 # seconds between looks for new certificates while the crawl runs
+PIPELINE_SETTLE_SECONDS = 2 # a certificate is only read once SSLsplit has not written it for this long
+
+
+def directory_usage(path):
+    """
+    Totals the files below a directory
+
+    Args:
+        path (str): directory to walk. Does not need to exist.
+    Returns:
+        tuple (bytes, files)
+    """
+    total_bytes, total_files = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total_bytes += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError: # removed or renamed by wget while walking
+                continue
+            total_files += 1
+    return total_bytes, total_files
+
+def transform_certificate(path, output_dir):
+    """
+    Makes one certificate written by SSLsplit human readable with openssl
+
+    Args:
+        path (Path): certificate e.g. debug/certificates/<fingerprint>.crt
+        output_dir (str): directory the <fingerprint>.crt.text file is written to
+    Returns:
+        Path of the text file or None when openssl could not read the certificate
+    """
+    result = subprocess.run(['openssl', 'x509', '-in', str(path), '-text'], capture_output=True)
+    if result.returncode != 0:
+        return None
+    text_path = Path(output_dir) / (path.name + '.text')
+    with open(text_path, 'wb') as text_f:
+        text_f.write(result.stdout)
+    return text_path
+
+def transform_certificates(certificate_dir, output_dir, done=()):
+    """
+    Makes the internet-side certificates written by SSLsplit human readable with openssl.
+    Only the certificates named by their SHA1 fingerprint are the internet-side ones.
+
+    Args:
+        certificate_dir (str): SSLsplit certificate directory e.g. debug/certificates/
+        output_dir (str): directory the <fingerprint>.crt.text files are written to
+        done (set): names of certificates already transformed e.g. by an ArchivePipeline. Counted as transformed.
+    Returns:
+        tuple (transformed, failed) counts of certificates
+    """
+    transformed, failed = 0, 0
+    for path in sorted(Path(certificate_dir).glob('*.crt')):
+        if not _FINGERPRINT_RE.match(path.stem):
+            continue
+        if path.name in done or transform_certificate(path, output_dir):
+            transformed += 1
+        else:
+            failed += 1
+    return transformed, failed
+
+def anonymize_tarinfo(tarinfo):
+    """Changes information in the created tar. Security by obscurity."""
+    tarinfo.uname = "user"
+    tarinfo.gname = "group"
+    tarinfo.uid = 0
+    tarinfo.gid = 0
+    return tarinfo
+
+def write_job_archive(job_root, archive_path, arcname, progress=None):
+    """
+    Compresses the job directory into a tar.gz without the owners of the files
+
+    Args:
+        job_root (str): job directory. The archive may be written inside it as tarfile skips the archive itself.
+        archive_path (str): tar.gz to write
+        arcname (str): top directory inside the archive e.g. <jobid>-<region>
+        progress (callable): optional, called without arguments for every file added
+    Returns:
+        int size of the archive in bytes
+    """
+    def archive_filter(tarinfo):
+        if progress:
+            progress()
+        return anonymize_tarinfo(tarinfo)
+
+    with tarfile.open(archive_path, mode='w:gz') as archive:
+        archive.add(job_root, recursive=True, arcname=arcname, filter=archive_filter)
+    return os.path.getsize(archive_path)
+
+class _HashingReader:
+    """File object wrapper that hashes what tarfile reads through it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        self.digest.update(chunk)
+        return chunk
+
+class ArchivePipeline:
+    """
+    Writes the job archive while the crawl is still running. Every file the crawler reports as saved is hashed and
+    appended to the archive by a background thread, and new SSLsplit certificates are transformed and appended as
+    they show up. The archive is a tar split over several gzip members, which gzip and tarfile read as one stream.
+    finish() appends the rest of the job directory and the end of the tar in a last member. A member holding a
+    file that changed after it was appended is dropped together with the members after it and its files are
+    appended again at the end.
+    """
+
+    def __init__(self, job_root, archive_path, arcname, certificate_dir=None, certificate_output_dir=None):
+        """
+        Args:
+            job_root (str): job directory. The archive may be written inside it as it is skipped.
+            archive_path (str): tar.gz to write
+            arcname (str): top directory inside the archive e.g. <jobid>-<region>
+            certificate_dir (str): optional, SSLsplit certificate directory e.g. debug/certificates/ watched for new certificates
+            certificate_output_dir (str): directory the <fingerprint>.crt.text files are written to
+        """
+        self.job_root = job_root
+        self.archive_path = archive_path
+        self.arcname = arcname
+        self.certificate_dir = certificate_dir
+        self.certificate_output_dir = certificate_output_dir
+        self.rendered = set() # names of the certificates transformed. Passed to transform_certificates() as done.
+        self.hashes = {} # path within the job directory -> (bytes, mtime_ns, sha256) of every file appended
+        self.stats = {'files': 0, 'bytes': 0, 'members': 0, 'certificates': 0, 'dropped_members': 0}
+        self.error = None # exception that stopped the background thread. finish() then archives everything itself.
+        self._queue = queue.Queue()
+        self._members = [] # (archive offset, tar offset, list of (name, bytes, mtime_ns), dirty) of the closed gzip members
+        self._member = None # (archive offset, tar offset, files, gzip file, tar file) of the gzip member being written
+        self._member_bytes = 0
+        self._tar_offset = 0 # uncompressed bytes of the tar stream written so far
+        self._seen_certificates = set()
+        self._archive_f = None
+        self._thread = None
+
+    def start(self):
+        """Creates the archive and starts the background thread"""
+        self._archive_f = open(self.archive_path, 'wb')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, path):
+        """Queues a file the crawler finished writing"""
+        self._queue.put(path)
+
+    def drain(self):
+        """
+        Appends the queued files and the certificates not seen yet once the crawl is over, then stops the background thread
+
+        Returns:
+            dict of the counts in stats
+        """
+        self._queue.put(None)
+        self._thread.join()
+        return self.stats
+
+    def tree_hashes(self, tree):
+        """
+        Returns:
+            dict path within tree -> (bytes, mtime_ns, sha256) of the files appended, for build_manifest()
+        """
+        prefix = os.path.relpath(tree, self.job_root) + '/'
+        return {name[len(prefix):]: value for name, value in self.hashes.items() if name.startswith(prefix)}
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    path = self._queue.get(timeout=PIPELINE_POLL_INTERVAL)
+                except queue.Empty:
+                    self._add_certificates(settle=PIPELINE_SETTLE_SECONDS)
+                    continue
+                if path is None:
+                    self._add_certificates(settle=0)
+                    self._close_member()
+                    return
+                self._add_file(path)
+                if self._member_bytes >= PIPELINE_MEMBER_BYTES:
+                    self._close_member()
+        except Exception as e: # e.g. the disk is full
+            self.error = e
+
+    def _add_file(self, path):
+        name = os.path.relpath(path, self.job_root)
+        if name.startswith('..') or name in self.hashes:
+            return
+        try:
+            file_stat = os.lstat(path)
+            if not stat.S_ISREG(file_stat.st_mode):
+                return
+            if not self._member:
+                archive_offset = self._archive_f.tell() # before the gzip header
+                gzip_f = gzip.GzipFile(filename='', mode='wb', fileobj=self._archive_f)
+                tar = tarfile.TarFile(fileobj=gzip_f, mode='w')
+                tar.offset = self._tar_offset # tar offsets continue over the members
+                self._member = (archive_offset, self._tar_offset, [], gzip_f, tar)
+            tar, files = self._member[4], self._member[2]
+            tarinfo = anonymize_tarinfo(tar.gettarinfo(path, arcname=self.arcname + '/' + name))
+            f = open(path, 'rb')
+        except OSError: # removed since it was saved. The last member picks it up.
+            return
+        with f:
+            reader = _HashingReader(f)
+            try:
+                tar.addfile(tarinfo, reader)
+            except OSError: # shorter than when it was stat'ed. Its header and part of it are in the member already.
+                self._close_member(dirty=True)
+                return
+        self._tar_offset = tar.offset
+        files.append((name, file_stat.st_size, file_stat.st_mtime_ns))
+        self.hashes[name] = (file_stat.st_size, file_stat.st_mtime_ns, reader.digest.hexdigest())
+        self._member_bytes += file_stat.st_size
+        self.stats['files'] += 1
+        self.stats['bytes'] += file_stat.st_size
+
+    def _close_member(self, dirty=False):
+        """Closes the gzip member being written. finish() drops a dirty member, which holds an incomplete file."""
+        if not self._member:
+            return
+        self._member[3].close() # the tar is left open so that its end is not written
+        self._members.append(self._member[:3] + (dirty,))
+        self._member = None
+        self._member_bytes = 0
+        self.stats['members'] += 1
+
+    def _add_certificates(self, settle):
+        if not self.certificate_dir or not Path(self.certificate_dir).is_dir():
+            return
+        now = time.time()
+        for path in sorted(Path(self.certificate_dir).glob('*.crt')):
+            if path.name in self._seen_certificates:
+                continue
+            try:
+                if now - path.stat().st_mtime < settle:
+                    continue
+            except OSError:
+                continue
+            self._seen_certificates.add(path.name)
+            self._add_file(str(path))
+            if _FINGERPRINT_RE.match(path.stem) and self.certificate_output_dir:
+                text_path = transform_certificate(path, self.certificate_output_dir)
+                if text_path:
+                    self.rendered.add(path.name)
+                    self.stats['certificates'] += 1
+                    self._add_file(str(text_path))
+
+    def _unchanged_members(self):
+        """Returns the number of leading members that are complete and whose files are still the same"""
+        for number, (archive_offset, tar_offset, files, dirty) in enumerate(self._members):
+            if dirty:
+                return number
+            for name, size, mtime_ns in files:
+                try:
+                    file_stat = os.lstat(os.path.join(self.job_root, name))
+                except OSError:
+                    return number
+                if (file_stat.st_size, file_stat.st_mtime_ns) != (size, mtime_ns):
+                    return number
+        return len(self._members)
+
+    def finish(self, progress=None):
+        """
+        Completes the archive with everything in the job directory not appended yet. Call drain() first.
+
+        Args:
+            progress (callable): optional, called without arguments for every file added
+        Returns:
+            int size of the archive in bytes
+        """
+        if self.error:
+            kept, archive_offset, tar_offset = 0, 0, 0
+        else:
+            kept = self._unchanged_members()
+            archive_offset, tar_offset = self._members[kept][:2] if kept < len(self._members) else (self._archive_f.tell(), self._tar_offset)
+        self.stats['dropped_members'] = len(self._members) - kept
+        appended = set(name for member in self._members[:kept] for name, size, mtime_ns in member[2])
+        self._archive_f.seek(archive_offset) # drops the members from the first changed one on
+        self._archive_f.truncate()
+        archive_real_path = os.path.realpath(self.archive_path)
+
+        with gzip.GzipFile(filename='', mode='wb', fileobj=self._archive_f) as gzip_f:
+            tar = tarfile.TarFile(fileobj=gzip_f, mode='w')
+            tar.offset = tar_offset # the end of the tar is padded to a full record of the whole stream
+            for dirpath, dirnames, filenames in os.walk(self.job_root):
+                dirnames.sort()
+                name = os.path.relpath(dirpath, self.job_root)
+                tar.add(dirpath, arcname=self.arcname if name == '.' else self.arcname + '/' + name, recursive=False, filter=anonymize_tarinfo)
+                for filename in sorted(filenames) + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, self.job_root)
+                    if name in appended or os.path.realpath(path) == archive_real_path:
+                        continue
+                    tar.add(path, arcname=self.arcname + '/' + name, recursive=False, filter=anonymize_tarinfo)
+                    if progress:
+                        progress()
+            tar.close()
+        self._archive_f.close()
+        return os.path.getsize(self.archive_path)
+
+#
+# Job archive scanning
+#
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Returns the hex sha256 of a file read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def stream_sha256(fileobj, chunk_size=1 << 20):
+    """Returns tuple (hex sha256, number of bytes) of a file object read in chunks"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+def certificate_sha256(pem_bytes):
+    """Returns the hex sha256 fingerprint of the first certificate in PEM bytes or None"""
+    match = _PEM_CERTIFICATE_RE.search(pem_bytes)
+    if not match:
+        return None
+    try:
+        return hashlib.sha256(base64.b64decode(b''.join(match.group(1).split()))).hexdigest()
+    except ValueError:
+        return None
+
+def connection_observations(record):
+    """
+    Turns a connection record into indexable observations.
+
+    Args:
+        record (dict): connection from parse_proxy_log_line() or read_connection_summary()
+    Returns:
+        set of tuple (kind, value, detail)
+    """
+    observations = set()
+    if record.get('dst_ip'):
+        observations.add(('ip', record['dst_ip'], ''))
+    for hostname in (record.get('sni'), record.get('host')):
+        if hostname:
+            observations.add(('host', hostname, ''))
+    if record.get('server_cert'):
+        observations.add(('cert_sha1', record['server_cert'].upper(), ''))
+    if record.get('uri'):
+        scheme = 'https' if record.get('proto') in ('https', 'ssl') else 'http'
+        hostname = record.get('host') or record.get('sni') or record.get('dst_ip')
+        observations.add(('url', f"{scheme}://{hostname}{record['uri']}", ''))
+    return observations
+
+def iter_job_archive(path, fileobj=None):
+    """
+    Streams the regular file members of a job tar.gz without extracting it to disk.
+
+    Args:
+        path (str): path of the job tar.gz. Only used as its name when fileobj is provided.
+        fileobj: file object to read the job tar.gz from instead e.g. an S3 response body
+    Returns:
+        generator of tuple (path of member within the job i.e. without the leading <jobid>-<region>/, tarfile.TarInfo, file object)
+        The file object is only valid until the next item is requested.
+    """
+    with tarfile.open(path, mode='r|gz', fileobj=fileobj) as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            relative_name = member.name.split('/', 1)[1] if '/' in member.name else member.name
+            yield relative_name, member, archive.extractfile(member)
+
+def scan_job_archive(path, skip_checksums=()):
+    """
+    Collects the observations of a job archive for the local analytics index.
+    Runs in a worker process so it only returns plain data.
+
+    Observation kinds: ip, host, url, cert_sha1, cert_sha256, file_sha256
+
+    Args:
+        path (str): path of the job tar.gz
+        skip_checksums (set): archive sha256 values that are already indexed
+    Returns:
+        dict with keys name, path, sha256, bytes, skipped and observations (list of tuple (kind, value, detail))
+    """
+    result = {'name': job_name_from_path(path), 'path': str(Path(path).absolute()), 'sha256': file_sha256(path), 'bytes': Path(path).stat().st_size, 'skipped': False, 'observations': []}
+    if result['sha256'] in skip_checksums:
+        result['skipped'] = True
+        return result
+
+    observations = set()
+    for name, member, fileobj in iter_job_archive(path):
+        if name.startswith('wget_saved/'):
+            digest, size = stream_sha256(fileobj)
+            observations.add(('file_sha256', digest, name[len('wget_saved/'):]))
+        elif name == CONNECTION_SUMMARY_NAME:
+            for record in read_connection_summary(io.BytesIO(fileobj.read())):
+                observations.update(connection_observations(record))
+        elif name == 'proxy.log':
+            for line in fileobj.read().decode(errors='replace').splitlines():
+                record = parse_proxy_log_line(line)
+                if record:
+                    observations.update(connection_observations(record))
+        elif name.startswith('debug/certificates/') and name.endswith('.crt'):
+            fingerprint = Path(name).stem
+            if _FINGERPRINT_RE.match(fingerprint): # original server certificate and not the forged one
+                observations.add(('cert_sha1', fingerprint.upper(), ''))
+                sha256 = certificate_sha256(fileobj.read())
+                if sha256:
+                    observations.add(('cert_sha256', sha256, fingerprint.upper()))
+
+    result['observations'] = sorted(observations)
+    return result
+
+#
+# Incremental recrawl manifests
+#
+MANIFEST_NAME = "manifest.json.gz" # name inside the job archive
+MANIFEST_SUFFIX = ".manifest.json.gz" # suffix of the S3 sidecar object read by the worker of a later incremental job
+TREE_PREFIX = "wget_saved/" # downloaded tree within the job archive
+
+
+def build_manifest(tree, job_name, url, base=None, validators=None, hashes=None):
+    """
+    Describes the downloaded tree of a job. For an incremental job it also records how the tree differs from its base.
+    Every file entry names the job whose archive holds its content. Files that did not change since the base keep
+    pointing at an earlier job so they can be left out of this job's archive.
+
+    Args:
+        tree (str): downloaded tree (wget_saved/)
+        job_name (str): <jobid>-<region>
+        url (str): crawled URL
+        base (dict): manifest of the base job or None for a full job
+        validators (dict): path within the tree -> ETag recorded by the crawler
+        hashes (dict): path within the tree -> (bytes, mtime_ns, sha256) of files hashed before e.g. by an ArchivePipeline.
+                       Only used for files that did not change since.
+    Returns:
+        tuple (manifest dict, list of pathlib.Path of unchanged files)
+
+        Example entry: {'index.html': {'sha256': '9f86...', 'bytes': 1024, 'mtime': 1620000000, 'etag': '"abc"', 'job': '33fbce02-20e6-4120-b955-c79cc4126c0e-eu-west-1'}}
+    """
+    base_files = base['files'] if base else {}
+    validators = validators or {}
+    hashes = hashes or {}
+    files, unchanged, added, changed = {}, [], [], []
+    for path in sorted(Path(tree).rglob('*')):
+        if not path.is_file() or path.is_symlink():
+            continue
+        name = path.relative_to(tree).as_posix()
+        file_stat = path.stat()
+        known = hashes.get(name)
+        sha256 = known[2] if known and known[:2] == (file_stat.st_size, file_stat.st_mtime_ns) else file_sha256(path)
+        entry = {'sha256': sha256, 'bytes': file_stat.st_size, 'mtime': int(file_stat.st_mtime), 'etag': validators.get(name), 'job': job_name}
+        previous = base_files.get(name)
+        if previous and previous['sha256'] == entry['sha256']:
+            entry['job'] = previous['job']
+            entry['etag'] = entry['etag'] or previous.get('etag')
+            unchanged.append(path)
+        elif previous:
+            changed.append(name)
+        else:
+            added.append(name)
+        files[name] = entry
+    for name, entry in base_files.items(): # not seeded or no longer on the site. Stays part of the tree like wget --mirror.
+        files.setdefault(name, entry)
+
+    manifest = {'job': job_name,
+                'url': url,
+                'base': base['job'] if base else None,
+                'files': files,
+                'changes': {'added': added, 'changed': changed, 'unchanged': len(unchanged)}}
+    return manifest, unchanged
+
+def write_manifest(manifest, path):
+    """Writes a manifest as gzip JSON"""
+    with gzip.open(path, 'wt', encoding='utf-8') as manifest_f:
+        json.dump(manifest, manifest_f, separators=(',', ':'))
+    return
+
+def read_manifest(fileobj):
+    """Reads a gzip JSON manifest from a binary file object"""
+    with gzip.open(fileobj, 'rt', encoding='utf-8') as manifest_f:
+        return json.load(manifest_f)
+
+def read_archive_manifest(path):
+    """
+    Reads the manifest inside a job tar.gz
+
+    Returns:
+        dict or None if the job has no manifest
+    """
+    for name, member, fileobj in iter_job_archive(path):
+        if name == MANIFEST_NAME:
+            return read_manifest(io.BytesIO(fileobj.read()))
+    return None
+
+def manifest_files_by_job(manifest):
+    """Groups the file entries of a manifest by the job archive holding them. Returns dict job -> {path: entry}"""
+    by_job = {}
+    for name, entry in manifest['files'].items():
+        by_job.setdefault(entry['job'], {})[name] = entry
+    return by_job
+
+def extract_tree_files(archive, wanted, output_dir, fileobj=None):
+    """
+    Writes files of the downloaded tree out of a job archive with the modification time of the manifest.
+    Seeds the tree of an incremental job (so Wget --timestamping sees the base files) and rebuilds full trees.
+
+    Args:
+        archive (str): path of the job tar.gz. Only used as its name when fileobj is provided.
+        wanted (dict): path within the tree -> manifest entry. Only these are written and their sha256 is verified.
+        output_dir (str): directory the tree is written to
+        fileobj: file object to read the job tar.gz from instead e.g. an S3 response body
+    Returns:
+        tuple (files written, bytes written)
+    """
+    files, written = 0, 0
+    for name, member, member_f in iter_job_archive(archive, fileobj=fileobj):
+        if not name.startswith(TREE_PREFIX):
+            continue
+        name = name[len(TREE_PREFIX):]
+        entry = wanted.get(name)
+        if not entry or name.startswith('/') or '..' in name.split('/'):
+            continue
+        target = Path(output_dir, name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        with open(target, 'wb') as target_f:
+            for chunk in iter(lambda: member_f.read(1 << 20), b''):
+                digest.update(chunk)
+                target_f.write(chunk)
+        if digest.hexdigest() != entry['sha256']:
+            raise ValueError(f"{name} in {archive} does not match its manifest entry")
+        os.utime(target, (entry['mtime'], entry['mtime']))
+        files += 1
+        written += member.size
+    return files, written
+
+def remove_tree_files(paths, tree):
+    """Deletes files from the downloaded tree and then the directories left empty"""
+    for path in paths:
+        Path(path).unlink()
+    for directory, subdirectories, names in os.walk(tree, topdown=False):
+        if directory != str(tree) and not os.listdir(directory):
+            os.rmdir(directory)
+    return
+
+def rebuild_tree(manifest, archive_dir, output_dir):
+    """
+    Rebuilds the full downloaded tree of an incremental job from the archives of the job and its bases
+
+    Args:
+        manifest (dict): manifest of the job
+        archive_dir (str): directory holding <job>.tar.gz of every job the manifest refers to
+        output_dir (str): directory the tree is written to
+    Returns:
+        tuple (files written, bytes written)
+    Raises:
+        FileNotFoundError when job archives are missing
+        ValueError when an archive does not hold the files its manifest entries promise
+    """
+    by_job = manifest_files_by_job(manifest)
+    missing = sorted(job + '.tar.gz' for job in by_job if not Path(archive_dir, job + '.tar.gz').is_file())
+    if missing:
+        raise FileNotFoundError(f"Job archives needed in {archive_dir}: {', '.join(missing)}")
+
+    files, written = 0, 0
+    for job, wanted in by_job.items():
+        job_files, job_bytes = extract_tree_files(str(Path(archive_dir, job + '.tar.gz')), wanted, output_dir)
+        if job_files != len(wanted):
+            raise ValueError(f"{len(wanted) - job_files} files of the manifest are missing from {job}.tar.gz")
+        files += job_files
+        written += job_bytes
+    return files, written
+
+#
+# Sharded recursive crawls
+#
+
+def partition_frontier(urls, shards):
+    """
+    Splits the URLs a coordinator did not crawl itself into the seeds of at most shards sub jobs of about the same size.
+    URLs stay together by host and directory so pages of a section, which mostly link to each other, end up in the
+    same shard. Directories larger than a fair share are split.
+
+    Args:
+        urls (list): absolute URLs
+        shards (int): number of sub jobs wanted
+    Returns:
+        list of non-empty lists of URLs
+    """
+    groups = {}
+    for url in urls:
+        parts = urlsplit(url)
+        groups.setdefault((parts.netloc, parts.path.rsplit('/', 1)[0]), []).append(url)
+
+    fair_share = max(-(-len(urls) // shards), 1) # ceiling
+    chunks = []
+    for group in groups.values():
+        chunks.extend(group[start:start + fair_share] for start in range(0, len(group), fair_share))
+
+    bins = [[] for _ in range(shards)]
+    for chunk in sorted(chunks, key=len, reverse=True): # largest first into the emptiest shard
+        min(bins, key=len).extend(chunk)
+    return [shard for shard in bins if shard]
+
+def merge_manifests(job_name, url, manifests):
+    """
+    Combines the manifests of the parts of a sharded crawl into the logical manifest of the whole job.
+    File entries keep pointing at the part whose archive holds them, so the tree is rebuilt and incremental jobs are
+    seeded the same way as for a chain of incremental jobs. A file in more than one part is taken from the first.
+
+    Args:
+        job_name (str): <jobid>-<region> of the coordinator
+        url (str): crawled URL
+        manifests (list): manifests of the coordinator and the shards, coordinator first
+    Returns:
+        manifest dict. The extra key shards lists the parts.
+    """
+    files = {}
+    for manifest in manifests:
+        for name, entry in manifest['files'].items():
+            files.setdefault(name, entry)
+    return {'job': job_name,
+            'url': url,
+            'base': None,
+            'files': files,
+            'changes': {'added': sorted(files), 'changed': [], 'unchanged': 0},
+            'shards': [manifest['job'] for manifest in manifests]}
+
+#
+# Crawl checkpoints
+#
+CHECKPOINT_INDEX_NAME = "checkpoint.json" # first member of every checkpoint segment
+CHECKPOINT_ATTEMPTS_DIR = "attempts" # capture of earlier workers of a resumed job within the job directory, by attempt
+CHECKPOINT_COMPRESSLEVEL = 1 # segments are read back at most once so they favour speed over size
+
+
+class CrawlCheckpoint:
+    """
+    Collects what a crawl added to the job directory since the last checkpoint into a numbered segment. Downloaded files
+    are taken whole once the engine reported them saved. Every other file is only taken from the size it had at the
+    last checkpoint on, as SSLsplit, the engine and the DNS resolver append to theirs. Applying the segments in order
+    with apply_checkpoint_segment() gives the job directory as it was at the last checkpoint.
+    """
+
+    def __init__(self, job_root, attempt, segment=0, exclude=()):
+        """
+        Args:
+            job_root (str): job directory
+            attempt (int): worker of the job this is. Starts at 1 and goes up with every resume.
+            segment (int): number of the next segment. Segments are numbered across all attempts.
+            exclude (tuple): names within the job directory left out e.g. the job archive
+        """
+        self.job_root = job_root
+        self.attempt = attempt
+        self.segment = segment
+        self.exclude = set(exclude) | {TREE_PREFIX.rstrip('/'), CHECKPOINT_ATTEMPTS_DIR}
+        self._offsets = {} # path within the job directory -> bytes of it in the segments so far
+        self._saved = [] # paths within the job directory of the downloaded files not in a segment yet
+        self._written = None # (downloaded files, offsets) of the segment written but not committed yet
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        """Records a file the engine finished downloading"""
+        name = os.path.relpath(path, self.job_root)
+        if name.startswith(TREE_PREFIX):
+            with self._lock:
+                self._saved.append(name)
+
+    def write_segment(self, fileobj, state=None):
+        """
+        Writes the next segment. It only counts as taken once commit() is called e.g. after it was uploaded.
+
+        Args:
+            fileobj: file object the segment tar.gz is written to
+            state (dict): crawl state stored in the index e.g. seconds crawled so far
+        Returns:
+            dict index of the segment or None when nothing changed since the last one
+
+            Example: {'attempt': 1, 'segment': 0, 'created': 1620000000.0, 'state': {...}, 'files': {'proxy.pcap': [0, 1048576]}}
+        """
+        with self._lock:
+            saved = list(self._saved)
+        files = {}
+        for name in dict.fromkeys(saved): # in order, once
+            try:
+                files[name] = [0, os.lstat(os.path.join(self.job_root, name)).st_size]
+            except OSError: # removed since e.g. by an incremental job
+                continue
+        for dirpath, dirnames, filenames in os.walk(self.job_root):
+            if os.path.relpath(dirpath, self.job_root) == '.':
+                dirnames[:] = [d for d in dirnames if d not in self.exclude]
+                filenames = [f for f in filenames if f not in self.exclude]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.job_root)
+                try:
+                    file_stat = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                offset = self._offsets.get(name, 0)
+                if file_stat.st_size < offset: # replaced. Taken whole again.
+                    offset = 0
+                if file_stat.st_size > offset or name not in self._offsets:
+                    files[name] = [offset, file_stat.st_size - offset]
+        if not files:
+            return None
+
+        index = {'attempt': self.attempt, 'segment': self.segment, 'created': time.time(), 'state': state or {}, 'files': files}
+        with tarfile.open(fileobj=fileobj, mode='w:gz', compresslevel=CHECKPOINT_COMPRESSLEVEL) as segment:
+            index_bytes = json.dumps(index).encode('utf-8')
+            tarinfo = tarfile.TarInfo(CHECKPOINT_INDEX_NAME)
+            tarinfo.size, tarinfo.mtime = len(index_bytes), int(index['created'])
+            segment.addfile(anonymize_tarinfo(tarinfo), io.BytesIO(index_bytes))
+            for name, (offset, length) in files.items():
+                path = os.path.join(self.job_root, name)
+                tarinfo = anonymize_tarinfo(segment.gettarinfo(path, arcname=name))
+                tarinfo.size = length
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    segment.addfile(tarinfo, f) # raises when the file got shorter. The next segment tries again.
+        self._written = (len(saved), {name: offset + length for name, (offset, length) in files.items() if not name.startswith(TREE_PREFIX)})
+        return index
+
+    def commit(self):
+        """Counts the segment last written as taken"""
+        saved, offsets = self._written
+        with self._lock:
+            del self._saved[:saved]
+        self._offsets.update(offsets)
+        self._written = None
+        self.segment += 1
+
+def apply_checkpoint_segment(fileobj, job_root):
+    """
+    Puts the content of a checkpoint segment in place. Downloaded files go to the tree and keep their modification time.
+    Everything else is the capture of an earlier worker and goes below attempts/<attempt>/.
+
+    Args:
+        fileobj: file object to read the segment tar.gz from e.g. an S3 response body
+        job_root (str): job directory
+    Returns:
+        dict index of the segment. See CrawlCheckpoint.write_segment().
+    Raises:
+        ValueError: when the segment does not start with its index or names a file outside the job directory
+    """
+    index = None
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as segment:
+        for member in segment:
+            if index is None:
+                if member.name != CHECKPOINT_INDEX_NAME:
+                    raise ValueError(f"checkpoint segment starts with {member.name} instead of {CHECKPOINT_INDEX_NAME}")
+                index = json.load(segment.extractfile(member))
+                continue
+            name = member.name
+            if not member.isfile() or name not in index['files'] or name.startswith('/') or '..' in name.split('/'):
+                raise ValueError(f"unexpected file {name} in checkpoint segment {index['segment']}")
+            if not name.startswith(TREE_PREFIX):
+                name = f"{CHECKPOINT_ATTEMPTS_DIR}/{index['attempt']}/{name}"
+            target = Path(job_root, name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            offset = index['files'][member.name][0]
+            with open(target, 'r+b' if offset and target.exists() else 'wb') as target_f:
+                target_f.seek(offset)
+                shutil.copyfileobj(segment.extractfile(member), target_f)
+                target_f.truncate()
+            os.utime(target, (member.mtime, member.mtime))
+    if index is None:
+        raise ValueError("empty checkpoint segment")
+    return index
+
+#
+# Cross-region diff
+#
+_REGION_RE = re.compile(r'-([a-z]{2}(?:-gov)?-[a-z]+-\d+)$')
+VARIANT_LABELS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz" # one per distinct content. Later ones are shown as +
+VARIANT_MISSING = "-"
+
+def region_from_job_name(job_name):
+    """Returns the AWS region of a <jobid>-<region> job name or the job name when it has none"""
+    match = _REGION_RE.search(job_name)
+    return match.group(1) if match else job_name
+
+def fingerprint_job_archive(path):
+    """
+    Hashes the downloaded files and the leaf certificates of a job to compare it with jobs of the same URL from other
+    regions. The archive is streamed once without extracting it. Runs in a worker process so it only returns plain data.
+
+    Args:
+        path (str): path of the job tar.gz
+    Returns:
+        dict with keys name, region, files ({path within wget_saved/: sha256}) and certificates ({SNI or host: sorted
+        list of the sha256 fingerprints of the original server certificates it presented})
+    """
+    files = {}
+    certificate_sha256s = {} # sha1 -> sha256 of the original server certificates written by SSLsplit
+    host_certificates = {} # SNI or host -> set of sha1 of the connect log
+    for name, member, fileobj in iter_job_archive(path):
+        records = ()
+        if name.startswith(TREE_PREFIX):
+            files[name[len(TREE_PREFIX):]] = stream_sha256(fileobj)[0]
+        elif name == CONNECTION_SUMMARY_NAME:
+            records = read_connection_summary(io.BytesIO(fileobj.read()))
+        elif name == 'proxy.log':
+            records = (parse_proxy_log_line(line) for line in fileobj.read().decode(errors='replace').splitlines())
+        elif name.startswith('debug/certificates/') and name.endswith('.crt') and _FINGERPRINT_RE.match(Path(name).stem):
+            certificate_sha256s[Path(name).stem.upper()] = certificate_sha256(fileobj.read())
+        for record in records:
+            if record and record.get('server_cert'):
+                host = record.get('sni') or record.get('host') or record.get('dst_ip')
+                host_certificates.setdefault(host, set()).add(record['server_cert'].upper())
+
+    job_name = job_name_from_path(path)
+    return {'name': job_name,
+            'region': region_from_job_name(job_name),
+            'files': files,
+            'certificates': {host: sorted(certificate_sha256s.get(sha1) or sha1 for sha1 in sha1s) for host, sha1s in host_certificates.items()}}
+
+def diff_fingerprints(fingerprints):
+    """
+    Compares the fingerprints of several jobs of the same URL.
+
+    Args:
+        fingerprints (list): results of fingerprint_job_archive() in column order
+    Returns:
+        tuple of a list and a dict. The list holds tuple (kind, key, variants) for every file and certificate host
+        that is not the same in all jobs. kind is file or cert, key the path within wget_saved/ or the host and
+        variants a string of one label per job. Jobs that saw the same content share a label in order of first
+        appearance and VARIANT_MISSING marks a job without it. The dict counts {kind: {'same': n, 'different': n}}.
+    """
+    rows = []
+    counts = {}
+    for kind, field in (('file', 'files'), ('cert', 'certificates')):
+        counts[kind] = {'same': 0, 'different': 0}
+        for key in sorted(set().union(*(fingerprint[field] for fingerprint in fingerprints))):
+            labels = {}
+            variants = ""
+            for fingerprint in fingerprints:
+                value = fingerprint[field].get(key)
+                if value is None:
+                    variants += VARIANT_MISSING
+                    continue
+                value = str(value)
+                if value not in labels:
+                    labels[value] = VARIANT_LABELS[len(labels)] if len(labels) < len(VARIANT_LABELS) else "+"
+                variants += labels[value]
+            if len(labels) == 1 and VARIANT_MISSING not in variants:
+                counts[kind]['same'] += 1
+            else:
+                counts[kind]['different'] += 1
+                rows.append((kind, key, variants))
+    return rows, counts
+
+#
+# Network timing
+# SSLsplit writes the decrypted traffic to proxy.pcap with synthesized TCP handshakes, so the packet times show
+# when data was relayed but not the handshakes with the server. Those are part of the time from the DNS answer to
+# the connection being ready, measured against the DNS record of the job.
+#
+TIMING_NAME = "timing.jsonl" # one line per request within the job archive
+TIMING_SUMMARY_NAME = "timing_summary.json" # per host summary within the job archive
+DNS_CONNECT_WINDOW = 30 # seconds after a DNS answer within which a connection to one of its addresses is timed from it
+
+_PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6), b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9)}
+_TCP_FIN, _TCP_SYN, _TCP_RST, _TCP_ACK = 0x01, 0x02, 0x04, 0x10
+
+def _normalize_ip(address):
+    """Writes IPv6 addresses the same way whichever tool logged them"""
+    try:
+        return ipaddress.ip_address(address).compressed
+    except ValueError:
+        return address
+
+def _link_payload(linktype, frame):
+    """Returns the IP packet of a captured frame or None for other protocols"""
+    if linktype == 1: # Ethernet
+        offset, ethertype = 14, frame[12:14]
+        while ethertype == b'\x81\x00' and len(frame) >= offset + 4: # VLAN tags
+            ethertype, offset = frame[offset + 2:offset + 4], offset + 4
+        return frame[offset:] if ethertype in (b'\x08\x00', b'\x86\xdd') else None
+    if linktype in (0, 108): # BSD loopback
+        return frame[4:]
+    if linktype == 113: # Linux cooked capture
+        return frame[16:] if frame[14:16] in (b'\x08\x00', b'\x86\xdd') else None
+    if linktype == 276: # Linux cooked capture v2
+        return frame[20:] if frame[0:2] in (b'\x08\x00', b'\x86\xdd') else None
+    if linktype in (12, 14, 101): # raw IP
+        return frame
+    return None
+
+def iter_pcap_tcp(fileobj):
+    """
+    Streams the TCP segments of a pcap file. IP options and IPv6 extension headers are not expected from SSLsplit.
+
+    Args:
+        fileobj: binary file object positioned at the pcap file header
+    Returns:
+        generator of tuple (epoch seconds, src_ip, src_port, dst_ip, dst_port, TCP flags, payload bytes)
+    Raises:
+        ValueError when the file is not a pcap file
+    """
+    header = fileobj.read(24)
+    if len(header) < 24 or header[:4] not in _PCAP_MAGIC:
+        raise ValueError("not a pcap file")
+    endian, resolution = _PCAP_MAGIC[header[:4]]
+    linktype = struct.unpack(endian + 'I', header[20:24])[0] & 0x0FFFFFFF
+    record_header = struct.Struct(endian + 'IIII')
+    while True:
+        record = fileobj.read(16)
+        if len(record) < 16:
+            return
+        seconds, fraction, captured, _ = record_header.unpack(record)
+        packet = _link_payload(linktype, fileobj.read(captured))
+        if not packet:
+            continue
+        if packet[0] >> 4 == 4 and len(packet) >= 20 and packet[9] == 6:
+            ip_header, ip_length = (packet[0] & 0x0F) * 4, struct.unpack('!H', packet[2:4])[0]
+            src, dst = socket.inet_ntop(socket.AF_INET, packet[12:16]), socket.inet_ntop(socket.AF_INET, packet[16:20])
+        elif packet[0] >> 4 == 6 and len(packet) >= 40 and packet[6] == 6:
+            ip_header, ip_length = 40, 40 + struct.unpack('!H', packet[4:6])[0]
+            src, dst = socket.inet_ntop(socket.AF_INET6, packet[8:24]), socket.inet_ntop(socket.AF_INET6, packet[24:40])
+        else:
+            continue
+        if len(packet) < ip_header + 20:
+            continue
+        src_port, dst_port = struct.unpack('!HH', packet[ip_header:ip_header + 4])
+        tcp_header, flags = (packet[ip_header + 12] >> 4) * 4, packet[ip_header + 13]
+        yield seconds + fraction * resolution, src, src_port, dst, dst_port, flags, max(0, ip_length - ip_header - tcp_header)
+
+def _percentile(values, share):
+    """Nearest rank percentile of a list of numbers. None when empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+def _dns_answers(dns_path):
+    """Times of the DNS answers of the job by address. Empty when the job has no DNS record."""
+    answers = {}
+    if not dns_path or not Path(dns_path).is_file():
+        return answers
+    with open(dns_path, errors='replace') as dns_f:
+        for line in dns_f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            for answer in entry.get('answers') or ():
+                if answer.get('type') in ('A', 'AAAA'):
+                    answers.setdefault(_normalize_ip(answer['data']), []).append(entry['ts'])
+    return answers
+
+def network_timings(pcap_path, proxy_log_path, dns_path=None):
+    """
+    Times every request of a job from proxy.pcap, proxy.log and dns.jsonl, each read once. A request is a run of
+    client data and the server data that answers it. Times are milliseconds and throughputs KB per second.
+
+    Request fields: ts (epoch seconds the request was sent), conn (connection number), req (request number within
+    the connection), proto, dst_ip, dst_port, host, method, uri and status from proxy.log when it has them,
+    dns_ready_ms (DNS answer to connection ready, first request of a connection only, includes the TCP and TLS
+    handshakes with the server), ttfb_ms (request to first response byte), transfer_ms (first to last response byte),
+    sent, received (payload bytes) and kbps (response bytes over request to last response byte).
+
+    Args:
+        pcap_path (str): path to proxy.pcap
+        proxy_log_path (str): path to proxy.log. Missing is allowed.
+        dns_path (str): path to dns.jsonl or None
+    Returns:
+        list of dict, one per request in order of the connections
+    """
+    connections = {} # (client ip, client port, server ip, server port) -> connection
+    with open(pcap_path, 'rb', buffering=1 << 20) as pcap_f:
+        for ts, src, src_port, dst, dst_port, flags, length in iter_pcap_tcp(pcap_f):
+            forward, backward = (src, src_port, dst, dst_port), (dst, dst_port, src, src_port)
+            key = forward if forward in connections else backward if backward in connections else None
+            if key is None:
+                if not length and flags & (_TCP_FIN | _TCP_RST):
+                    continue
+                # The side sending the SYN or, without a handshake, the first data is the client
+                key = backward if flags & _TCP_SYN and flags & _TCP_ACK else forward
+                connections[key] = {'start': ts, 'requests': []}
+            if not length:
+                continue
+            requests = connections[key]['requests']
+            if key == forward: # client data starts a request unless it continues one without an answer yet
+                if not requests or requests[-1]['received']:
+                    requests.append({'ts': ts, 'first': None, 'last': None, 'sent': 0, 'received': 0})
+                requests[-1]['sent'] += length
+            else:
+                if not requests: # the server spoke first
+                    requests.append({'ts': ts, 'first': None, 'last': None, 'sent': 0, 'received': 0})
+                requests[-1]['first'] = requests[-1]['first'] or ts
+                requests[-1]['last'] = ts
+                requests[-1]['received'] += length
+
+    logged = {} # connection -> its proxy.log records in order
+    if proxy_log_path and Path(proxy_log_path).is_file():
+        with open(proxy_log_path, errors='replace') as log_f:
+            for line in log_f:
+                record = parse_proxy_log_line(line)
+                if record and record['src_port'].isdigit() and record['dst_port'].isdigit():
+                    key = (_normalize_ip(record['src_ip']), int(record['src_port']), _normalize_ip(record['dst_ip']), int(record['dst_port']))
+                    logged.setdefault(key, []).append(record)
+
+    answers = _dns_answers(dns_path)
+    timings = []
+    for number, ((client_ip, client_port, server_ip, server_port), connection) in enumerate(sorted(connections.items(), key=lambda item: item[1]['start'])):
+        records = logged.get((_normalize_ip(client_ip), client_port, _normalize_ip(server_ip), server_port), [])
+        http_records = [record for record in records if record['method']]
+        first = records[0] if records else dict.fromkeys(CONNECTION_COLUMNS, '')
+        dns_ready = None
+        candidates = [ts for ts in answers.get(_normalize_ip(server_ip), ()) if 0 <= connection['start'] - ts <= DNS_CONNECT_WINDOW]
+        if candidates: # later connections to the address use a cached answer and are not timed from it
+            answers[_normalize_ip(server_ip)].remove(max(candidates))
+            dns_ready = round((connection['start'] - max(candidates)) * 1000, 1)
+        for index, request in enumerate(connection['requests']):
+            record = http_records[index] if index < len(http_records) else dict.fromkeys(CONNECTION_COLUMNS, '') # keep-alive requests beyond the log
+            elapsed = (request['last'] - request['ts']) if request['last'] else None
+            timings.append({'ts': round(request['ts'], 6),
+                            'conn': number,
+                            'req': index,
+                            'proto': first['proto'] or None,
+                            'dst_ip': server_ip,
+                            'dst_port': server_port,
+                            'host': record['host'] or first['host'] or first['sni'] or None,
+                            'method': record['method'] or None,
+                            'uri': record['uri'] or None,
+                            'status': int(record['status']) if record['status'].isdigit() else None,
+                            'dns_ready_ms': dns_ready if index == 0 else None,
+                            'ttfb_ms': round((request['first'] - request['ts']) * 1000, 1) if request['first'] else None,
+                            'transfer_ms': round((request['last'] - request['first']) * 1000, 1) if request['first'] else None,
+                            'sent': request['sent'],
+                            'received': request['received'],
+                            'kbps': round(request['received'] / 1024 / elapsed, 1) if elapsed else None})
+    return timings
+
+def summarize_network_timings(timings):
+    """
+    Summarises request timings per host and for the whole job
+
+    Args:
+        timings (list): result of network_timings()
+    Returns:
+        dict with keys all (summary of every request) and hosts ({host or server IP: summary}). A summary has
+        connections, requests, received and the p50 and p95 of dns_ready_ms, ttfb_ms and kbps.
+    """
+    hosts = {}
+    for timing in timings:
+        hosts.setdefault(timing['host'] or timing['dst_ip'], []).append(timing)
+
+    def summary(requests):
+        result = {'connections': len({request['conn'] for request in requests}),
+                  'requests': len(requests),
+                  'received': sum(request['received'] for request in requests)}
+        for field in ('dns_ready_ms', 'ttfb_ms', 'kbps'):
+            values = [request[field] for request in requests if request[field] is not None]
+            result[field + '_p50'] = _percentile(values, 0.5)
+            result[field + '_p95'] = _percentile(values, 0.95)
+        return result
+
+    return {'all': summary(timings), 'hosts': {host: summary(requests) for host, requests in sorted(hosts.items())}}
+
+def write_network_timings(pcap_path, proxy_log_path, dns_path, output_dir):
+    """
+    Writes TIMING_NAME and TIMING_SUMMARY_NAME into output_dir
+
+    Args:
+        pcap_path (str): path to proxy.pcap
+        proxy_log_path (str): path to proxy.log
+        dns_path (str): path to dns.jsonl or None
+        output_dir (str): usually the job directory
+    Returns:
+        int number of requests timed
+    """
+    timings = network_timings(pcap_path, proxy_log_path, dns_path)
+    with open(Path(output_dir) / TIMING_NAME, 'w') as timing_f:
+        for timing in timings:
+            timing_f.write(json.dumps(timing, separators=(',', ':')) + "\n")
+    with open(Path(output_dir) / TIMING_SUMMARY_NAME, 'w') as summary_f:
+        json.dump(summarize_network_timings(timings), summary_f, indent=1)
+    return len(timings)
+
+def read_archive_timing_summary(path):
+    """
+    Reads the network timing summary of a job archive without extracting it. Runs in a worker process.
+
+    Args:
+        path (str): path of the job tar.gz
+    Returns:
+        dict with keys name, region and summary (see summarize_network_timings(), None when the job has none)
+    """
+    summary = None
+    for name, member, fileobj in iter_job_archive(path):
+        if name == TIMING_SUMMARY_NAME:
+            summary = json.load(fileobj)
+            break
+    job_name = job_name_from_path(path)
+    return {'name': job_name, 'region': region_from_job_name(job_name), 'summary': summary}
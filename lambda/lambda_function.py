@@ -10,6 +10,8 @@ from boto3.session import Session
 from botocore.exceptions import ClientError
 import json
 import os # for environment variable access
+import re # job id validation
+import time # job status long polling
 
 # logging setup
 logger = logging.getLogger()
@@ -28,6 +30,12 @@ AWS_AUTOSCALE_ADD_CAPACITY_ARN = os.environ['ENV_ADD_CAPACITY_POLICY_ARN']
 AWS_AUTOSCALEGROUP_NAME = os.environ['ENV_AUTOSCALEGROUP_NAME']
 AWS_SQS_URL = os.environ['ENV_SQS_URL']
 AWS_REGION = os.environ['AWS_REGION'] # provided by AWS itself
+JOB_MAX_BYTES = int(os.environ['ENV_JOB_MAX_BYTES']) # default and ceiling of the per job quotas
+JOB_MAX_FILES = int(os.environ['ENV_JOB_MAX_FILES'])
+JOB_MAX_SECONDS = int(os.environ['ENV_JOB_MAX_SECONDS'])
+JOB_STATUS_MAX_WAIT = 20 # seconds a jobstatus request may long poll. Must stay below the lambda and API Gateway timeouts.
+JOB_STATUS_POLL_INTERVAL = 1 # seconds between reads of the job status record while long polling
+JOB_MAX_SHARDS = 10 # ceiling of the shards of a sharded recursive job. Must match server_application.py
 
 #
 # START SCRIPT
@@ -73,7 +81,7 @@ def sqs_queue_stats():
 
     return {'ApproximateNumberOfMessages': queue_status['Attributes']['ApproximateNumberOfMessages'], 'ApproximateNumberOfMessagesNotVisible': queue_status['Attributes']['ApproximateNumberOfMessagesNotVisible'], 'ApproximateNumberOfMessagesDelayed': queue_status['Attributes']['ApproximateNumberOfMessagesDelayed']}
 
-def sqs_add_job(input_url, input_useragent, input_recursivelevel, input_forceipver, input_wgetmode):
+def sqs_add_job(input_url, input_useragent, input_recursivelevel, input_forceipver, input_wgetmode, input_maxbytes, input_maxfiles, input_maxseconds, input_engine, input_basejob=None, input_shards=None):
     """
     Connects to AWS Gateway API to to submit a website download job
 
@@ -83,6 +91,12 @@ def sqs_add_job(input_url, input_useragent, input_recursivelevel, input_forceipv
         input_recursivelevel (str):
         input_forceipver (str):
         input_wgetmode (str):
+        input_maxbytes (int): stop the crawl after this many downloaded bytes
+        input_maxfiles (int): stop the crawl after this many downloaded files
+        input_maxseconds (int): stop the crawl after this many seconds
+        input_engine (str): wget or crawler
+        input_basejob (str): <jobid>-<region> of the earlier job an incremental recrawl only downloads changes against. None for a full download.
+        input_shards (int): workers a recursive crawl is split across. None for a crawl by one worker.
 
     Returns:
          json str with keys
@@ -113,8 +127,34 @@ def sqs_add_job(input_url, input_useragent, input_recursivelevel, input_forceipv
         'wget_mode': {
             'DataType': 'String',
             'StringValue': input_wgetmode # singlepage or recursive
+        },
+        'max_bytes': {
+            'DataType': 'Number',
+            'StringValue': str(input_maxbytes)
+        },
+        'max_files': {
+            'DataType': 'Number',
+            'StringValue': str(input_maxfiles)
+        },
+        'max_seconds': {
+            'DataType': 'Number',
+            'StringValue': str(input_maxseconds)
+        },
+        'engine': {
+            'DataType': 'String',
+            'StringValue': input_engine # wget or crawler
         }
     }
+    if input_basejob:
+        request_body['base_job'] = {
+            'DataType': 'String',
+            'StringValue': input_basejob
+        }
+    if input_shards:
+        request_body['shards'] = {
+            'DataType': 'Number',
+            'StringValue': str(input_shards)
+        }
 
     logging.debug(request_body)
 
@@ -129,6 +169,97 @@ def sqs_add_job(input_url, input_useragent, input_recursivelevel, input_forceipv
     job_id = response_dict['MessageId']
     return job_id
 
+def job_status_key(job_id):
+    """S3 key of the job status record. Must match server_application.py"""
+    return 'status/' + job_id + '-' + AWS_REGION + '.json'
+
+def put_job_status(job_id, state):
+    """
+    Writes the first job status record. The EC2 worker replaces it once it receives the job. The job is already
+    in SQS at this point so the record is only written when there is none yet. A worker's record is never replaced.
+    """
+    record = {'jobid': job_id, 'region': AWS_REGION, 'state': state, 'updated': time.time()}
+    try:
+        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=job_status_key(job_id), Body=json.dumps(record), ContentType='application/json', IfNoneMatch='*')
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+            raise
+        # received by a worker in the meantime
+    return
+
+def get_job_status(job_id, wait=0, since=0):
+    """
+    Reads the job status record written by the EC2 worker. Long polls when asked to.
+
+    Args:
+        job_id (str): SQS message id of the job
+        wait (int): seconds to wait for a record newer than since. 0 returns right away.
+        since (float): updated value of the record the caller already has
+
+    Returns:
+        dict of the job status record. The state is unknown when there is no record e.g. wrong region or job id.
+        Complete jobs also get the download URLs. Complete sharded jobs also get the URLs of their shards and of the
+        manifest of the whole job.
+
+        Example: {'jobid': 'c57120e1-6fb5-45d0-b4df-79a21c3e6be9', 'region': 'eu-west-1', 'state': 'crawling', 'phase': 'crawl', 'bytes': 1048576, 'files': 12, 'error': None, 'updated': 1620000000.0}
+    """
+    deadline = time.monotonic() + wait
+    record, etag = {'jobid': job_id, 'region': AWS_REGION, 'state': 'unknown', 'updated': 0}, None
+
+    while True:
+        try:
+            request = {'Bucket': AWS_S3_BUCKET_NAME, 'Key': job_status_key(job_id)}
+            if etag:
+                request['IfNoneMatch'] = etag # unchanged records are not transferred again
+            response = s3_client.get_object(**request)
+            etag = response['ETag']
+            record = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('304', 'NotModified', 'NoSuchKey', '404'):
+                raise
+
+        if record['updated'] > since or record['state'] in ('complete', 'failed', 'cancelled') or time.monotonic() + JOB_STATUS_POLL_INTERVAL > deadline:
+            break
+        time.sleep(JOB_STATUS_POLL_INTERVAL)
+
+    if record['state'] == 'complete': # same links as returned when the job was created
+        record['url'] = create_presigned_url(AWS_S3_BUCKET_NAME, job_id + '-' + AWS_REGION + '.tar.gz')
+        record['proxylog_url'] = create_presigned_url(AWS_S3_BUCKET_NAME, job_id + '-' + AWS_REGION + '.proxy_log.csv.gz')
+        if record.get('shards'): # archives of the shards. Must match server_application.py
+            record['shard_urls'] = {shard: create_presigned_url(AWS_S3_BUCKET_NAME, shard + '.tar.gz') for shard in record['shards']}
+            record['manifest_url'] = create_presigned_url(AWS_S3_BUCKET_NAME, job_id + '-' + AWS_REGION + '.manifest.json.gz')
+    return record
+
+def cancel_job(job_id):
+    """
+    Cancels a job that no EC2 worker received yet. The worker receiving a cancelled job drops it. Jobs already
+    received run to the end. The record is only replaced if it is unchanged so a worker receiving the job wins.
+
+    Args:
+        job_id (str): SQS message id of the job
+
+    Returns:
+        dict of the job status record after the attempt. The state is cancelled when the job was cancelled.
+    """
+    try:
+        response = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=job_status_key(job_id))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return {'jobid': job_id, 'region': AWS_REGION, 'state': 'unknown', 'updated': 0}
+    record = json.loads(response['Body'].read())
+    if record['state'] != 'queued':
+        return record
+
+    record.update(state='cancelled', updated=time.time())
+    try:
+        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=job_status_key(job_id), Body=json.dumps(record), ContentType='application/json', IfMatch=response['ETag'])
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+            raise
+        return get_job_status(job_id) # received by a worker in the meantime
+    return record
+
 def start_ec2_instance():
     """Uses the boto3 autoscaling client to execute a policy. The defined policy adds another EC2 instance."""
 
@@ -230,6 +361,45 @@ def lambda_handler(event, context):
     elif input_job.get('display_useragents') == True:
         outputdict['message'] = user_agent # return entire UA dict 
 
+    elif input_job.get('jobstatus') == True:
+        status_details = input_job.get('jobstatus_details') or {}
+        provided_jobid = str(status_details.get('jobid', ''))
+        provided_wait = status_details.get('wait') or 0
+        provided_since = status_details.get('since') or 0
+
+        if not re.fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', provided_jobid):
+            outputdict['status'] = "failure"
+            outputdict['message'] = "ERROR: Job id must be the id returned when the job was created"
+            s_code = 400
+        elif not str(provided_wait).isdigit() or not isinstance(provided_since, (int, float)):
+            outputdict['status'] = "failure"
+            outputdict['message'] = "ERROR: wait must be whole seconds and since a timestamp"
+            s_code = 400
+        else:
+            try:
+                outputdict['status'] = "success"
+                outputdict['message'] = get_job_status(provided_jobid, wait=min(int(provided_wait), JOB_STATUS_MAX_WAIT), since=provided_since)
+            except Exception as e:
+                outputdict['status'] = "failure"
+                outputdict['message'] = f'ERROR: {str(e)}'
+                s_code = 400
+
+    elif input_job.get('canceljob') == True:
+        provided_jobid = str((input_job.get('canceljob_details') or {}).get('jobid', ''))
+
+        if not re.fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', provided_jobid):
+            outputdict['status'] = "failure"
+            outputdict['message'] = "ERROR: Job id must be the id returned when the job was created"
+            s_code = 400
+        else:
+            try:
+                outputdict['status'] = "success"
+                outputdict['message'] = cancel_job(provided_jobid)
+            except Exception as e:
+                outputdict['status'] = "failure"
+                outputdict['message'] = f'ERROR: {str(e)}'
+                s_code = 400
+
     elif input_job.get('downloadjob') == True:
         dl_job = input_job['downloadjob_details']
         provided_url = dl_job['url']
@@ -237,6 +407,13 @@ def lambda_handler(event, context):
         provided_recursivelevel = dl_job['recursivelevel']
         provided_forceipver = dl_job['forceipver']
         provided_wgetmode = dl_job['wgetmode']
+        # Optional quotas. Missing means the deployment default which is also the ceiling.
+        provided_maxbytes = dl_job.get('maxbytes') or JOB_MAX_BYTES
+        provided_maxfiles = dl_job.get('maxfiles') or JOB_MAX_FILES
+        provided_maxseconds = dl_job.get('maxseconds') or JOB_MAX_SECONDS
+        provided_engine = dl_job.get('engine') or "wget"
+        provided_basejob = dl_job.get('basejob') # optional job id of an earlier job in this region to recrawl incrementally
+        provided_shards = dl_job.get('shards') # optional number of workers a recursive crawl is split across
 
         # Input Validation for job
         if provided_recursivelevel: # only exists with recursive job otherwise None
@@ -246,12 +423,36 @@ def lambda_handler(event, context):
         if provided_wgetmode != "singlepage" and provided_wgetmode != "recursive":
             msg = "ERROR: Mode must be singlepage or recursive"
 
+        if provided_engine != "wget" and provided_engine != "crawler":
+            msg = "ERROR: Engine must be wget or crawler"
+
         if provided_forceipver != "ipv4" and provided_forceipver != "ipv6":
             msg = "ERROR: Force ip version must be ipv4 of ipv6"
 
+        for quota, ceiling in ((provided_maxbytes, JOB_MAX_BYTES), (provided_maxfiles, JOB_MAX_FILES), (provided_maxseconds, JOB_MAX_SECONDS)):
+            if not str(quota).isdigit() or int(quota) < 1 or int(quota) > ceiling:
+                msg = f"ERROR: Quotas must be whole numbers between 1 and the deployment limits (bytes {JOB_MAX_BYTES}, files {JOB_MAX_FILES}, seconds {JOB_MAX_SECONDS})"
+
         if provided_useragent not in user_agent.keys():
             msg = "ERROR: Non-supported user-agent provided"
 
+        if provided_basejob:
+            if not re.fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', str(provided_basejob)):
+                msg = "ERROR: Base job must be a job id"
+            else:
+                try: # the worker needs the manifest the base job uploaded
+                    s3_client.head_object(Bucket=AWS_S3_BUCKET_NAME, Key=provided_basejob + '-' + AWS_REGION + '.manifest.json.gz') # Must match server_application.py
+                except ClientError:
+                    msg = "ERROR: Base job not found in this region or it has no manifest"
+
+        if provided_shards:
+            if not str(provided_shards).isdigit() or int(provided_shards) < 2 or int(provided_shards) > JOB_MAX_SHARDS:
+                msg = f"ERROR: Shards must be a whole number between 2 and {JOB_MAX_SHARDS}"
+            elif provided_wgetmode != "recursive" or provided_engine != "crawler" or not str(provided_recursivelevel).isdigit() or int(provided_recursivelevel) < 2:
+                msg = "ERROR: Sharding needs a recursive job with the crawler engine and a recursive level of at least 2"
+            elif provided_basejob:
+                msg = "ERROR: A sharded job cannot be an incremental recrawl"
+
         urlcheck = urlparse(provided_url) # validate URL
         if not all([urlcheck.scheme, urlcheck.netloc]):
             msg = "ERROR: URL did not validate. E.g. must start with http:// or https://"
@@ -273,22 +474,36 @@ def lambda_handler(event, context):
                                   input_useragent=user_agent[provided_useragent], # Custom UA mapping
                                   input_recursivelevel=provided_recursivelevel,
                                   input_forceipver=provided_forceipver,
-                                  input_wgetmode=provided_wgetmode
+                                  input_wgetmode=provided_wgetmode,
+                                  input_maxbytes=int(provided_maxbytes),
+                                  input_maxfiles=int(provided_maxfiles),
+                                  input_maxseconds=int(provided_maxseconds),
+                                  input_engine=provided_engine,
+                                  input_basejob=provided_basejob + '-' + AWS_REGION if provided_basejob else None,
+                                  input_shards=int(provided_shards) if provided_shards else None
                                  )
 
+                # Job status is queued until the EC2 worker receives the job
+                put_job_status(sqs_job, 'queued')
+
                 # Start up EC2 instance
                 start_ec2_instance()
 
                 # Create pre-signed S3 URL so user can download file. Must match format of filename in server_application.py
                 s3filename = sqs_job + '-' + AWS_REGION + '.tar.gz' # file does not have to exist in S3 when created url created. It will provide access when file is created.
                 presigned_url = create_presigned_url(AWS_S3_BUCKET_NAME, s3filename)
+                connection_summary_filename = sqs_job + '-' + AWS_REGION + '.proxy_log.csv.gz' # sidecar with proxy.log summary. Must match server_application.py
+                connection_summary_url = create_presigned_url(AWS_S3_BUCKET_NAME, connection_summary_filename)
                 #import urllib3
                 #http = urllib3.PoolManager()
                 #r = http.request('GET', presigned_url)
 
                 outputdict['status'] = "success"
+                outputdict['jobid'] = sqs_job
                 outputdict['url'] = presigned_url
                 outputdict['filename'] = s3filename
+                outputdict['proxylog_url'] = connection_summary_url
+                outputdict['proxylog_filename'] = connection_summary_filename
                 #outputdict['extra']= str(r.data)
             except Exception as e:
                 outputdict['status'] = "failure"
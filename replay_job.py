@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+# Built in Python 3.8
+__author__ = "Kemp Langhorne"
+__copyright__ = "Copyright (C) 2021 AskKemp.com"
+__license__ = "agpl-3.0"
+
+# Re-runs the post-processing stages of server_application.py (certificate transform, connection summary,
+# network timing, size walk, compression, upload) on a job directory and measures them. The job directory is an extracted job
+# archive, a job tar.gz or a synthetic job generated with chosen sizes. The upload goes to a local moto S3 server
+# or any S3 endpoint. Comparing a run against a saved report makes it a regression gate for compression and
+# upload changes. Keeping the output re-processes old jobs into the current archive format.
+#
+# Example:
+#   $ python3 replay_job.py --synthetic --small-files 5000 --pcap-mb 200 --certificates 50 --repeat 3 --report baseline.json
+#   $ python3 replay_job.py --synthetic --small-files 5000 --pcap-mb 200 --certificates 50 --repeat 3 --baseline baseline.json
+#   $ python3 replay_job.py --job ./old-job/ --stages certificate_transform connection_summary compress --output ./reprocessed/
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import resource # CPU and memory of each stage
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+import job_artifacts # the stages themselves
+import dns_resolver # name of the DNS record of a job
+
+#
+# REPLAY CONFIGURATION SECTION
+#
+STAGES = ('certificate_transform', 'connection_summary', 'network_timing', 'size_walk', 'compress', 'upload') # order of server_application.py
+REPLAY_BUCKET = "website-downloader-replay"
+REPLAY_REGION = "us-east-1"
+REGRESSION_FLOOR = 0.05 # seconds. Slowdowns below this are treated as noise by the regression gate.
+SYNTHETIC_WORDS = ("html", "body", "div", "class", "script", "function", "return", "var", "href", "src", "style", "span", "table", "width", "height")
+
+#
+# Script Starts Below
+#
+
+def synthetic_job(job_root, small_files, small_file_bytes, pcap_mb, certificates, connections, seed=0):
+    """
+    Creates a job directory with the layout of server_install.sh and server_application.py
+
+    Args:
+        job_root (Path): directory to create
+        small_files (int): files below wget_saved/, text like so they compress like web content
+        small_file_bytes (int): size of each small file
+        pcap_mb (int): size of proxy.pcap. Random payloads so it does not compress, like TLS heavy traffic.
+        certificates (int): internet-side certificates in debug/certificates/ named by their SHA1 fingerprint
+        connections (int): lines in proxy.log and connections in proxy.pcap
+        seed (int): seed of the file contents so runs are comparable
+    Returns:
+        None
+    """
+    rng = random.Random(seed)
+    for directory in ("debug/certificates", "certificates", "proxy_streams", "wget_saved"):
+        (job_root / directory).mkdir(parents=True, exist_ok=True)
+
+    for number in range(small_files):
+        path = job_root / "wget_saved" / f"site{number % 10}.example.com" / f"dir{number % 100}" / f"file{number}.html"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        text = " ".join(rng.choice(SYNTHETIC_WORDS) for _ in range(small_file_bytes // 5 + 1))
+        path.write_text(text[:small_file_bytes])
+
+    write_synthetic_pcap(job_root / "proxy.pcap", pcap_mb, connections, rng)
+
+    fingerprints = []
+    if certificates:
+        key_path = job_root / "debug" / "synthetic_key.pem"
+        subprocess.run(["openssl", "genrsa", "-out", str(key_path), "2048"], check=True, capture_output=True)
+        for number in range(certificates):
+            pem = subprocess.run(["openssl", "req", "-new", "-x509", "-key", str(key_path), "-days", "1", "-set_serial", str(number + 1),
+                                  "-subj", f"/CN=site{number}.example.com"], check=True, capture_output=True).stdout
+            der = base64.b64decode(b"".join(pem.split(b"-----")[2].split()))
+            fingerprint = hashlib.sha1(der).hexdigest().upper()
+            (job_root / "debug" / "certificates" / (fingerprint + ".crt")).write_bytes(pem)
+            fingerprints.append(fingerprint)
+        key_path.unlink()
+
+    with open(job_root / "proxy.log", "w") as log_f:
+        for number in range(connections):
+            host = f"site{number % 10}.example.com"
+            fingerprint = fingerprints[number % len(fingerprints)] if fingerprints else "-"
+            log_f.write(f"2021-05-02 17:{number // 3600 % 60:02d}:{number // 60 % 60:02d} UTC https [10.0.0.5]:{30000 + number % 30000} [93.184.216.{number % 250}]:443 "
+                        f"sni:{host} names:{host} sproto:TLSv1.2:ECDHE-RSA-AES128-GCM-SHA256 dproto:TLSv1.2:ECDHE-RSA-AES128-GCM-SHA256 origcrt:{fingerprint} usedcrt:- "
+                        f"{host} GET /dir{number % 100}/file{number}.html 200 {small_file_bytes}\n")
+    return
+
+def write_synthetic_pcap(path, pcap_mb, connections, rng):
+    """
+    Writes a pcap like SSLsplit does: a handshake, a request and the response of each connection of the synthetic
+    proxy.log, then FIN. The responses share pcap_mb equally.
+
+    Args:
+        path (Path): proxy.pcap to write
+        pcap_mb (int): size of the responses together
+        connections (int): connections. At least one is written.
+        rng (random.Random): source of the packet times
+    Returns:
+        None
+    """
+    started = 1619974800.0 # 2021-05-02 17:00:00 UTC like proxy.log
+    response_bytes = (pcap_mb << 20) // max(1, connections)
+    with open(path, "wb") as pcap_f:
+        pcap_f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)) # Ethernet
+        for number in range(max(1, connections)):
+            client, server = (bytes([10, 0, 0, 5]), 30000 + number % 30000), (bytes([93, 184, 216, number % 250]), 443)
+            now = started + number
+
+            def packet(sender, receiver, flags, payload=b""):
+                tcp = struct.pack("!HHIIBBHHH", sender[1], receiver[1], 0, 0, 5 << 4, flags, 65535, 0, 0)
+                ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 40 + len(payload), 0, 0, 64, 6, 0, sender[0], receiver[0])
+                frame = b"\x00" * 12 + b"\x08\x00" + ip + tcp + payload
+                pcap_f.write(struct.pack("<IIII", int(now), int(now % 1 * 1e6), len(frame), len(frame)) + frame)
+
+            packet(client, server, 0x02)
+            packet(server, client, 0x12)
+            packet(client, server, 0x10)
+            packet(client, server, 0x18, os.urandom(300))
+            now += rng.uniform(0.02, 0.2) # time to first byte
+            remaining = response_bytes
+            while remaining > 0:
+                packet(server, client, 0x18, os.urandom(min(1400, remaining)))
+                remaining -= 1400
+                now += 0.0001
+            packet(client, server, 0x11)
+            packet(server, client, 0x11)
+    return
+
+def prepare_job(source, work_dir):
+    """
+    Copies or extracts the job to replay so the source is never changed
+
+    Args:
+        source (Path): job directory or job tar.gz
+        work_dir (Path): empty directory
+    Returns:
+        Path of the job directory within work_dir
+    """
+    if source.is_file():
+        with tarfile.open(source, mode='r:gz') as archive:
+            archive.extractall(work_dir)
+        entries = [entry for entry in work_dir.iterdir() if entry.is_dir()]
+        if len(entries) != 1:
+            raise ValueError(f"{source} does not contain a single job directory")
+        return entries[0]
+    job_root = work_dir / source.name
+    shutil.copytree(source, job_root, symlinks=True)
+    return job_root
+
+def measure(function, *args):
+    """
+    Runs a stage and measures it
+
+    Returns:
+        tuple (return value, dict with wall_seconds, cpu_seconds and peak_rss_mb). CPU includes child processes such
+        as openssl. Peak RSS is the high-water mark of this process and its children so far, so it only isolates a
+        stage when it is run alone with --stages.
+    """
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+    result = function(*args)
+    wall = time.monotonic() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (self_after.ru_utime - self_before.ru_utime + self_after.ru_stime - self_before.ru_stime
+           + children_after.ru_utime - children_before.ru_utime + children_after.ru_stime - children_before.ru_stime)
+    return result, {'wall_seconds': wall, 'cpu_seconds': cpu, 'peak_rss_mb': max(self_after.ru_maxrss, children_after.ru_maxrss) / 1024}
+
+def start_s3(endpoint_url):
+    """
+    Creates the S3 client of the upload stage. Without an endpoint a local moto server is started.
+
+    Returns:
+        tuple (s3 client, moto server or None) or (None, None) when there is no S3 to upload to
+    """
+    from boto3.session import Session
+    moto_server = None
+    if not endpoint_url:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            return None, None
+        import logging
+        import socket
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        moto_server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        moto_server.start()
+        endpoint_url = f"http://127.0.0.1:{port}"
+        session = Session(aws_access_key_id='replay', aws_secret_access_key='replay', region_name=REPLAY_REGION) # never real credentials against moto
+    else:
+        session = Session(region_name=REPLAY_REGION)
+    s3_client = session.client('s3', endpoint_url=endpoint_url)
+    try:
+        s3_client.create_bucket(Bucket=REPLAY_BUCKET)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    return s3_client, moto_server
+
+def replay(job_root, stages, s3_client):
+    """
+    Runs the selected post-processing stages on a job directory the way server_application.py does
+
+    Args:
+        job_root (Path): job directory. Changed in place.
+        stages (list): names from STAGES
+        s3_client: boto3 S3 client or None to skip the upload
+    Returns:
+        dict stage name -> measurements including bytes and mb_per_second of the data the stage processed
+    """
+    job_name = job_root.name
+    archive_path = job_root / (job_name + ".tar.gz") # inside job_root like on the worker
+    summary_path = job_root / job_artifacts.CONNECTION_SUMMARY_NAME
+    results = {}
+
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if stage == 'certificate_transform':
+            processed = job_artifacts.directory_usage(job_root / "debug" / "certificates")[0]
+            (job_root / "certificates").mkdir(exist_ok=True)
+            value, metrics = measure(job_artifacts.transform_certificates, str(job_root / "debug" / "certificates"), str(job_root / "certificates"))
+            metrics['items'] = value[0]
+        elif stage == 'connection_summary':
+            if not (job_root / "proxy.log").is_file():
+                continue
+            processed = (job_root / "proxy.log").stat().st_size
+            value, metrics = measure(job_artifacts.write_connection_summary, str(job_root / "proxy.log"), str(summary_path))
+            metrics['items'] = value
+        elif stage == 'network_timing':
+            if not (job_root / "proxy.pcap").is_file():
+                continue
+            processed = (job_root / "proxy.pcap").stat().st_size
+            value, metrics = measure(job_artifacts.write_network_timings, str(job_root / "proxy.pcap"), str(job_root / "proxy.log"), str(job_root / dns_resolver.DNS_RECORD_NAME), str(job_root))
+            metrics['items'] = value
+        elif stage == 'size_walk':
+            value, metrics = measure(job_artifacts.directory_usage, str(job_root))
+            processed, metrics['items'] = value
+        elif stage == 'compress':
+            processed = job_artifacts.directory_usage(job_root)[0]
+            value, metrics = measure(job_artifacts.write_job_archive, str(job_root), str(archive_path), job_name)
+            metrics['archive_bytes'] = value
+            metrics['ratio'] = round(value / processed, 3) if processed else None
+        elif stage == 'upload':
+            if not s3_client or not archive_path.is_file():
+                continue
+            def upload():
+                if summary_path.is_file(): # sidecar first like the worker
+                    s3_client.upload_file(str(summary_path), REPLAY_BUCKET, job_name + job_artifacts.CONNECTION_SUMMARY_SUFFIX)
+                s3_client.upload_file(str(archive_path), REPLAY_BUCKET, job_name + ".tar.gz")
+            processed = archive_path.stat().st_size + (summary_path.stat().st_size if summary_path.is_file() else 0)
+            value, metrics = measure(upload)
+        metrics['bytes'] = processed
+        metrics['mb_per_second'] = round(processed / (1 << 20) / metrics['wall_seconds'], 2) if metrics['wall_seconds'] else None
+        results[stage] = metrics
+    return results
+
+def combine_runs(runs):
+    """Median of every measurement over the repeated runs"""
+    combined = {}
+    for stage in STAGES:
+        measured = [run[stage] for run in runs if stage in run]
+        if measured:
+            combined[stage] = {key: round(statistics.median(m[key] for m in measured), 3) if measured[0][key] is not None else None for key in measured[0]}
+    return combined
+
+def print_results(results):
+    """Prints the stage measurements as a table"""
+    print("{:<22} {:>10} {:>10} {:>10} {:>12} {:>10}".format("STAGE", "wall s", "cpu s", "MB/s", "MB", "peak RSS"))
+    for stage, m in results.items():
+        print("{:<22} {:>10.3f} {:>10.3f} {:>10} {:>12.1f} {:>9.0f}M".format(stage, m['wall_seconds'], m['cpu_seconds'], m['mb_per_second'] if m['mb_per_second'] is not None else '-', m['bytes'] / (1 << 20), m['peak_rss_mb']))
+    if 'compress' in results:
+        print(f"* Archive: {results['compress']['archive_bytes'] / (1 << 20):.1f}MB ratio {results['compress']['ratio']}")
+    return
+
+def find_regressions(results, input_bytes, baseline, tolerance):
+    """
+    Compares the stage wall times with a saved report
+
+    Args:
+        results (dict): stage measurements of this run
+        input_bytes (int): size of the job replayed
+        baseline (dict): report written with --report
+        tolerance (float): allowed slowdown in percent
+    Returns:
+        list of str describing each regression
+    """
+    regressions = []
+    for stage, m in results.items():
+        before = baseline.get('stages', {}).get(stage)
+        if not before:
+            continue
+        allowed = before['wall_seconds'] * (1 + tolerance / 100)
+        if m['wall_seconds'] > allowed and m['wall_seconds'] - before['wall_seconds'] > REGRESSION_FLOOR:
+            regressions.append(f"{stage}: {m['wall_seconds']:.3f}s vs baseline {before['wall_seconds']:.3f}s (+{(m['wall_seconds'] / before['wall_seconds'] - 1) * 100:.0f}%)")
+    if baseline.get('input', {}).get('bytes') not in (None, input_bytes):
+        regressions.append("Note: the job replayed is not the same size as the baseline job")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='\
+Re-runs the post-processing stages of server_application.py (certificate transform, connection summary, size walk,\n\
+compression, upload) on an existing or synthetic job and reports wall time, CPU time, throughput and peak memory\n\
+of each stage. The upload goes to a local moto S3 server unless --s3-endpoint is provided.\n\
+\n\
+Examples:\n\
+    Save a baseline and later fail when a stage got more than 10%% slower:\n\
+        $ %(prog)s --synthetic --small-files 5000 --pcap-mb 200 --certificates 50 --repeat 3 --report baseline.json\n\
+        $ %(prog)s --synthetic --small-files 5000 --pcap-mb 200 --certificates 50 --repeat 3 --baseline baseline.json\n\
+\n\
+    Re-process an old extracted job into the current archive format:\n\
+        $ %(prog)s --job ./33fbce02-20e6-4120-b955-c79cc4126c0e-eu-west-1/ --stages certificate_transform connection_summary compress --output ./reprocessed/\n\
+')
+
+    groupA = parser.add_argument_group("Job Input")
+    groupA.add_argument('--job', dest='in_job', metavar='<path>', help='Job directory (e.g. an extracted job archive) or job tar.gz to replay. It is copied first and never changed.')
+    groupA.add_argument('--synthetic', dest='in_synthetic', action='store_true', help='Generate a synthetic job instead')
+    groupA.add_argument('--small-files', dest='in_smallfiles', type=int, default=2000, metavar='<count>', help='Use with --synthetic. Downloaded files. Default: 2000')
+    groupA.add_argument('--small-file-bytes', dest='in_smallfilebytes', type=int, default=8192, metavar='<bytes>', help='Use with --synthetic. Size of each downloaded file. Default: 8192')
+    groupA.add_argument('--pcap-mb', dest='in_pcapmb', type=int, default=50, metavar='<MB>', help='Use with --synthetic. Size of proxy.pcap. Default: 50')
+    groupA.add_argument('--certificates', dest='in_certificates', type=int, default=20, metavar='<count>', help='Use with --synthetic. Captured server certificates. Default: 20')
+    groupA.add_argument('--connections', dest='in_connections', type=int, default=2000, metavar='<count>', help='Use with --synthetic. Lines in proxy.log. Default: 2000')
+
+    groupB = parser.add_argument_group("Replay Options")
+    groupB.add_argument('--stages', dest='in_stages', nargs='+', choices=STAGES, default=list(STAGES), metavar='<stage>', help=f'Stages to run. Default: all of {", ".join(STAGES)}')
+    groupB.add_argument('--repeat', dest='in_repeat', type=int, default=1, metavar='<count>', help='Run the stages this many times on fresh copies and report the median. Default: 1')
+    groupB.add_argument('--s3-endpoint', dest='in_s3endpoint', metavar='<url>', help='S3 endpoint of the upload stage e.g. http://127.0.0.1:9000. Default: a local moto server')
+    groupB.add_argument('--workdir', dest='in_workdir', metavar='<path>', help='Where the job copies are made. Default: system temp directory')
+
+    groupC = parser.add_argument_group("Output")
+    groupC.add_argument('--report', dest='in_report', metavar='<path>', help='Write the results as JSON e.g. as a baseline')
+    groupC.add_argument('--baseline', dest='in_baseline', metavar='<path>', help='Report of an earlier run. Exit code 1 when a stage got slower than --tolerance.')
+    groupC.add_argument('--tolerance', dest='in_tolerance', type=float, default=10.0, metavar='<percent>', help='Use with --baseline. Default: 10')
+    groupC.add_argument('--output', dest='in_output', metavar='<path>', help='Keep the produced tar.gz and connection summary in this directory')
+
+    args = parser.parse_args()
+
+    if bool(args.in_job) == args.in_synthetic:
+        parser.error("Provide either --job or --synthetic")
+    if args.in_job and not Path(args.in_job).exists():
+        parser.error(f"{args.in_job} does not exist")
+    if args.in_repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if 'certificate_transform' in args.in_stages and not shutil.which("openssl"):
+        parser.error("openssl is required for the certificate_transform stage")
+
+    work_dir = Path(tempfile.mkdtemp(prefix="website-downloader-replay-", dir=args.in_workdir))
+    try:
+        if args.in_synthetic:
+            source = work_dir / "source" / "synthetic-job"
+            print(f"* Generating synthetic job: {args.in_smallfiles} files of {args.in_smallfilebytes} bytes, {args.in_pcapmb}MB pcap, {args.in_certificates} certificates, {args.in_connections} connections")
+            synthetic_job(source, args.in_smallfiles, args.in_smallfilebytes, args.in_pcapmb, args.in_certificates, args.in_connections)
+        else:
+            source = Path(args.in_job)
+        input_bytes, input_files = job_artifacts.directory_usage(source) if source.is_dir() else (source.stat().st_size, 1)
+        print(f"* Replaying {source} ({input_bytes / (1 << 20):.1f}MB, {input_files} files) {args.in_repeat} time(s)")
+
+        s3_client, moto_server = (None, None)
+        if 'upload' in args.in_stages:
+            s3_client, moto_server = start_s3(args.in_s3endpoint)
+            if not s3_client:
+                print("* Skipping upload: install moto[server] or provide --s3-endpoint")
+
+        runs = []
+        for run in range(args.in_repeat):
+            run_dir = work_dir / f"run{run}"
+            run_dir.mkdir()
+            job_root = prepare_job(source, run_dir) # not measured
+            runs.append(replay(job_root, args.in_stages, s3_client))
+            if args.in_output and run == args.in_repeat - 1:
+                Path(args.in_output).mkdir(parents=True, exist_ok=True)
+                for produced in (job_root / (job_root.name + ".tar.gz"), job_root / job_artifacts.CONNECTION_SUMMARY_NAME):
+                    if produced.is_file():
+                        target = Path(args.in_output) / (job_root.name + job_artifacts.CONNECTION_SUMMARY_SUFFIX if produced.name == job_artifacts.CONNECTION_SUMMARY_NAME else produced.name)
+                        shutil.move(str(produced), str(target))
+                        print(f"* Written: {target}")
+            shutil.rmtree(run_dir, ignore_errors=True)
+        if moto_server:
+            moto_server.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = combine_runs(runs)
+    print_results(results)
+
+    report = {'input': {'source': 'synthetic' if args.in_synthetic else str(args.in_job), 'bytes': input_bytes, 'files': input_files,
+                        'synthetic': {'small_files': args.in_smallfiles, 'small_file_bytes': args.in_smallfilebytes, 'pcap_mb': args.in_pcapmb,
+                                      'certificates': args.in_certificates, 'connections': args.in_connections} if args.in_synthetic else None},
+              'repeat': args.in_repeat,
+              'stages': results}
+    if args.in_report:
+        with open(args.in_report, "w") as report_f:
+            json.dump(report, report_f, indent=1)
+        print(f"* Report written to: {args.in_report}")
+
+    if args.in_baseline:
+        with open(args.in_baseline) as baseline_f:
+            regressions = find_regressions(results, input_bytes, json.load(baseline_f), args.in_tolerance)
+        failed = [regression for regression in regressions if not regression.startswith("Note:")]
+        for regression in regressions:
+            print(f"* {'REGRESSION ' if regression in failed else ''}{regression}")
+        if failed:
+            sys.exit(1)
+        print(f"* No stage is more than {args.in_tolerance}% slower than the baseline")
+
+if __name__ == "__main__":
+    main()
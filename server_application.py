@@ -8,32 +8,316 @@ import subprocess
 import logging
 import json
 #import argparse
-import tarfile
 from pathlib import Path
 #import boto3
 from botocore.exceptions import ClientError
 from boto3.session import Session
 from watchtower import CloudWatchLogHandler
 from ec2_metadata import ec2_metadata, NetworkInterface
+from collections import namedtuple # instance metadata snapshot
+from concurrent.futures import ThreadPoolExecutor # concurrent instance metadata requests and proxy wait
 from urllib.parse import urlparse # url validation
 import os # for environment variable access and file size collection
+import re # base job validation
+import shutil # discarding a failed incremental seed
+import hashlib # keys of URLs claimed by the shards of a sharded job
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # URL claim service for the crawler of a shard
+import threading # crawl quota monitor
+import csv # resource samples
+import tempfile # crawl checkpoint segments
+import time
+import job_artifacts # proxy.log connection summary and post-processing stages
+import dns_resolver # caching and recording resolver of the crawl
 
 #
 # DYNAMIC CONFIGURATION SECTION
 #
 AWS_CLOUDWATCH_LOG_GROUP = os.environ['ENV_CLOUDWATCH_LOG_GROUP']
-AWS_CLOUDWATCH_LOG_STREAM = f'{ec2_metadata.instance_id}-{ec2_metadata.region}' # e.g. i-0d4276fc8ab7dee65-eu-west-1
 #AWS_SQS_QUEUE_NAME = "website_downloader_jobs"
 AWS_SQS_URL = os.environ['ENV_SQS_URL']
 AWS_S3_BUCKET_NAME = os.environ['ENV_S3_BUCKET_NAME']
+AWS_AUTOSCALEGROUP_NAME = os.environ.get('ENV_AUTOSCALEGROUP_NAME') # scaled out by the coordinator of a sharded job for its shards
+PROXY_READY_TIMEOUT = 90 # seconds SSLsplit is given to come up after boot before the instance gives up
+PROXY_READY_INTERVAL = 0.5 # seconds between checks whether SSLsplit is up
+QUOTA_CHECK_INTERVAL = 5 # seconds between checks of the crawl output against the job quotas
+QUOTA_STOP_GRACE = 30 # seconds wget is given to exit after being asked to stop
+CRAWLER_PATH = os.environ.get('ENV_CRAWLER_PATH', "/usr/local/bin/website_crawler.py") # crawler.py installed by server_install.sh where proxy_client can read it
+JOB_ROOT = os.environ.get('ENV_JOB_ROOT', "/website_download/") # created by server_install.sh. Must end in /. Overridden by simulate.py.
+DNS_RESOLVER_PORT = int(os.environ.get('ENV_DNS_RESOLVER_PORT', 5353)) # DNS of proxy_client is redirected here by server_install.sh. Overridden by simulate.py.
+WORKSPACE_RAM_MB = int(os.environ.get('ENV_WORKSPACE_RAM_MB', 0)) # RAM a job may use as workspace before it moves to disk. 0 keeps every job on disk.
+WORKSPACE_RAM_PATH = os.environ.get('ENV_WORKSPACE_RAM_PATH', "/website_download_ram/") # tmpfs mounted by server_install.sh. Must end in /.
+WORKSPACE_DISK_PATH = os.environ.get('ENV_WORKSPACE_DISK_PATH', "/website_download_disk/") # target of the JOB_ROOT symlink unless a job runs in RAM. Must end in /.
+WORKSPACE_RAM_SHARE = 0.5 # share of the available memory a workspace may use at most. wget, SSLsplit and compression need the rest.
+WORKSPACE_OVERHEAD = 3 # workspace bytes per downloaded byte. The files, the pcap and the streams of SSLsplit.
+CHECKPOINT_INTERVAL = int(os.environ.get('ENV_CHECKPOINT_INTERVAL', 300)) # seconds between crawl checkpoints of recursive jobs uploaded to S3. 0 disables them. Overridden by simulate.py.
+ARCHIVE_PIPELINE = os.environ.get('ENV_ARCHIVE_PIPELINE', "1") == "1" # compress and hash the downloaded files while the crawl runs. Jobs in RAM and incremental jobs are archived after the crawl.
+METRICS_NAMESPACE = "WebsiteDownloader" # CloudWatch namespace of the job metrics
+SQS_BOOT_GRACE = int(os.environ.get('ENV_SQS_BOOT_GRACE', 120)) # seconds to keep polling an empty queue after boot before shutting down
+SQS_WAIT_SECONDS = 20 # long polling. Maximum allowed by SQS.
+SQS_VISIBILITY_TIMEOUT = int(os.environ.get('ENV_SQS_VISIBILITY_TIMEOUT', 300)) # seconds a job stays leased without a heartbeat. A crashed worker's job is retried after this. Overridden by simulate.py.
+SQS_HEARTBEAT_INTERVAL = SQS_VISIBILITY_TIMEOUT // 5 # seconds between visibility timeout extensions
+SQS_STALL_TIMEOUT = 1800 # seconds without any job progress after which the lease is no longer extended
+SQS_MAX_RECEIVES = 3 # a job received more often than this is dropped as it keeps killing workers
+RESOURCE_SAMPLE_INTERVAL = 2 # seconds between samples of the resource use of the instance
+STATUS_PUBLISH_INTERVAL = 15 # minimum seconds between job status progress updates within the same state
+JOB_CLAIM_ATTEMPTS = 3 # reads and conditional writes of the job status record before a job whose record keeps changing is left to SQS
+SHARDS_MAX = 10 # ceiling of the shards of a sharded recursive job. Must match lambda_function.py
 
 
 #
 # START SCRIPT
 # 
 
+class JobTimer:
+    """Times the phases of the job, which run one after another, with a monotonic clock"""
+
+    def __init__(self):
+        self.timings = {} # phase name -> seconds, in the order the phases ran
+        self.marks = {} # startup timeline. Point of the worker startup -> seconds since the instance booted.
+        self.phase = None
+        self._started = None
+        self.last_activity = time.monotonic() # progress of the job as seen by the SQS heartbeat
+        try:
+            with open("/proc/self/stat") as stat_f: # start time of this process in clock ticks since boot is field 22
+                self.marks['process_start'] = round(int(stat_f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK'), 3)
+        except (OSError, ValueError, IndexError):
+            pass
+
+    def begin(self, phase):
+        """Ends the running phase and starts the next one"""
+        self.end()
+        self.phase, self._started = phase, time.monotonic()
+        self.touch()
+
+    def mark(self, name):
+        """Records a point of the worker startup. Boot time includes the install of a freshly launched instance."""
+        self.marks[name] = round(time.clock_gettime(time.CLOCK_BOOTTIME), 3)
+
+    def touch(self):
+        """Records that the running phase made progress"""
+        self.last_activity = time.monotonic()
+
+    def end(self):
+        """Ends the running phase if there is one"""
+        if self.phase:
+            self.timings[self.phase] = round(time.monotonic() - self._started, 3)
+            self.phase = None
+
+job_timer = JobTimer()
+job_timer.mark('imported')
+job_timer.begin('startup')
+
+def wait_for_proxy(timeout):
+    """
+    Waits for SSLsplit to run. It is started by the same boot so it may still be coming up when this script starts.
+
+    Args:
+        timeout (int): seconds to wait at most
+    Returns:
+        bool, True once SSLsplit runs
+    """
+    deadline = time.monotonic() + timeout
+    while subprocess.run(["systemctl", "is-active", "--quiet", "sslsplit"]).returncode != 0:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(PROXY_READY_INTERVAL)
+    job_timer.mark('proxy_ready')
+    return True
+
+InstanceMetadata = namedtuple('InstanceMetadata', ['instance_id', 'region', 'instance_type', 'mac', 'public_ipv4', 'private_ipv4', 'ipv6s'])
+
+def fetch_instance_metadata(executor):
+    """
+    Reads everything this script uses from the EC2 instance metadata service once.
+    Every value is a request to the service so they are made concurrently. The identity document holds the
+    instance id, region, type and private IPv4 in one request. The network values are only logged so they may fail.
+
+    Args:
+        executor (ThreadPoolExecutor): makes the requests
+    Returns:
+        InstanceMetadata
+    """
+    def interface():
+        mac = ec2_metadata.mac
+        return mac, NetworkInterface(mac).ipv6s
+
+    document = executor.submit(lambda: ec2_metadata.instance_identity_document)
+    network = executor.submit(interface)
+    public_ipv4 = executor.submit(lambda: ec2_metadata.public_ipv4)
+    document = document.result()
+    try:
+        mac, ipv6s = network.result()
+    except Exception:
+        mac, ipv6s = None, []
+    try:
+        public_ipv4 = public_ipv4.result()
+    except Exception:
+        public_ipv4 = None
+    return InstanceMetadata(instance_id=document['instanceId'], region=document['region'], instance_type=document['instanceType'],
+                            mac=mac, public_ipv4=public_ipv4, private_ipv4=document.get('privateIp'), ipv6s=ipv6s)
+
+# The proxy is waited for while the rest of the startup runs
+startup_executor = ThreadPoolExecutor(max_workers=4)
+proxy_ready = startup_executor.submit(wait_for_proxy, PROXY_READY_TIMEOUT)
+instance_metadata = fetch_instance_metadata(startup_executor) # never changes for the life of the instance
+job_timer.mark('metadata')
+
+class ResourceSampler:
+    """
+    Samples the resource use of the instance in a thread for the whole job so it shows whether a job is CPU, memory,
+    disk or network bound. Steal time shows CPU credits of a burstable instance running out. Every sample is labelled
+    with the phase job_timer is in. Rates are per second over the interval.
+    """
+    COLUMNS = ('seconds', 'phase', 'cpu_user_pct', 'cpu_system_pct', 'cpu_iowait_pct', 'cpu_steal_pct',
+               'mem_available_mb', 'swap_used_mb', 'swap_pages_ps', 'rss_wget_mb', 'rss_sslsplit_mb', 'rss_python_mb',
+               'disk_read_kbps', 'disk_write_kbps', 'net_rx_kbps', 'net_tx_kbps', 'free_mb')
+    PEAK_COLUMNS = ('cpu_user_pct', 'cpu_system_pct', 'cpu_iowait_pct', 'cpu_steal_pct', 'swap_pages_ps',
+                    'disk_read_kbps', 'disk_write_kbps', 'net_rx_kbps', 'net_tx_kbps') # phase with the highest mean is reported
+
+    def __init__(self, interval, path):
+        self.interval = interval
+        self.path = path # free space is taken of the file system holding it
+        self.samples = []
+        self.started = time.monotonic()
+        self.disks = [disk for disk in os.listdir("/sys/block") if not disk.startswith(("loop", "ram"))] if os.path.isdir("/sys/block") else []
+        self.first = self.previous = None # counters when sampling started and of the last sample
+        self.previous_time = None
+
+    def counters(self):
+        """Cumulative CPU jiffies, swap pages, disk sectors and network bytes of the instance"""
+        with open("/proc/stat") as stat_f:
+            cpu = [int(value) for value in stat_f.readline().split()[1:9]] # user nice system idle iowait irq softirq steal
+        swap = 0
+        with open("/proc/vmstat") as vmstat_f:
+            for line in vmstat_f:
+                name, value = line.split()
+                if name in ("pswpin", "pswpout"):
+                    swap += int(value)
+        sectors = [0, 0]
+        with open("/proc/diskstats") as diskstats_f:
+            for line in diskstats_f:
+                fields = line.split()
+                if fields[2] in self.disks:
+                    sectors[0] += int(fields[5])
+                    sectors[1] += int(fields[9])
+        network = [0, 0]
+        with open("/proc/net/dev") as net_f:
+            for line in net_f.readlines()[2:]:
+                interface, fields = line.split(":", 1)
+                fields = fields.split()
+                if interface.strip() != "lo":
+                    network[0] += int(fields[0])
+                    network[1] += int(fields[8])
+        return {'cpu': cpu, 'swap': swap, 'sectors': sectors, 'network': network}
+
+    @staticmethod
+    def process_rss_mb():
+        """RSS of wget, SSLsplit and Python processes (the worker and the crawler) in MB"""
+        rss = {'wget': 0, 'sslsplit': 0, 'python': 0}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/status") as status_f:
+                    status = dict(line.split(":", 1) for line in status_f if ":" in line)
+            except OSError: # exited meanwhile
+                continue
+            name = status.get('Name', '').strip()
+            group = 'python' if name.startswith('python') else name
+            if group in rss and 'VmRSS' in status:
+                rss[group] += int(status['VmRSS'].split()[0])
+        return {group: round(kb / 1024, 1) for group, kb in rss.items()}
+
+    def sample(self):
+        """Takes one sample"""
+        now = time.monotonic()
+        current = self.counters()
+        elapsed = max(now - self.previous_time, 0.001)
+        cpu = [after - before for after, before in zip(current['cpu'], self.previous['cpu'])]
+        cpu_total = max(sum(cpu), 1)
+        meminfo = {}
+        with open("/proc/meminfo") as meminfo_f:
+            for line in meminfo_f:
+                name, value = line.split(":", 1)
+                meminfo[name] = int(value.split()[0])
+        rss = self.process_rss_mb()
+        space = os.statvfs(self.path)
+        self.samples.append({'seconds': round(now - self.started, 1),
+                             'phase': job_timer.phase or '',
+                             'cpu_user_pct': round((cpu[0] + cpu[1]) * 100 / cpu_total, 1),
+                             'cpu_system_pct': round((cpu[2] + cpu[5] + cpu[6]) * 100 / cpu_total, 1),
+                             'cpu_iowait_pct': round(cpu[4] * 100 / cpu_total, 1),
+                             'cpu_steal_pct': round(cpu[7] * 100 / cpu_total, 1),
+                             'mem_available_mb': meminfo.get('MemAvailable', 0) >> 10,
+                             'swap_used_mb': (meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0)) >> 10,
+                             'swap_pages_ps': round((current['swap'] - self.previous['swap']) / elapsed, 1),
+                             'rss_wget_mb': rss['wget'],
+                             'rss_sslsplit_mb': rss['sslsplit'],
+                             'rss_python_mb': rss['python'],
+                             'disk_read_kbps': round((current['sectors'][0] - self.previous['sectors'][0]) / 2 / elapsed, 1), # 512 byte sectors
+                             'disk_write_kbps': round((current['sectors'][1] - self.previous['sectors'][1]) / 2 / elapsed, 1),
+                             'net_rx_kbps': round((current['network'][0] - self.previous['network'][0]) / 1024 / elapsed, 1),
+                             'net_tx_kbps': round((current['network'][1] - self.previous['network'][1]) / 1024 / elapsed, 1),
+                             'free_mb': space.f_bavail * space.f_frsize >> 20})
+        self.previous, self.previous_time = current, now
+
+    def run(self):
+        """Samples until the process exits. A failing sample stops the sampler instead of the job."""
+        try:
+            self.first = self.previous = self.counters()
+            self.previous_time = time.monotonic()
+            while True:
+                time.sleep(self.interval)
+                self.sample()
+        except Exception as e:
+            logging.error(f"ERROR sampling resource use. Sampling stopped: {e}")
+
+    def summary(self):
+        """
+        Summarises the samples taken so far
+
+        Returns:
+            dict of the peaks, means and totals of the job and, for the rate and CPU columns, the phase with the
+            highest mean. Empty without samples.
+        """
+        samples = list(self.samples)
+        if not samples:
+            return {}
+        first, last = self.first, self.previous
+        busy = [sample['cpu_user_pct'] + sample['cpu_system_pct'] for sample in samples]
+        phases = {}
+        for sample in samples:
+            phases.setdefault(sample['phase'], []).append(sample)
+        return {'samples': len(samples),
+                'cpu_busy_pct_mean': round(sum(busy) / len(busy), 1),
+                'cpu_busy_pct_max': max(busy),
+                'cpu_iowait_pct_max': max(sample['cpu_iowait_pct'] for sample in samples),
+                'cpu_steal_pct_max': max(sample['cpu_steal_pct'] for sample in samples),
+                'mem_available_mb_min': min(sample['mem_available_mb'] for sample in samples),
+                'swap_used_mb_max': max(sample['swap_used_mb'] for sample in samples),
+                'rss_wget_mb_max': max(sample['rss_wget_mb'] for sample in samples),
+                'rss_sslsplit_mb_max': max(sample['rss_sslsplit_mb'] for sample in samples),
+                'rss_python_mb_max': max(sample['rss_python_mb'] for sample in samples),
+                'disk_read_mb': round((last['sectors'][0] - first['sectors'][0]) / 2048, 1),
+                'disk_write_mb': round((last['sectors'][1] - first['sectors'][1]) / 2048, 1),
+                'net_rx_mb': round((last['network'][0] - first['network'][0]) / (1 << 20), 1),
+                'net_tx_mb': round((last['network'][1] - first['network'][1]) / (1 << 20), 1),
+                'free_mb_min': min(sample['free_mb'] for sample in samples),
+                'peak_phases': {column: max(phases, key=lambda phase: sum(sample[column] for sample in phases[phase]) / len(phases[phase]))
+                                for column in self.PEAK_COLUMNS}}
+
+    def write(self, path):
+        """Writes the samples taken so far as CSV"""
+        with open(path, "w", newline="") as samples_f:
+            writer = csv.DictWriter(samples_f, fieldnames=self.COLUMNS)
+            writer.writeheader()
+            writer.writerows(list(self.samples))
+
+resource_sampler = ResourceSampler(RESOURCE_SAMPLE_INTERVAL, JOB_ROOT)
+threading.Thread(target=resource_sampler.run, daemon=True).start()
+
 # AWS boto3 session set for Cloudwatch, SQS, S3
-boto3_session = Session(region_name=ec2_metadata.region) # requires region to be set
+boto3_session = Session(region_name=instance_metadata.region) # requires region to be set
 
 # AWS Cloudwath setup as log handler
 logger = logging.getLogger()
@@ -41,12 +325,213 @@ logging.getLogger('botocore').setLevel(logging.INFO)
 logging.getLogger('s3transfer').setLevel(logging.INFO)
 logging.getLogger('urllib3').setLevel(logging.INFO)
 logger.setLevel(logging.DEBUG)
-cloudwatch_handler = CloudWatchLogHandler(create_log_group=False, create_log_stream=True, log_group=AWS_CLOUDWATCH_LOG_GROUP,stream_name=AWS_CLOUDWATCH_LOG_STREAM,boto3_session=boto3_session)
+cloudwatch_log_stream = f'{instance_metadata.instance_id}-{instance_metadata.region}' # e.g. i-0d4276fc8ab7dee65-eu-west-1
+cloudwatch_handler = CloudWatchLogHandler(create_log_group=False, create_log_stream=True, log_group=AWS_CLOUDWATCH_LOG_GROUP,stream_name=cloudwatch_log_stream,boto3_session=boto3_session)
 console_handler = logging.StreamHandler()
 logger.addHandler(cloudwatch_handler)
 logger.addHandler(console_handler)
 
-logging.debug(f"EC2 instance metadata: Type: {ec2_metadata.instance_type} Region: {ec2_metadata.region} | Interface MAC: {ec2_metadata.mac} | Public IPv4: {ec2_metadata.public_ipv4} | Private IPv4: {ec2_metadata.private_ipv4} | Global IPv6: {NetworkInterface(ec2_metadata.mac).ipv6s}")
+# CloudWatch only extracts metrics from Embedded Metric Format records sent with the header below, which watchtower does
+# not send. The records go to a stream of their own through this client.
+def add_emf_header(request, **kwargs):
+    """botocore before-sign handler marking PutLogEvents requests as Embedded Metric Format"""
+    request.headers['x-amzn-logs-format'] = 'json/emf'
+
+metrics_log_stream = cloudwatch_log_stream + '-metrics'
+metrics_logs_client = boto3_session.client('logs')
+metrics_logs_client.meta.events.register('before-sign.cloudwatch-logs.PutLogEvents', add_emf_header)
+
+class LastErrorHandler(logging.Handler):
+    """Remembers the last error logged so that a failed job can report it in its status"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.last_error = None
+
+    def emit(self, record):
+        self.last_error = record.getMessage()
+
+last_error_handler = LastErrorHandler()
+logger.addHandler(last_error_handler)
+
+job_timer.mark('logging')
+logging.debug(f"EC2 instance metadata: Type: {instance_metadata.instance_type} Region: {instance_metadata.region} | Interface MAC: {instance_metadata.mac} | Public IPv4: {instance_metadata.public_ipv4} | Private IPv4: {instance_metadata.private_ipv4} | Global IPv6: {instance_metadata.ipv6s}")
+
+s3_client = boto3_session.client('s3')
+
+# Job status published to S3 for the jobstatus API of the lambda. Filled once a job is received.
+job_status = {'jobid': None, 'key': None, 'attempt': 1, 'state': None, 'published': 0, 'deleted': False, 'etag': None}
+
+# Crawl progress shared with the quota monitor and the job status
+crawl_progress = {'bytes': 0, 'files': 0, 'stdout_files': 0, 'started': None, 'truncated': None, 'seeded_bytes': 0, 'seeded_files': 0}
+
+# Sharded recursive job this job is a part of. parent is the <jobid>-<region> of the coordinator, part is coordinator or
+# the shard number, parts counts the coordinator and its shards once they are queued and jobs lists the shards.
+shard_info = {'parent': None, 'part': None, 'parts': 0, 'jobs': []}
+
+def publish_job_status(state, error=None, throttle=False, claim=False):
+    """
+    Writes the small job status record that the jobstatus API of the lambda reads
+
+    Args:
+        state (str): started, seeding, resuming, crawling, processing, compressing, uploading, retrying, sharded, complete or failed. The lambda writes queued and cancelled.
+            sharded is complete for the coordinator of a sharded job. The last part to finish publishes the sharded job as complete.
+        error (str): why the job failed or is retried
+        throttle (bool): skip the write when the state is unchanged and was published less than STATUS_PUBLISH_INTERVAL ago
+        claim (bool): only write when the record is unchanged since job_cancelled() read it, i.e. the lambda did not
+            cancel the job or write queued in the meantime
+    Returns:
+        bool False when the claim failed, otherwise True
+    """
+    now = time.time()
+    if throttle and state == job_status['state'] and now - job_status['published'] < STATUS_PUBLISH_INTERVAL:
+        return True
+    job_status['state'], job_status['published'] = state, now
+
+    record = {'jobid': job_status['jobid'],
+              'region': instance_metadata.region,
+              'instance': instance_metadata.instance_id,
+              'attempt': job_status['attempt'],
+              'state': state,
+              'phase': job_timer.phase,
+              'bytes': crawl_progress['bytes'],
+              'files': crawl_progress['files'],
+              'truncated': crawl_progress['truncated'],
+              'error': error,
+              'updated': now}
+    if shard_info['jobs']:
+        record['shards'] = shard_info['jobs']
+    elif shard_info['parent'] and shard_info['part'] != 'coordinator':
+        record['parent'] = shard_info['parent']
+    condition = {}
+    if claim:
+        condition = {'IfMatch': job_status['etag']} if job_status['etag'] else {'IfNoneMatch': '*'}
+    try:
+        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=job_status['key'], Body=json.dumps(record), ContentType='application/json', **condition)
+    except ClientError as e:
+        if claim and e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        logging.error(f"ERROR publishing job status {state}: {e}")
+    except Exception as e:
+        logging.error(f"ERROR publishing job status {state}: {e}")
+    if shard_info['parts'] and state in ('sharded', 'complete', 'failed'):
+        record_shard_part(record)
+    return True
+
+def job_cancelled():
+    """
+    Checks whether the client cancelled the job while it was queued e.g. a hedged job that completed in another region.
+    The lambda only cancels jobs which are still queued. Remembers the ETag of the record for the claim of the job.
+
+    Returns:
+        bool
+    """
+    job_status['etag'] = None
+    try:
+        response = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=job_status['key'])
+        record = json.loads(response['Body'].read())
+    except ClientError: # e.g. no record
+        return False
+    except Exception as e:
+        logging.error(f"ERROR reading job status: {e}")
+        return False
+    job_status['etag'] = response['ETag']
+    return record.get('state') == 'cancelled'
+
+def checkpoint_key(name):
+    """S3 key of an object of the crawl checkpoints of this job"""
+    return 'checkpoints/' + job_status['jobid'] + '-' + instance_metadata.region + '/' + name
+
+def remove_checkpoints():
+    """Deletes the crawl checkpoint segments of this job once they are no longer needed"""
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=AWS_S3_BUCKET_NAME, Prefix=checkpoint_key('')):
+        if page.get('Contents'):
+            s3_client.delete_objects(Bucket=AWS_S3_BUCKET_NAME, Delete={'Objects': [{'Key': item['Key']} for item in page['Contents']], 'Quiet': True})
+    return
+
+def shard_key(name):
+    """S3 key of an object shared by the parts of the sharded job of this job"""
+    return 'shards/' + shard_info['parent'] + '/' + name
+
+def claim_url(url):
+    """
+    Claims a URL in the set of URLs crawled by the parts of the sharded job. The object of the URL is only created
+    when it does not exist yet. URLs this part claimed in an earlier attempt of the job stay its own.
+
+    Args:
+        url (str): URL about to be crawled
+    Returns:
+        bool False when another part crawls the URL
+    """
+    key = shard_key('seen/' + hashlib.sha1(url.encode('utf-8')).hexdigest())
+    try:
+        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=key, Body=shard_info['part'], IfNoneMatch='*')
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+    return s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)['Body'].read().decode('utf-8') == shard_info['part']
+
+def remove_shard_claims():
+    """Deletes the URLs claimed by the parts of the sharded job"""
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=AWS_S3_BUCKET_NAME, Prefix=shard_key('seen/')):
+        if page.get('Contents'):
+            s3_client.delete_objects(Bucket=AWS_S3_BUCKET_NAME, Delete={'Objects': [{'Key': item['Key']} for item in page['Contents']], 'Quiet': True})
+    return
+
+def record_shard_part(record):
+    """
+    Counts this job as a finished part of its sharded job. The last part to finish merges the manifests of all parts
+    into the logical manifest of the sharded job, publishes the job status of the sharded job and removes the claimed URLs.
+
+    Args:
+        record (dict): final job status record of this part
+    Returns:
+        None
+    """
+    parent = shard_info['parent']
+    try:
+        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=shard_key('done/' + shard_info['part'] + '.json'), Body=json.dumps(record), ContentType='application/json')
+        listing = s3_client.list_objects_v2(Bucket=AWS_S3_BUCKET_NAME, Prefix=shard_key('done/'))
+        if listing.get('KeyCount', 0) < shard_info['parts']:
+            return
+        try: # parts finishing at the same time all see every part done. Only one merges.
+            s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=shard_key('merged'), Body=record['jobid'], IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return
+            raise
+
+        parts = [json.loads(s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=item['Key'])['Body'].read()) for item in listing['Contents']]
+        parts.sort(key=lambda part: part['jobid'] + '-' + part['region'] != parent) # coordinator first
+        manifests = []
+        for part in parts:
+            try:
+                manifests.append(job_artifacts.read_manifest(s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=part['jobid'] + '-' + part['region'] + job_artifacts.MANIFEST_SUFFIX)['Body']))
+            except ClientError as e:
+                logging.error(f"ERROR reading the manifest of part {part['jobid']} of sharded job {parent}: {e}")
+        merged_manifest_path = JOB_ROOT + "sharded_" + job_artifacts.MANIFEST_NAME
+        job_artifacts.write_manifest(job_artifacts.merge_manifests(parent, sqs_url, manifests), merged_manifest_path)
+        s3_client.upload_file(merged_manifest_path, AWS_S3_BUCKET_NAME, parent + job_artifacts.MANIFEST_SUFFIX)
+
+        coordinator, shards = parts[0], parts[1:]
+        incomplete = [part['truncated'] for part in parts if part['truncated']]
+        failed = sum(part['state'] == 'failed' for part in shards)
+        if failed:
+            incomplete.insert(0, f"{failed} of {len(shards)} shards failed")
+        parent_record = dict(coordinator,
+                             state='failed' if coordinator['state'] == 'failed' else 'complete',
+                             phase=None,
+                             bytes=sum(part['bytes'] for part in parts),
+                             files=sum(part['files'] for part in parts),
+                             truncated="; ".join(incomplete) or None,
+                             updated=time.time())
+        s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key='status/' + parent + '.json', Body=json.dumps(parent_record), ContentType='application/json') # key must match lambda_function.py
+        remove_shard_claims()
+        logging.debug(f"Sharded job {parent} {parent_record['state']}: {len(parts)} parts {parent_record['files']} files {parent_record['bytes'] >> 20}MB. Manifest of {len(manifests)} parts merged.")
+    except Exception as e:
+        logging.error(f"ERROR finishing part {shard_info['part']} of sharded job {parent}: {e}")
+    return
 
 def sqs_delete_message(sqs_queue_url, receipt_handle):
     """Delete message from sqs queue"""
@@ -56,6 +541,7 @@ def sqs_delete_message(sqs_queue_url, receipt_handle):
             QueueUrl = sqs_queue_url,
             ReceiptHandle = receipt_handle
         )
+        job_status['deleted'] = True
     except ClientError as e:
         logging.error(f"ERROR on sqs delete message: {e}")
     except Exception as e:
@@ -77,25 +563,50 @@ def do_shutdown():
     # Option 3 - Use AWS API to terminate the instance and decrease the desired capacity
     logging.debug("Shutdown method: Terminating instance...")
 
+    # A job that did not complete reports why. Unless it was deleted or used up its receives SQS hands it to another worker.
+    if job_status['jobid'] and job_status['state'] not in ('sharded', 'complete', 'failed', 'cancelled'):
+        if job_status['deleted'] or job_status['attempt'] >= SQS_MAX_RECEIVES:
+            publish_job_status('failed', error=last_error_handler.last_error or "Worker stopped")
+            try:
+                remove_checkpoints()
+            except Exception as e:
+                logging.error(f"ERROR removing the crawl checkpoints: {e}")
+        else:
+            publish_job_status('retrying', error=last_error_handler.last_error or "Worker stopped")
+
     cloudwatch_handler.flush()
     cloudwatch_handler.close()
     #subprocess.run(['sudo systemctl restart rsyslog'], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True) # flush all syslog queues to disk?
+    # Jobs still waiting in the queue e.g. shards of a sharded job get a fresh instance in place of this one
+    # unless the other instances of the group take them
     autoscale = boto3_session.client('autoscaling')
+    backlog = 0
+    if job_status['jobid']:
+        try:
+            backlog = int(sqs.get_queue_attributes(QueueUrl=AWS_SQS_URL, AttributeNames=['ApproximateNumberOfMessages'])['Attributes']['ApproximateNumberOfMessages'])
+            if backlog and AWS_AUTOSCALEGROUP_NAME:
+                backlog -= autoscale.describe_auto_scaling_groups(AutoScalingGroupNames=[AWS_AUTOSCALEGROUP_NAME])['AutoScalingGroups'][0]['DesiredCapacity'] - 1
+        except Exception as e:
+            logging.error(f"ERROR reading SQS queue size: {e}")
+    if backlog > 0:
+        logging.debug(f"{backlog} jobs waiting in SQS for an instance. This instance is replaced.")
     response = autoscale.terminate_instance_in_auto_scaling_group(
-        InstanceId=ec2_metadata.instance_id,
-        ShouldDecrementDesiredCapacity=True
+        InstanceId=instance_metadata.instance_id,
+        ShouldDecrementDesiredCapacity=backlog <= 0
     )
 
     exit() # otherwise it will run other parts of the script that dont need to now be ran
     return
 
-# Check if proxy is running
-proxystate = subprocess.run(["systemctl", "is-active", "--quiet", "sslsplit"])
-if proxystate.returncode != 0:
-    logging.error(f"ERROR: Proxy not running!")
+# Wait for the proxy. Usually it came up during the startup.
+job_timer.begin('proxy_check')
+if not proxy_ready.result():
+    logging.error(f"ERROR: Proxy not running after {PROXY_READY_TIMEOUT} seconds!")
     do_shutdown()
+startup_executor.shutdown(wait=False)
 
 # Create SQS client
+job_timer.begin('sqs_receive')
 sqs = boto3_session.client('sqs')
 
 # Pull SQS queue stats
@@ -105,18 +616,64 @@ queue_status = sqs.get_queue_attributes(
 )
 logging.debug(f"SQS queue status: ApproximateNumberOfMessages: {queue_status['Attributes']['ApproximateNumberOfMessages']} ApproximateNumberOfMessagesNotVisible: {queue_status['Attributes']['ApproximateNumberOfMessagesNotVisible']} ApproximateNumberOfMessagesDelayed: {queue_status['Attributes']['ApproximateNumberOfMessagesDelayed']}")
 
+def visibility_heartbeat(receipt_handle, stop_event):
+    """
+    Runs in a thread and keeps the job leased while it makes progress.
+    The job is received with a short visibility timeout so that a crashed worker's job is retried within minutes.
+
+    Args:
+        receipt_handle (str): SQS receipt handle of the job
+        stop_event (threading.Event): set once the job message is deleted
+    Returns:
+        None
+    """
+    while not stop_event.wait(SQS_HEARTBEAT_INTERVAL):
+        idle = time.monotonic() - job_timer.last_activity
+        if idle > SQS_STALL_TIMEOUT:
+            logging.error(f"ERROR: No job progress for {int(idle)} seconds. Not extending the SQS visibility timeout.")
+            continue
+        try:
+            sqs.change_message_visibility(
+                QueueUrl=AWS_SQS_URL,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=SQS_VISIBILITY_TIMEOUT
+            )
+        except Exception as e:
+            logging.error(f"ERROR on sqs change message visibility: {e}")
+
 # Get item from SQS queue
 try:
-    sqs_messages = sqs.receive_message(
-        QueueUrl=AWS_SQS_URL,
-        MessageAttributeNames=['All'],
-        MaxNumberOfMessages=1,
-        WaitTimeSeconds=1
-    )
+    # Long poll. The job that started this instance may not be visible yet so keep polling for the boot grace period.
+    receive_deadline = time.monotonic() + SQS_BOOT_GRACE
+    while True:
+        sqs_messages = sqs.receive_message(
+            QueueUrl=AWS_SQS_URL,
+            AttributeNames=['ApproximateReceiveCount'],
+            MessageAttributeNames=['All'],
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=SQS_WAIT_SECONDS,
+            VisibilityTimeout=SQS_VISIBILITY_TIMEOUT
+        )
+        if sqs_messages.get('Messages') or time.monotonic() >= receive_deadline:
+            break
+        logging.debug("SQS queue empty. Polling again.")
 
     if sqs_messages.get('Messages'): # key only appears if there is a message
+        job_timer.mark('first_receive')
+        logging.debug(f"Startup timeline in seconds since boot: {job_timer.marks}")
         sqs_ReceiptHandle = sqs_messages['Messages'][0]['ReceiptHandle'] # Taking first from list and should only be one item in list
         sqs_id = sqs_messages['Messages'][0]['MessageId'] # output to disk will use this value
+
+        # Keep the job leased while it is worked
+        heartbeat_stop_event = threading.Event()
+        threading.Thread(target=visibility_heartbeat, args=(sqs_ReceiptHandle, heartbeat_stop_event), daemon=True).start()
+
+        sqs_receive_count = int(sqs_messages['Messages'][0].get('Attributes', {}).get('ApproximateReceiveCount', 1))
+        job_status.update(jobid=sqs_id, key='status/' + sqs_id + '-' + instance_metadata.region + '.json', attempt=sqs_receive_count) # key must match lambda_function.py
+        if sqs_receive_count > SQS_MAX_RECEIVES:
+            logging.error(f"ERROR: Job {sqs_id} was received {sqs_receive_count} times and is dropped")
+            sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+            do_shutdown()
         sqs_body = json.loads(sqs_messages['Messages'][0]['Body'])
 
         sqs_url = sqs_body['url']['StringValue']
@@ -124,8 +681,18 @@ try:
         sqs_force_ip_version = sqs_body['force_ip_version']['StringValue']
         sqs_wget_mode = sqs_body['wget_mode']['StringValue'] # singlepage or recursive
         sqs_recursive_level = sqs_body['recursive_level']['StringValue'] # str
+        # Resource quotas. Jobs queued before quotas existed do not have them which means no limit.
+        sqs_max_bytes = sqs_body.get('max_bytes', {}).get('StringValue') # str
+        sqs_max_files = sqs_body.get('max_files', {}).get('StringValue') # str
+        sqs_max_seconds = sqs_body.get('max_seconds', {}).get('StringValue') # str
+        sqs_engine = sqs_body.get('engine', {}).get('StringValue', 'wget') # wget or crawler. Jobs queued before engines existed are wget.
+        sqs_base_job = sqs_body.get('base_job', {}).get('StringValue') # <jobid>-<region> of an earlier job of the same URL. Only set for incremental recrawls.
+        sqs_shards = sqs_body.get('shards', {}).get('StringValue') # str. Only set for sharded recursive crawls. This worker becomes their coordinator.
+        sqs_parent_job = sqs_body.get('parent_job', {}).get('StringValue') # <jobid>-<region> of the coordinator. Only set for shards of a sharded job.
+        sqs_shard = sqs_body.get('shard', {}).get('StringValue') # str number of this shard
+        sqs_shard_count = sqs_body.get('shard_count', {}).get('StringValue') # str shards of the sharded job
 
-        logging.debug(f"SQS job: {sqs_id} {sqs_force_ip_version} {sqs_url} {sqs_useragent} {sqs_wget_mode} {sqs_recursive_level}")
+        logging.debug(f"SQS job: {sqs_id} {sqs_force_ip_version} {sqs_url} {sqs_useragent} {sqs_wget_mode} {sqs_recursive_level} {sqs_engine} base {sqs_base_job} shards {sqs_shards} parent {sqs_parent_job} shard {sqs_shard} | Quotas: bytes {sqs_max_bytes} files {sqs_max_files} seconds {sqs_max_seconds}")
 
         # Check for bad values
         # Input Validation for job
@@ -142,6 +709,10 @@ try:
             logging.error("ERROR: Mode must be singlepage or recursive")
             sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
             do_shutdown()
+        if sqs_engine != "wget" and sqs_engine != "crawler":
+            logging.error("ERROR: Engine must be wget or crawler")
+            sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+            do_shutdown()
         if sqs_force_ip_version != "ipv4" and sqs_force_ip_version != "ipv6":
             logging.error("ERROR: Force ip version must be ipv4 of ipv6")
             sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
@@ -151,6 +722,41 @@ try:
             logging.error("ERROR: URL did not validate. E.g. must start with http:// or https://")
             sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
             do_shutdown()
+        for quota in (sqs_max_bytes, sqs_max_files, sqs_max_seconds):
+            if quota and (not quota.isdigit() or int(quota) < 1):
+                logging.error("ERROR: Quotas must be whole numbers greater than 0")
+                sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+                do_shutdown()
+        if sqs_base_job and not re.fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-' + re.escape(instance_metadata.region), sqs_base_job):
+            logging.error("ERROR: Base job must be a job of this region")
+            sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+            do_shutdown()
+        if sqs_shards and (not sqs_shards.isdigit() or not 2 <= int(sqs_shards) <= SHARDS_MAX or sqs_engine != "crawler" or sqs_wget_mode != "recursive" or int(sqs_recursive_level) < 2 or sqs_base_job):
+            logging.error(f"ERROR: Sharding needs 2 to {SHARDS_MAX} shards, the crawler engine and a recursive level of at least 2. Not incremental.")
+            sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+            do_shutdown()
+        if sqs_parent_job:
+            if not re.fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-' + re.escape(instance_metadata.region), sqs_parent_job) or not str(sqs_shard).isdigit() or not str(sqs_shard_count).isdigit() or sqs_engine != "crawler":
+                logging.error("ERROR: Shard must name its parent job of this region, its number and the shard count")
+                sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+                do_shutdown()
+            shard_info.update(parent=sqs_parent_job, part=sqs_shard, parts=int(sqs_shard_count) + 1)
+        if sqs_shards:
+            shard_info.update(parent=sqs_id + '-' + instance_metadata.region, part='coordinator')
+        # Claim the job. The record is only replaced when it is unchanged since it was read, so a job the lambda
+        # cancels in between is not started. Writing queued in between is retried.
+        for claim_attempt in range(JOB_CLAIM_ATTEMPTS):
+            if job_cancelled():
+                logging.debug(f"Job {sqs_id} was cancelled before it started. Dropping it.")
+                sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+                job_status['state'] = 'cancelled' # the record stays as the client left it
+                do_shutdown()
+            if publish_job_status('started', claim=True):
+                break
+        else:
+            logging.error(f"ERROR: Job {sqs_id} status kept changing while it was claimed. Leaving it to SQS.")
+            job_status['state'] = 'cancelled' # the record stays as the other writer left it
+            do_shutdown()
     else:
         logging.error(f"ERROR: Forcing shutdown due to: Nothing in SQS queue")
         do_shutdown()
@@ -164,12 +770,130 @@ except Exception as error:
     do_shutdown()
 
 # Output locations
-job_root = "/website_download/" # must end in /
+job_root = JOB_ROOT # must end in /
 debug_path = job_root + "debug/"
 certificate_path = job_root + "certificates/"
 wget_path = job_root + "wget_saved/" # wget will auto make this directory
 output_targz_path = job_root
-output_targz_filename = sqs_id + '-' + ec2_metadata.region + '.tar.gz'
+output_targz_filename = sqs_id + '-' + instance_metadata.region + '.tar.gz'
+connection_summary_filename = sqs_id + '-' + instance_metadata.region + job_artifacts.CONNECTION_SUMMARY_SUFFIX # S3 sidecar of proxy.log summary
+manifest_filename = sqs_id + '-' + instance_metadata.region + job_artifacts.MANIFEST_SUFFIX # S3 sidecar of the file manifest. Read by later incremental jobs.
+validators_path = debug_path + "etags.json" # ETags kept by the crawler for incremental jobs
+frontier_path = debug_path + "frontier.json" # links the coordinator of a sharded job did not follow
+shard_seeds_path = debug_path + "shard_seeds.txt" # URLs a shard starts from
+
+def memory_available_mb():
+    """MemAvailable of /proc/meminfo in MB. 0 when it cannot be read."""
+    try:
+        with open("/proc/meminfo") as meminfo_f:
+            for line in meminfo_f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) >> 10
+    except (OSError, ValueError, IndexError) as e:
+        logging.error(f"ERROR reading available memory: {e}")
+    return 0
+
+
+def switch_workspace(target):
+    """
+    Moves the job workspace and points JOB_ROOT at it. SSLsplit is stopped meanwhile so that its log, pcap and streams
+    are complete in the copy and rsyslog is told to reopen its files in the new location. A RAM workspace left is emptied.
+
+    Args:
+        target (str): WORKSPACE_RAM_PATH or WORKSPACE_DISK_PATH
+    Returns:
+        None
+    Raises:
+        subprocess.CalledProcessError: when a step fails. JOB_ROOT still points at the old workspace if the copy failed.
+    """
+    source = os.path.realpath(JOB_ROOT) + "/"
+    subprocess.run(["sudo", "systemctl", "stop", "sslsplit"], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        subprocess.run(["sudo", "cp", "-a", source + ".", target], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        subprocess.run(["sudo", "ln", "-sfn", target.rstrip("/"), JOB_ROOT.rstrip("/")], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    finally:
+        subprocess.run(["sudo", "systemctl", "kill", "-s", "HUP", "rsyslog"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        subprocess.run(["sudo", "systemctl", "start", "sslsplit"], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if source == os.path.realpath(WORKSPACE_RAM_PATH) + "/":
+        subprocess.run(["sudo", "find", source, "-mindepth", "1", "-delete"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+# Job workspace. JOB_ROOT is a symlink so a small job can run in a tmpfs and its files are not written to and read back
+# from EBS several times. Single page jobs are moved there as they are small, other jobs only when their byte quota says
+# they stay within the RAM budget. One that outgrows it anyway, or fills the tmpfs before the quota monitor notices, is
+# moved back to disk during the crawl and continues there.
+workspace = {'ram': False, 'budget': 0, 'spill': False}
+if WORKSPACE_RAM_MB and Path(JOB_ROOT.rstrip("/")).is_symlink() and Path(WORKSPACE_RAM_PATH).is_dir():
+    job_timer.begin('workspace')
+    memory_mb = memory_available_mb()
+    workspace['budget'] = min(WORKSPACE_RAM_MB, int(memory_mb * WORKSPACE_RAM_SHARE)) << 20
+    expected_bytes = int(sqs_max_bytes) * WORKSPACE_OVERHEAD if sqs_max_bytes else None
+    if workspace['budget'] and (sqs_wget_mode == "singlepage" or (expected_bytes and expected_bytes <= workspace['budget'])):
+        try:
+            switch_workspace(WORKSPACE_RAM_PATH)
+            workspace['ram'] = True
+        except Exception as e:
+            logging.error(f"ERROR moving job workspace to RAM. Staying on disk: {e}")
+    logging.debug(f"Job workspace {'in RAM' if workspace['ram'] else 'on disk'}. RAM budget {workspace['budget'] >> 20}MB of {memory_mb}MB available.")
+
+# Incremental recrawl: the tree of the base job is put in place first so only what changed since is downloaded.
+# The files come from the archives in S3 of the base job and of the jobs it was built on. Traffic to S3 is not
+# intercepted as only proxy_client goes through SSLsplit.
+base_manifest = None
+if sqs_base_job:
+    job_timer.begin('seed')
+    publish_job_status('seeding')
+    try:
+        base_manifest = job_artifacts.read_manifest(s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=sqs_base_job + job_artifacts.MANIFEST_SUFFIX)['Body'])
+        for base_job, wanted in job_artifacts.manifest_files_by_job(base_manifest).items():
+            archive_body = s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=base_job + '.tar.gz')['Body']
+            job_artifacts.extract_tree_files(base_job + '.tar.gz', wanted, wget_path, fileobj=archive_body)
+        crawl_progress['seeded_bytes'], crawl_progress['seeded_files'] = job_artifacts.directory_usage(wget_path)
+        with open(validators_path, "w") as validators_f:
+            json.dump({name: entry['etag'] for name, entry in base_manifest['files'].items() if entry.get('etag')}, validators_f)
+        logging.debug(f"Seeded {crawl_progress['seeded_files']} files ({crawl_progress['seeded_bytes'] >> 20}MB) of base job {sqs_base_job}")
+    except Exception as e:
+        logging.error(f"ERROR seeding incremental job from base job {sqs_base_job}. Downloading everything instead: {e}")
+        base_manifest = None
+        crawl_progress['seeded_bytes'], crawl_progress['seeded_files'] = 0, 0
+        shutil.rmtree(wget_path, ignore_errors=True)
+
+# Sharded recursive crawl. The coordinator only crawls the URL itself and splits the links it finds into shards.
+# Shards crawl from their share of the links and skip URLs another part already crawls. The crawler runs as
+# proxy_client without AWS credentials so it claims URLs through a service on localhost, which iptables does not redirect.
+claim_service_url = None
+if shard_info['part'] == 'coordinator':
+    try:
+        claim_url(sqs_url)
+    except Exception as e:
+        logging.error(f"ERROR claiming the URL of sharded job {shard_info['parent']}: {e}")
+elif shard_info['parent']:
+    class ClaimHandler(BaseHTTPRequestHandler):
+        """POST body is a URL. Replies 200 when this shard may crawl it and 409 when another part does."""
+
+        def log_message(self, format, *args):
+            return
+
+        def do_POST(self):
+            url = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', errors='replace')
+            try:
+                code = 200 if claim_url(url) else 409
+            except Exception as e: # crawled anyway. A duplicate is better than a gap.
+                logging.error(f"ERROR claiming {url}: {e}")
+                code = 200
+            self.send_response(code)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    try:
+        s3_client.download_file(AWS_S3_BUCKET_NAME, shard_key(f'seeds/{shard_info["part"]}.txt'), shard_seeds_path)
+        claim_server = ThreadingHTTPServer(('127.0.0.1', 0), ClaimHandler)
+        threading.Thread(target=claim_server.serve_forever, daemon=True).start()
+        claim_service_url = f"http://127.0.0.1:{claim_server.server_address[1]}/claim"
+        logging.debug(f"Shard {shard_info['part']} of sharded job {shard_info['parent']}. URL claim service on {claim_service_url}")
+    except Exception as e:
+        logging.error(f"ERROR preparing shard {shard_info['part']} of sharded job {shard_info['parent']}: {e}")
+        do_shutdown()
 
 # Post processing SQS message: wget IP protocol forcing
 if sqs_force_ip_version == "ipv4":       # wget connect only to IPv4 addresses
@@ -200,24 +924,221 @@ if sqs_wget_mode == "recursive":
     wget_options_list.append("--recursive") # Turn on recursive retrieving
     wget_options_list.append(f"--level={sqs_recursive_level}") # Recursion maximum depth level depth. The default maximum depth is 5 which is A LOT!
 
+if base_manifest:
+    wget_options_list.append("--timestamping") # only download files newer than the seeded ones
+    wget_options_list.append("--no-if-modified-since") # HEAD based timestamping. After a 304 wget does not parse the unchanged page for links.
+
 wget_options_list.append(sqs_url)
 
+# Built-in concurrent crawler replaces wget when requested. Same user (iptables), output location and layout.
+if sqs_engine == "crawler":
+    wget_options_list = ["sudo", "-u", "proxy_client", "python3.8", CRAWLER_PATH,
+                         f"--mode={sqs_wget_mode}",
+                         f"--ipversion={sqs_force_ip_version}",
+                         f"--user-agent={sqs_useragent}",
+                         f"--directory-prefix={wget_path}"]
+    if shard_info['part'] == 'coordinator':
+        wget_options_list.append("--level=0") # the URL itself. Its links are the seeds of the shards.
+        wget_options_list.append(f"--frontier={frontier_path}")
+    elif sqs_wget_mode == "recursive":
+        wget_options_list.append(f"--level={sqs_recursive_level}")
+    if base_manifest:
+        wget_options_list.append("--timestamping")
+    wget_options_list.append(f"--validators={validators_path}") # ETags for the next incremental job
+    if claim_service_url:
+        wget_options_list.append(f"--input-file={shard_seeds_path}")
+        wget_options_list.append(f"--claim-url={claim_service_url}")
+    else:
+        wget_options_list.append(sqs_url)
+
 logging.debug(f'wget command: {wget_options_list}')
 
+# Crawl checkpoints. A recursive job uploads what it crawled so far every CHECKPOINT_INTERVAL seconds as numbered segments
+# below checkpoints/<jobid>-<region>/. A worker receiving the job again after the worker before it was lost puts the
+# downloaded files back and keeps the capture of the earlier workers below attempts/<attempt>/. The engine then runs
+# with --no-clobber like after a move from RAM to disk so it finds the links of the files it has without downloading them again.
+checkpoint = None
+resumed_seconds = 0 # crawl time of the earlier attempts. Counts towards the time quota.
+if CHECKPOINT_INTERVAL and sqs_wget_mode == "recursive":
+    checkpoint_index = None
+    try:
+        checkpoint_segments = sorted(item['Key'] for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=AWS_S3_BUCKET_NAME, Prefix=checkpoint_key(''))
+                                     for item in page.get('Contents', []))
+        if checkpoint_segments:
+            job_timer.begin('resume')
+            publish_job_status('resuming')
+            for segment_key in checkpoint_segments:
+                checkpoint_index = job_artifacts.apply_checkpoint_segment(s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=segment_key)['Body'], job_root)
+                job_timer.touch()
+            resumed_seconds = checkpoint_index['state'].get('crawl_seconds', 0)
+            if not base_manifest and "--no-clobber" not in wget_options_list: # incremental jobs already skip unchanged files with --timestamping
+                wget_options_list.insert(-1, "--no-clobber")
+            walked_bytes, walked_files = job_artifacts.directory_usage(wget_path)
+            logging.debug(f"Resumed from {len(checkpoint_segments)} checkpoint segments of attempt {checkpoint_index['attempt']}: {walked_files} files ({walked_bytes >> 20}MB) after {int(resumed_seconds)} seconds of crawling. Resuming wget with: {wget_options_list}")
+    except Exception as e:
+        logging.error(f"ERROR resuming from the crawl checkpoints. Crawling from the start: {e}")
+        checkpoint_segments = []
+    checkpoint = job_artifacts.CrawlCheckpoint(job_root, attempt=checkpoint_index['attempt'] + 1 if checkpoint_index else 1, segment=len(checkpoint_segments), exclude=(output_targz_filename,))
+
+
+def upload_checkpoint():
+    """Uploads what the crawl added since the last checkpoint as the next segment. A failed upload is retried with the next one."""
+    with tempfile.TemporaryFile() as segment_f:
+        index = checkpoint.write_segment(segment_f, state={'crawl_seconds': time.monotonic() - crawl_progress['started'], 'bytes': crawl_progress['bytes'], 'files': crawl_progress['files']})
+        if not index:
+            return
+        segment_f.seek(0)
+        s3_client.upload_fileobj(segment_f, AWS_S3_BUCKET_NAME, checkpoint_key(f"{index['segment']:06d}.tar.gz"))
+    checkpoint.commit()
+    logging.debug(f"Crawl checkpoint {index['segment']} uploaded with {len(index['files'])} files")
+
+def checkpoint_monitor(stop_event):
+    """
+    Runs in a thread next to the crawl and uploads a checkpoint every CHECKPOINT_INTERVAL seconds
+
+    Args:
+        stop_event (threading.Event): set by the caller once the crawl is over
+    Returns:
+        None
+    """
+    while not stop_event.wait(CHECKPOINT_INTERVAL):
+        try:
+            upload_checkpoint()
+        except Exception as e:
+            logging.error(f"ERROR uploading a crawl checkpoint: {e}")
+
+
+def quota_monitor(popen, progress, stop_event):
+    """
+    Runs in a thread next to wget and stops it gracefully when a job quota is reached.
+    Bytes and files are taken from the output tree while files are also counted from wget stdout by the caller.
+    wget runs under sudo which relays the SIGTERM to it.
+
+    Args:
+        popen (subprocess.Popen): running wget
+        progress (dict): shared crawl progress. Keys bytes, files, stdout_files, started, truncated. Also published as job status.
+        stop_event (threading.Event): set by the caller once wget exited
+    Returns:
+        None but sets progress['truncated'] to the reason when wget was stopped or workspace['spill'] when a RAM
+        workspace outgrew its budget and the caller moves it to disk
+    """
+    while not stop_event.wait(QUOTA_CHECK_INTERVAL):
+        walked_bytes, walked_files = job_artifacts.directory_usage(wget_path)
+        progress['bytes'] = max(walked_bytes - progress['seeded_bytes'], 0) # seeded files of an incremental job do not count
+        progress['files'] = max(walked_files - progress['seeded_files'], progress['stdout_files'])
+        elapsed = time.monotonic() - progress['started']
+        publish_job_status('crawling', throttle=True)
+
+        if sqs_max_bytes and progress['bytes'] >= int(sqs_max_bytes):
+            progress['truncated'] = f"byte quota of {sqs_max_bytes} reached"
+        elif sqs_max_files and progress['files'] >= int(sqs_max_files):
+            progress['truncated'] = f"file quota of {sqs_max_files} reached"
+        elif sqs_max_seconds and elapsed >= int(sqs_max_seconds):
+            progress['truncated'] = f"time quota of {sqs_max_seconds} seconds reached"
+        elif workspace['ram'] and job_artifacts.directory_usage(job_root)[0] > workspace['budget']:
+            workspace['spill'] = True
+
+        if progress['truncated']:
+            logging.error(f"ERROR: Stopping wget due to: {progress['truncated']} (bytes {progress['bytes']} files {progress['files']} seconds {int(elapsed)})")
+        elif workspace['spill']:
+            logging.debug(f"Job workspace outgrew its RAM budget of {workspace['budget'] >> 20}MB. Stopping wget to move it to disk.")
+        if progress['truncated'] or workspace['spill']:
+            popen.terminate()
+            try:
+                popen.wait(timeout=QUOTA_STOP_GRACE)
+            except subprocess.TimeoutExpired:
+                logging.error("ERROR: wget did not stop in time. Asking again.")
+                popen.terminate()
+            return
+
+# Caching DNS resolver of the crawl. iptables sends the DNS queries of proxy_client to it. Names only resolve to addresses
+# of the forced IP version and every query and answer is kept in dns.jsonl. The hosts of the first page are resolved
+# ahead of the crawl.
+resolver = dns_resolver.RecordingResolver(job_root + dns_resolver.DNS_RECORD_NAME, sqs_force_ip_version, port=DNS_RESOLVER_PORT)
+try:
+    resolver.start()
+    logging.debug(f"DNS resolver on port {DNS_RESOLVER_PORT} forwarding to {resolver.upstream}")
+except OSError as e:
+    logging.error(f"ERROR: DNS resolver not running! {e}")
+    do_shutdown()
+
+# Pipelined archive. Files are compressed into the job archive as soon as the crawler saved them and the certificates are
+# transformed as SSLsplit writes them, so only the rest of the job directory is left to compress after the crawl.
+# Not for jobs in RAM as the archive would take up their budget and not for incremental jobs as they remove files after the crawl.
+archive_pipeline = None
+if ARCHIVE_PIPELINE and not workspace['ram'] and not base_manifest:
+    try:
+        archive_pipeline = job_artifacts.ArchivePipeline(job_root, output_targz_path + output_targz_filename, output_targz_filename.replace('.tar.gz', ''), debug_path + "certificates/", certificate_path)
+        archive_pipeline.start()
+    except Exception as e:
+        logging.error(f"ERROR starting the pipelined archive. The job is archived after the crawl: {e}")
+        archive_pipeline = None
 
 # Website Download
+job_timer.begin('crawl')
+crawl_progress['started'] = time.monotonic() - resumed_seconds
+publish_job_status('crawling')
+checkpoint_stop_event = threading.Event()
+checkpoint_thread = threading.Thread(target=checkpoint_monitor, args=(checkpoint_stop_event,), daemon=True)
+if checkpoint:
+    checkpoint_thread.start()
 try: 
-    popen = subprocess.Popen(wget_options_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True) # stderror combined with stdout
-    output_of_interest = ["Saving to:", "saved", "FINISHED", "Downloaded"]
-
-    # All log lines go to a file and the ones needed for real-time monitoring go to Cloudwatch
-    for stdout_line in iter(popen.stdout.readline, ""):
-        with open(debug_path + "wget.log", "a+") as wget_f: # append if exists
-            wget_f.write(stdout_line)
-            if any(x in stdout_line for x in output_of_interest):
-                logging.debug(f'wget output: {stdout_line}') # will go to Cloudwatch
-    popen.stdout.close()
-    returncode = popen.wait()
+    prefetch_thread = None
+    while True:
+        popen = subprocess.Popen(wget_options_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True) # stderror combined with stdout
+        output_of_interest = ["Saving to:", "saved", "FINISHED", "Downloaded"]
+
+        quota_stop_event = threading.Event()
+        quota_thread = threading.Thread(target=quota_monitor, args=(popen, crawl_progress, quota_stop_event), daemon=True)
+        quota_thread.start()
+
+        # All log lines go to a file and the ones needed for real-time monitoring go to Cloudwatch
+        partial_path = None # file wget is saving. Incomplete when wget is stopped before it logs "saved".
+        for stdout_line in iter(popen.stdout.readline, ""):
+            with open(debug_path + "wget.log", "a+") as wget_f: # append if exists
+                wget_f.write(stdout_line)
+                if any(x in stdout_line for x in output_of_interest):
+                    logging.debug(f'wget output: {stdout_line}') # will go to Cloudwatch
+                if "Saving to:" in stdout_line:
+                    crawl_progress['stdout_files'] += 1
+                    partial_path = stdout_line.split("Saving to:", 1)[1].strip().strip("'\u2018\u2019")
+                elif " saved [" in stdout_line:
+                    if partial_path and not prefetch_thread: # first page
+                        prefetch_thread = threading.Thread(target=resolver.prefetch, args=(dns_resolver.hosts_in_page(partial_path),), daemon=True)
+                        prefetch_thread.start()
+                    if partial_path and archive_pipeline:
+                        archive_pipeline.add(partial_path)
+                    if partial_path and checkpoint:
+                        checkpoint.add(partial_path)
+                    partial_path = None
+            job_timer.touch()
+        popen.stdout.close()
+        returncode = popen.wait()
+        quota_stop_event.set()
+        quota_thread.join()
+        if returncode == 3 and workspace['ram'] and not crawl_progress['truncated']: # File I/O error e.g. the tmpfs filled up between two quota checks
+            logging.debug("Engine exited with a file I/O error in the RAM workspace. Moving it to disk.")
+            workspace['spill'] = True
+        if not workspace['spill'] or crawl_progress['truncated']:
+            break
+
+        # RAM workspace outgrew its budget or filled up. The crawl is moved to disk and run again without downloading what it already has.
+        workspace['spill'] = False
+        try:
+            if partial_path:
+                Path(partial_path).unlink(missing_ok=True)
+            switch_workspace(WORKSPACE_DISK_PATH)
+            workspace['ram'] = False
+        except Exception as e:
+            logging.error(f"ERROR moving job workspace to disk: {e}")
+            crawl_progress['truncated'] = f"RAM workspace budget of {workspace['budget'] >> 20}MB reached"
+            break
+        if not base_manifest and "--no-clobber" not in wget_options_list: # incremental jobs already skip unchanged files with --timestamping
+            wget_options_list.insert(-1, "--no-clobber")
+        logging.debug(f"Job workspace moved to disk. Resuming wget with: {wget_options_list}")
+    walked_bytes, walked_files = job_artifacts.directory_usage(wget_path) # final totals
+    crawl_progress['bytes'] = max(walked_bytes - crawl_progress['seeded_bytes'], 0)
+    crawl_progress['files'] = max(walked_files - crawl_progress['seeded_files'], crawl_progress['stdout_files'])
 
 # Specific exit codes
     wget_exit = {}
@@ -241,47 +1162,248 @@ try:
 
 except Exception as e:
     logging.error(f"ERROR: Exception running wget subprocess: {e}")
+checkpoint_stop_event.set()
+if checkpoint:
+    checkpoint_thread.join() # a segment uploaded after the job completed would never be removed
+resolver.stop()
+logging.debug(f"DNS queries of the crawl: {resolver.stats}")
+
+# Files still queued for the pipelined archive and the last certificates
+if archive_pipeline:
+    job_timer.begin('archive_drain')
+    pipelined = archive_pipeline.drain()
+    if archive_pipeline.error:
+        logging.error(f"ERROR in the pipelined archive. The job is archived after the crawl: {archive_pipeline.error}")
+    logging.debug(f"Pipelined archive: {pipelined['files']} files of {pipelined['bytes'] >> 20}MB in {pipelined['members']} gzip members and {pipelined['certificates']} certificates transformed during the crawl")
+
+# Partial results are still archived and uploaded. The marker tells the client why the crawl is incomplete.
+if crawl_progress['truncated']:
+    try:
+        with open(job_root + "truncated.json", "w") as truncated_f:
+            json.dump({'reason': crawl_progress['truncated'],
+                       'max_bytes': sqs_max_bytes,
+                       'max_files': sqs_max_files,
+                       'max_seconds': sqs_max_seconds,
+                       'bytes': crawl_progress['bytes'],
+                       'files': crawl_progress['files']}, truncated_f)
+    except Exception as e:
+        logging.error(f"ERROR writing truncated marker: {e}")
+
+# Coordinator of a sharded job: queues a shard for every share of the links found and scales out so they run at the same
+# time. Each shard is a job of its own with the remaining recursion levels and its share of the byte and file quotas.
+# A coordinator received again finds the shards it queued before.
+if shard_info['part'] == 'coordinator':
+    job_timer.begin('shard')
+    try:
+        try:
+            shard_info['jobs'] = json.loads(s3_client.get_object(Bucket=AWS_S3_BUCKET_NAME, Key=shard_key('jobs.json'))['Body'].read())
+        except ClientError:
+            with open(frontier_path) as frontier_f:
+                shard_seeds = job_artifacts.partition_frontier(json.load(frontier_f), int(sqs_shards))
+            for shard, seeds in enumerate(shard_seeds):
+                s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=shard_key(f'seeds/{shard}.txt'), Body="\n".join(seeds).encode('utf-8'))
+                shard_body = {name: value for name, value in sqs_body.items() if name != 'shards'}
+                shard_body['recursive_level'] = {'DataType': 'Number', 'StringValue': str(int(sqs_recursive_level) - 1)}
+                shard_body['parent_job'] = {'DataType': 'String', 'StringValue': shard_info['parent']}
+                shard_body['shard'] = {'DataType': 'Number', 'StringValue': str(shard)}
+                shard_body['shard_count'] = {'DataType': 'Number', 'StringValue': str(len(shard_seeds))}
+                for quota_name, quota in (('max_bytes', sqs_max_bytes), ('max_files', sqs_max_files)):
+                    if quota:
+                        shard_body[quota_name] = {'DataType': 'Number', 'StringValue': str(-(-int(quota) // len(shard_seeds)))}
+                shard_id = sqs.send_message(QueueUrl=AWS_SQS_URL, MessageBody=json.dumps(shard_body))['MessageId']
+                try: # only when no worker claimed the shard since it was sent
+                    s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key='status/' + shard_id + '-' + instance_metadata.region + '.json', ContentType='application/json', IfNoneMatch='*', # key must match lambda_function.py
+                                         Body=json.dumps({'jobid': shard_id, 'region': instance_metadata.region, 'state': 'queued', 'parent': shard_info['parent'], 'updated': time.time()}))
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+                        raise
+                shard_info['jobs'].append(shard_id + '-' + instance_metadata.region)
+            s3_client.put_object(Bucket=AWS_S3_BUCKET_NAME, Key=shard_key('jobs.json'), Body=json.dumps(shard_info['jobs']), ContentType='application/json')
+            if shard_info['jobs'] and AWS_AUTOSCALEGROUP_NAME:
+                try:
+                    autoscale = boto3_session.client('autoscaling')
+                    group = autoscale.describe_auto_scaling_groups(AutoScalingGroupNames=[AWS_AUTOSCALEGROUP_NAME])['AutoScalingGroups'][0]
+                    autoscale.set_desired_capacity(AutoScalingGroupName=AWS_AUTOSCALEGROUP_NAME, DesiredCapacity=min(group['MaxSize'], group['DesiredCapacity'] + len(shard_info['jobs'])), HonorCooldown=False)
+                except Exception as e:
+                    logging.error(f"ERROR scaling out for the shards. They wait for workers to free up: {e}")
+        shard_info['parts'] = len(shard_info['jobs']) + 1 if shard_info['jobs'] else 0
+        logging.debug(f"Sharded job {shard_info['parent']}: {len(shard_info['jobs'])} shards {shard_info['jobs']}")
+    except Exception as e:
+        logging.error(f"ERROR queueing the shards of sharded job {shard_info['parent']}. Only the URL itself was crawled: {e}")
+    if not shard_info['parts']:
+        try:
+            remove_shard_claims()
+        except Exception as e:
+            logging.error(f"ERROR removing the claimed URLs of job {shard_info['parent']}: {e}")
+
+# Manifest of the downloaded tree so a later job can be an incremental recrawl of this one.
+# Files of an incremental job that did not change since the base job are left out of the archive.
+job_timer.begin('manifest')
+manifest_changes = None
+if Path(wget_path).is_dir():
+    try:
+        validators = {}
+        if Path(validators_path).is_file():
+            with open(validators_path) as validators_f:
+                validators = json.load(validators_f)
+        manifest, unchanged_files = job_artifacts.build_manifest(wget_path, sqs_id + '-' + instance_metadata.region, sqs_url, base=base_manifest, validators=validators,
+                                                                 hashes=archive_pipeline.tree_hashes(wget_path) if archive_pipeline else None) # hashed while archived
+        if base_manifest:
+            job_artifacts.remove_tree_files(unchanged_files, wget_path)
+            manifest_changes = f"{len(manifest['changes']['added'])} added {len(manifest['changes']['changed'])} changed {manifest['changes']['unchanged']} unchanged since {sqs_base_job}"
+            logging.debug(f"Incremental job: {manifest_changes}")
+        job_artifacts.write_manifest(manifest, job_root + job_artifacts.MANIFEST_NAME)
+    except Exception as e:
+        logging.error(f"ERROR creating manifest of the downloaded files: {e}")
 
 # Make the internet-side certificates human readable
 # Only should occure when files are present which means there was a ssl connection
+job_timer.begin('certificate_transform')
+publish_job_status('processing')
 if len(list(Path(debug_path + "/certificates/").rglob('*.crt'))) > 0: # directory contains certs
     try:
-        result = subprocess.run(f'for file in {debug_path}/certificates/[A-Z0-9]???????????????????????????????????????.crt; do openssl x509 -in "$file" -text > "$file".text; mv "$file".text {certificate_path}; done', shell=True, capture_output=True, text=True)
-        logging.debug(f"Certificate transform stdout: {result.stdout} stderr: {result.stderr}" )
+        transformed, failed = job_artifacts.transform_certificates(debug_path + "certificates/", certificate_path, done=archive_pipeline.rendered if archive_pipeline else ())
+        logging.debug(f"Certificate transform: {transformed} transformed {failed} failed")
     except Exception as e:
         logging.error(f"ERROR: Exception running openssl subprocess: {e}")
 
-# Compress folder
-def set_permissions(tarinfo):
-    """Changes information in the created tar. Security by obscurity."""
-    tarinfo.uname = "user"
-    tarinfo.gname = "group"
-    tarinfo.uid = 0
-    tarinfo.gid = 0
-    return tarinfo
+# Summarise the SSLsplit connect log into a fixed schema gzip CSV so connections can be queried across jobs without extracting archives
+job_timer.begin('connection_summary')
+if Path(job_root + "proxy.log").is_file():
+    try:
+        connection_rows = job_artifacts.write_connection_summary(job_root + "proxy.log", job_root + job_artifacts.CONNECTION_SUMMARY_NAME)
+        logging.debug(f"Connection summary of {connection_rows} connections written to: {job_root + job_artifacts.CONNECTION_SUMMARY_NAME}")
+    except Exception as e:
+        logging.error(f"ERROR creating connection summary of proxy.log: {e}")
+
+# Network timing of every request from the capture
+job_timer.begin('network_timing')
+if Path(job_root + "proxy.pcap").is_file():
+    try:
+        timed_requests = job_artifacts.write_network_timings(job_root + "proxy.pcap", job_root + "proxy.log", job_root + dns_resolver.DNS_RECORD_NAME, job_root)
+        logging.debug(f"Network timings of {timed_requests} requests written to: {job_root + job_artifacts.TIMING_NAME}")
+    except Exception as e:
+        logging.error(f"ERROR creating network timings of proxy.pcap: {e}")
+
+def job_dimensions():
+    """Describes the job for timings.json and the job metrics"""
+    return {'JobId': sqs_id,
+            'Region': instance_metadata.region,
+            'InstanceType': instance_metadata.instance_type,
+            'Mode': sqs_wget_mode,
+            'Engine': sqs_engine,
+            'Bytes': crawl_progress['bytes'],
+            'Files': crawl_progress['files']}
 
+def write_timings(path, resources_path):
+    """Writes the phase timings and resource samples taken so far into the job results"""
+    try:
+        with open(path, "w") as timings_f:
+            json.dump(dict(job_dimensions(), phases=job_timer.timings, startup=job_timer.marks, resources=resource_sampler.summary()), timings_f, indent=1)
+        resource_sampler.write(resources_path)
+    except Exception as e:
+        logging.error(f"ERROR writing job timings: {e}")
+
+def emit_job_metrics():
+    """
+    Logs the phase timings, job size and resource use as a CloudWatch Embedded Metric Format record and sends it to
+    metrics_log_stream. CloudWatch turns the record into metrics in METRICS_NAMESPACE with the dimensions Region and Mode.
+    The phases that used a resource most and the startup timeline are logged with the record but are not metrics.
+    """
+    record = job_dimensions()
+    record.update(job_timer.timings)
+    metrics = [{'Name': phase, 'Unit': 'Seconds'} for phase in job_timer.timings]
+    record['StartupTimeline'] = job_timer.marks
+    if 'first_receive' in job_timer.marks:
+        record['BootToFirstReceive'] = job_timer.marks['first_receive']
+        metrics.append({'Name': 'BootToFirstReceive', 'Unit': 'Seconds'})
+    metrics.append({'Name': 'Bytes', 'Unit': 'Bytes'})
+    metrics.append({'Name': 'Files', 'Unit': 'Count'})
+    resources = resource_sampler.summary()
+    record['ResourcePeakPhases'] = resources.pop('peak_phases', {})
+    resources.pop('samples', None)
+    for name, value in resources.items():
+        record[name] = value
+        metrics.append({'Name': name, 'Unit': 'Percent' if '_pct' in name else 'Megabytes'})
+    record['_aws'] = {'Timestamp': int(time.time() * 1000),
+                      'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                             'Dimensions': [['Region', 'Mode']],
+                                             'Metrics': metrics}]}
+    logging.info(json.dumps(record)) # also kept in the worker log e.g. for simulate.py
+    try:
+        try:
+            metrics_logs_client.create_log_stream(logGroupName=AWS_CLOUDWATCH_LOG_GROUP, logStreamName=metrics_log_stream)
+        except metrics_logs_client.exceptions.ResourceAlreadyExistsException:
+            pass
+        metrics_logs_client.put_log_events(logGroupName=AWS_CLOUDWATCH_LOG_GROUP, logStreamName=metrics_log_stream,
+                                           logEvents=[{'timestamp': record['_aws']['Timestamp'], 'message': json.dumps(record)}])
+    except Exception as e:
+        logging.error(f"ERROR sending job metrics: {e}")
+
+# Size walk. Its timings go into the archive while compression and upload only go to the metrics.
+job_timer.begin('size_walk')
 try:
-    finished_job_size = sum(f.stat().st_size for f in Path(job_root).glob('**/*') if f.is_file()) >> 20 # Get size of and log. This is mainly for troubleshooting purposes.
+    finished_job_size = job_artifacts.directory_usage(job_root)[0] >> 20 # Get size of and log. This is mainly for troubleshooting purposes.
+    if workspace['ram'] and 2 * (finished_job_size << 20) > workspace['budget']: # the archive can be as large as the job itself
+        output_targz_path = WORKSPACE_DISK_PATH
+    job_timer.end()
+    write_timings(job_root + "timings.json", job_root + "resources.csv")
+    job_timer.begin('compress')
+    publish_job_status('compressing')
     logging.debug(f'Compressing job results of {finished_job_size}MB into {output_targz_path + output_targz_filename}')
-    with tarfile.open(output_targz_path + output_targz_filename, mode='w:gz') as archive:
-        archive.add(job_root, recursive=True, arcname=output_targz_filename.replace('.tar.gz', ''), filter=set_permissions)
-        logging.debug(f"Archive written to: {output_targz_path + output_targz_filename}")
-        logging.debug(f'Size of job results tar.gz: {os.path.getsize(output_targz_path + output_targz_filename) >> 20}MB') # Get size of and log. This is mainly for troubleshooting purposes.
+    if archive_pipeline:
+        archive_size = archive_pipeline.finish(progress=job_timer.touch) # only what was not archived during the crawl
+        if archive_pipeline.stats['dropped_members']:
+            logging.debug(f"Pipelined archive: {archive_pipeline.stats['dropped_members']} gzip members held files changed after the crawl saved them and were written again")
+    else:
+        archive_size = job_artifacts.write_job_archive(job_root, output_targz_path + output_targz_filename, output_targz_filename.replace('.tar.gz', ''), progress=job_timer.touch) # every file added signals progress
+    logging.debug(f"Archive written to: {output_targz_path + output_targz_filename}")
+    logging.debug(f'Size of job results tar.gz: {archive_size >> 20}MB') # Get size of and log. This is mainly for troubleshooting purposes.
 except Exception as e:
     logging.error(f"ERROR creating job output tar.gz: {e}")
     do_shutdown()
 
 # Upload the tar.gz into s3
-s3_client = boto3_session.client('s3')
+job_timer.begin('upload')
+publish_job_status('uploading')
+
+# Sidecars go first so that they are already present once the client sees the tar.gz
+for sidecar_name, sidecar_filename in ((job_artifacts.CONNECTION_SUMMARY_NAME, connection_summary_filename), (job_artifacts.MANIFEST_NAME, manifest_filename)):
+    if Path(job_root + sidecar_name).is_file():
+        try:
+            s3_client.upload_file(job_root + sidecar_name, AWS_S3_BUCKET_NAME, sidecar_filename)
+            logging.info(f"Uploaded to S3: {s3_client.meta.endpoint_url}/{AWS_S3_BUCKET_NAME}/{sidecar_filename}")
+        except Exception as e:
+            logging.error(f"ERROR uploading sidecar {sidecar_filename} to s3 {AWS_S3_BUCKET_NAME}. Error: {e}")
 
 try:
-    s3_client.upload_file(output_targz_path + output_targz_filename, AWS_S3_BUCKET_NAME, output_targz_filename)
+    upload_extra_args = {'Metadata': {'timings': json.dumps(job_timer.timings, separators=(',', ':'))}} # shown by client.py
+    if crawl_progress['truncated']:
+        upload_extra_args['Metadata']['truncated'] = crawl_progress['truncated']
+    if manifest_changes:
+        upload_extra_args['Metadata']['incremental'] = manifest_changes # shown by client.py
+    resources = resource_sampler.summary()
+    if resources:
+        upload_extra_args['Metadata']['resources'] = json.dumps(resources, separators=(',', ':')) # shown by client.py
+    s3_client.upload_file(output_targz_path + output_targz_filename, AWS_S3_BUCKET_NAME, output_targz_filename, ExtraArgs=upload_extra_args, Callback=lambda transferred: job_timer.touch())
     logging.info(f"Uploaded to S3: {s3_client.meta.endpoint_url}/{AWS_S3_BUCKET_NAME}/{output_targz_filename}")
+    publish_job_status('sharded' if shard_info['parts'] else 'complete') # client can download right away. Sharded jobs once all parts are done.
+    if checkpoint:
+        try:
+            remove_checkpoints()
+        except Exception as e:
+            logging.error(f"ERROR removing the crawl checkpoints: {e}")
 except ClientError as e:
     logging.error(f"ERROR uploading job {output_targz_filename} to s3 {AWS_S3_BUCKET_NAME}. Error: {e}")
+    publish_job_status('failed', error=str(e))
 except Exception as e:
     logging.error(f"ERROR uploading job {output_targz_filename} to s3 {AWS_S3_BUCKET_NAME}. Error: {e}")
+    publish_job_status('failed', error=str(e))
 
 # All is complete
+job_timer.begin('sqs_delete')
+heartbeat_stop_event.set()
 sqs_delete_message(AWS_SQS_URL, sqs_ReceiptHandle)
+job_timer.end()
+emit_job_metrics()
 do_shutdown()
\ No newline at end of file
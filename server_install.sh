@@ -21,15 +21,24 @@ yum install sslsplit iptables-services -y
 pip3.8 install boto3 ec2-metadata watchtower
 
 # Create job storage location
-mkdir /website_download
-chown root:proxy /website_download/
-chmod g+w /website_download/
-chmod g+s /website_download/
-setfacl -d -m g::rwx /website_download/
-mkdir /website_download/proxy_streams/
-mkdir /website_download/debug/
-mkdir /website_download/debug/certificates/
-mkdir /website_download/certificates/
+# /website_download is a symlink to the workspace of the job. It is on disk unless server_application.py moves a small job
+# into the tmpfs. SSLsplit and rsyslog write through the symlink.
+mkdir /website_download_disk
+chown root:proxy /website_download_disk/
+chmod g+w /website_download_disk/
+chmod g+s /website_download_disk/
+setfacl -d -m g::rwx /website_download_disk/
+mkdir /website_download_disk/proxy_streams/
+mkdir /website_download_disk/debug/
+mkdir /website_download_disk/debug/certificates/
+mkdir /website_download_disk/certificates/
+ln -s /website_download_disk /website_download
+
+# Memory backed job workspace. A tmpfs only takes memory for the files it holds. The budget a job may use is set by ENV_WORKSPACE_RAM_MB.
+mkdir /website_download_ram
+echo 'tmpfs /website_download_ram tmpfs size=50%,mode=2775,gid=proxy 0 0' >> /etc/fstab
+mount /website_download_ram
+setfacl -d -m g::rwx /website_download_ram/
 
 # Proxy certificate for interception
 openssl req -new -newkey rsa:1024 -sha256 -days 4000 -nodes -x509 -subj "/C=US/ST=CO/L=Southpark/O=Dis/CN=www.notreal.com" -keyout /website_download/debug/ca_priv_key.pem -out /website_download/debug/cacrt.pem
@@ -43,6 +52,8 @@ iptables -t nat -F
 iptables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 8080 -j REDIRECT --to-port 9080
 iptables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 80 -j REDIRECT --to-port 9080
 iptables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 443 -j REDIRECT --to-port 9443
+iptables -t nat -A OUTPUT -p udp -m owner --uid-owner proxy_client --dport 53 -j REDIRECT --to-port 5353 # caching DNS resolver of server_application.py
+iptables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 53 -j REDIRECT --to-port 5353
 
 service iptables save
 systemctl enable iptables
@@ -53,6 +64,8 @@ ip6tables -t nat -F
 ip6tables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 8080 -j REDIRECT --to-port 9080
 ip6tables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 80 -j REDIRECT --to-port 9080
 ip6tables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 443 -j REDIRECT --to-port 9443
+ip6tables -t nat -A OUTPUT -p udp -m owner --uid-owner proxy_client --dport 53 -j REDIRECT --to-port 5353
+ip6tables -t nat -A OUTPUT -p tcp -m owner --uid-owner proxy_client --dport 53 -j REDIRECT --to-port 5353
 
 service ip6tables save
 systemctl enable ip6tables
@@ -92,6 +105,8 @@ systemctl enable sslsplit
 systemctl start sslsplit
 
 # Get python file to server
+# The built-in crawler runs as proxy_client which cannot read the home directory of ec2-user
+install -m 755 /home/ec2-user/tls-intercept-website-downloader/crawler.py /usr/local/bin/website_crawler.py
 
 # websitedownloader service
 echo '
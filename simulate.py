@@ -0,0 +1,641 @@
+#!/usr/bin/python3
+# Built in Python 3.8
+__author__ = "Kemp Langhorne"
+__copyright__ = "Copyright (C) 2021 AskKemp.com"
+__license__ = "agpl-3.0"
+
+# Runs the whole application on one Linux box to benchmark it without AWS.
+# client.py submits jobs to lambda/lambda_function.py through a local stand-in of API Gateway and
+# server_application.py workers process them. AWS is provided by a moto server (SQS, S3, CloudWatch Logs,
+# EC2, Auto Scaling) and each worker gets its own fake instance metadata service. Scaling works like in AWS:
+# the lambda runs the AddCapacity policy, moto adds an instance to the autoscaling group and this script
+# starts a worker for every new instance. Websites are downloaded from a generated local test site.
+# SSLsplit does not run so jobs have no proxy logs, pcap or certificates.
+#
+# Requires: wget, openssl, moto[server] and the packages of server_application.py and client.py
+# Example:
+#   $ python3 simulate.py --jobs 20 --concurrency 5 --pages 20 --assets 10 --type singlepage --engine crawler
+
+import argparse
+import contextlib
+import email.utils # Last-Modified of the test site
+import json
+import logging
+import os
+import shutil
+import signal # --kill-after
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+#
+# SIMULATION CONFIGURATION SECTION
+#
+REPO_DIR = Path(__file__).resolve().parent
+SIM_REGION = "us-east-1"
+SIM_BUCKET = "website-downloader-simulation"
+SIM_QUEUE = "website-downloader-simulation"
+SIM_LOG_GROUP = "website-downloader-simulation"
+SIM_AUTOSCALEGROUP = "website-downloader-simulation"
+SIM_ADD_CAPACITY_POLICY = "AddCapacity"
+SIM_AMI = "ami-12c6146b" # known to moto
+SIM_INSTANCE_TYPE = "t3.micro"
+SIM_BOOT_GRACE = 5 # seconds a simulated worker polls an empty queue. Jobs are already queued when it starts.
+SIM_USERAGENT = "firefox_nt10"
+SCALER_INTERVAL = 0.5 # seconds between checks of the autoscaling group for new instances
+SIM_CHECKPOINT_INTERVAL = 2 # seconds between crawl checkpoints with --kill-after
+SIM_VISIBILITY_TIMEOUT = 10 # seconds a job of a killed worker stays leased with --kill-after
+
+# Runs server_application.py with the instance metadata pointed at the fake metadata service
+# Args: metadata url, server_application.py path, repository directory
+WORKER_BOOTSTRAP = """
+import runpy, sys
+from ec2_metadata import ec2_metadata
+ec2_metadata.service_url = sys.argv[1]
+ec2_metadata.dynamic_url = sys.argv[1] + 'dynamic/'
+ec2_metadata.metadata_url = sys.argv[1] + 'meta-data/'
+ec2_metadata.userdata_url = sys.argv[1] + 'user-data/'
+sys.path.insert(0, sys.argv[3])
+runpy.run_path(sys.argv[2], run_name='__main__')
+"""
+
+# Stand-ins for commands that need root or the services installed by server_install.sh
+SHIMS = {
+    'systemctl': '#!/bin/sh\nexit 0\n', # sslsplit is reported as running
+    'sudo': '#!/bin/sh\n[ "$1" = "-u" ] && shift 2\nexec "$@"\n', # runs wget and the crawler as the current user
+    'python3.8': f'#!/bin/sh\nexec "{sys.executable}" "$@"\n',
+}
+
+#
+# Script Starts Below
+#
+
+def free_port():
+    """Returns a TCP port that is free on localhost"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve(server):
+    """Runs a http.server in a daemon thread and returns it"""
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class QuietHandler(BaseHTTPRequestHandler):
+    """Request handler without the per request log lines"""
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, code, body, content_type="text/html", modified=None):
+        if modified and self.headers.get("If-Modified-Since"): # conditional requests of incremental recrawls
+            try:
+                if email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"]).timestamp() >= modified:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+            except (TypeError, ValueError):
+                pass
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if modified:
+            self.send_header("Last-Modified", email.utils.formatdate(modified, usegmt=True))
+        self.send_header("Connection", "close") # HTTP/1.0 server. Without it Wget reuses the connection after a HEAD and waits for a retry.
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+class TestSiteHandler(QuietHandler):
+    """
+    Generated website. The index links to every page and every page links to the next one, so the recursion level
+    decides how many pages a recursive job gets. Each page has the same number of assets, alternating css and images.
+    Sizes come from the server attributes pages, assets and asset_bytes. Once the server attribute changed is set,
+    pages 1 to changed_pages have new content and a newer Last-Modified.
+    """
+
+    def do_GET(self):
+        site = self.server
+        path = self.path.split('?')[0]
+        if path in ("/", "/index.html"):
+            self.reply(200, self.page(0, [f"/page/{n}.html" for n in range(1, site.pages + 1)]), modified=site.created)
+        elif path.startswith("/page/") and path.endswith(".html") and path[6:-5].isdigit() and 1 <= int(path[6:-5]) <= site.pages:
+            number = int(path[6:-5])
+            links = ["/"] + ([f"/page/{number + 1}.html"] if number < site.pages else [])
+            self.reply(200, self.page(number, links), modified=site.changed if site.changed and number <= site.changed_pages else site.created)
+        elif path.startswith("/asset/") and path.endswith(".css"):
+            self.reply(200, b"/*" + b"a" * max(site.asset_bytes - 4, 0) + b"*/", "text/css", modified=site.created)
+        elif path.startswith("/asset/") and path.endswith(".png"):
+            self.reply(200, b"\x89PNG\r\n\x1a\n" + b"\0" * max(site.asset_bytes - 8, 0), "image/png", modified=site.created)
+        else:
+            self.reply(404, b"not found")
+
+    def do_HEAD(self): # Wget --timestamping
+        self.do_GET()
+
+    def page(self, number, links):
+        """HTML of a page with its links and assets"""
+        html = [f"<html><head><title>page {number}</title>"]
+        if self.server.changed and 1 <= number <= self.server.changed_pages:
+            html.append(f"<meta name=\"updated\" content=\"{self.server.changed}\">")
+        for asset in range(self.server.assets):
+            if asset % 2 == 0:
+                html.append(f'<link rel="stylesheet" href="/asset/{number}/{asset}.css">')
+        html.append("</head><body>")
+        for asset in range(self.server.assets):
+            if asset % 2 == 1:
+                html.append(f'<img src="/asset/{number}/{asset}.png">')
+        html.extend(f'<a href="{link}">{link}</a>' for link in links)
+        html.append("</body></html>")
+        return "\n".join(html).encode()
+
+def start_test_site(pages, assets, asset_bytes, https, work_dir):
+    """
+    Starts the generated website
+
+    Args:
+        pages (int): pages besides the index
+        assets (int): assets on every page
+        asset_bytes (int): size of every asset
+        https (bool): serve over TLS with a self-signed certificate
+        work_dir (Path): where the certificate is created
+    Returns:
+        tuple (str of the site URL, the server whose attributes changed and changed_pages modify the site)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), TestSiteHandler)
+    server.daemon_threads = True
+    server.pages, server.assets, server.asset_bytes = pages, assets, asset_bytes
+    server.created, server.changed, server.changed_pages = int(time.time()) - 60, None, 0
+    scheme = "http"
+    if https:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                        "-keyout", str(work_dir / "site.key"), "-out", str(work_dir / "site.crt")], check=True, capture_output=True)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(str(work_dir / "site.crt"), str(work_dir / "site.key"))
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    serve(server)
+    return f"{scheme}://127.0.0.1:{server.server_address[1]}/", server
+
+class MetadataHandler(QuietHandler):
+    """EC2 instance metadata service (IMDSv2) of one simulated instance. Values come from the server attribute metadata."""
+
+    def do_PUT(self):
+        if self.path == "/latest/api/token":
+            self.reply(200, b"simulation-token", "text/plain")
+        else:
+            self.reply(404, b"")
+
+    def do_GET(self):
+        value = self.server.metadata.get(self.path)
+        if value is None:
+            self.reply(404, b"")
+        else:
+            self.reply(200, value.encode(), "text/plain")
+
+def start_metadata_service(instance_id):
+    """
+    Starts a fake instance metadata service for a simulated instance
+
+    Args:
+        instance_id (str): instance id in the moto autoscaling group
+    Returns:
+        tuple (server, metadata url)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), MetadataHandler)
+    server.daemon_threads = True
+    mac = "0e:00:00:00:00:01"
+    server.metadata = {
+        "/latest/meta-data/instance-id": instance_id,
+        "/latest/meta-data/instance-type": SIM_INSTANCE_TYPE,
+        "/latest/meta-data/mac": mac,
+        "/latest/meta-data/local-ipv4": "127.0.0.1",
+        "/latest/dynamic/instance-identity/document": json.dumps({"instanceId": instance_id, "instanceType": SIM_INSTANCE_TYPE, "region": SIM_REGION}),
+    }
+    serve(server)
+    return server, f"http://127.0.0.1:{server.server_address[1]}/latest/"
+
+class ApiGatewayHandler(QuietHandler):
+    """Local stand-in of API Gateway which hands the request body to lambda_function.lambda_handler"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        response = self.server.lambda_function.lambda_handler({'body': body}, None)
+        self.reply(response['statusCode'], response['body'].encode(), "application/json")
+
+def start_api_gateway():
+    """
+    Imports the lambda function, configured like template.yaml does, and serves it
+
+    Returns:
+        str of the API URL
+    """
+    os.environ.update({'ENV_S3_BUCKET_NAME': SIM_BUCKET,
+                       'ENV_S3_LINK_EXPIRATION': '7200',
+                       'ENV_ADD_CAPACITY_POLICY_ARN': SIM_ADD_CAPACITY_POLICY, # moto executes policies by name only
+                       'ENV_AUTOSCALEGROUP_NAME': SIM_AUTOSCALEGROUP,
+                       'ENV_SQS_URL': os.environ['ENV_SQS_URL'],
+                       'ENV_JOB_MAX_BYTES': '10737418240',
+                       'ENV_JOB_MAX_FILES': '100000',
+                       'ENV_JOB_MAX_SECONDS': '9000'})
+    sys.path.insert(0, str(REPO_DIR / "lambda"))
+    logging.disable(logging.INFO)
+    import lambda_function
+    logging.disable(logging.NOTSET)
+    for name in ('', 'botocore', 's3transfer', 'urllib3'): # lambda_function logs everything for CloudWatch
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), ApiGatewayHandler)
+    server.daemon_threads = True
+    server.lambda_function = lambda_function
+    serve(server)
+    return f"http://127.0.0.1:{server.server_address[1]}/Prod/websitedownloader/"
+
+def setup_aws(concurrency):
+    """
+    Creates the resources of template.yaml in moto
+
+    Args:
+        concurrency (int): maximum size of the autoscaling group
+    Returns:
+        str of the SQS queue URL
+    """
+    from boto3.session import Session
+    session = Session(region_name=SIM_REGION)
+    session.client('s3').create_bucket(Bucket=SIM_BUCKET)
+    session.client('logs').create_log_group(logGroupName=SIM_LOG_GROUP)
+    queue_url = session.client('sqs').create_queue(QueueName=SIM_QUEUE, Attributes={'VisibilityTimeout': '10800', 'MessageRetentionPeriod': '7200'})['QueueUrl']
+    session.client('ec2').create_launch_template(LaunchTemplateName=SIM_AUTOSCALEGROUP, LaunchTemplateData={'ImageId': SIM_AMI, 'InstanceType': SIM_INSTANCE_TYPE})
+    autoscaling = session.client('autoscaling')
+    autoscaling.create_auto_scaling_group(AutoScalingGroupName=SIM_AUTOSCALEGROUP,
+                                          LaunchTemplate={'LaunchTemplateName': SIM_AUTOSCALEGROUP, 'Version': '$Latest'},
+                                          MinSize=0, MaxSize=concurrency, DesiredCapacity=0,
+                                          AvailabilityZones=[SIM_REGION + 'a'])
+    autoscaling.put_scaling_policy(AutoScalingGroupName=SIM_AUTOSCALEGROUP, PolicyName=SIM_ADD_CAPACITY_POLICY,
+                                   AdjustmentType='ChangeInCapacity', ScalingAdjustment=1)
+    return queue_url
+
+class Scaler:
+    """
+    Plays the part of EC2: starts a server_application.py worker for every instance moto adds to the autoscaling group.
+    Each worker gets its own job directory and metadata service. Its resource use is taken when it exits.
+    With a RAM workspace the job directory is a symlink to a disk directory like on an instance and the tmpfs is a
+    directory in ram_dir. With kill_after every worker but the replacements is killed that many seconds after it
+    started, like a reclaimed spot instance, and its instance is replaced.
+    """
+
+    def __init__(self, work_dir, worker_env, ram_dir=None, kill_after=None):
+        self.work_dir = work_dir
+        self.worker_env = worker_env
+        self.ram_dir = ram_dir
+        self.kill_after = kill_after
+        self.replacements = 0 # instances still to come for killed workers. They are not killed again.
+        self.workers = {} # instance id -> dict of the worker
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        from boto3.session import Session
+        self.autoscaling = Session(region_name=SIM_REGION).client('autoscaling')
+
+    def run(self):
+        """Checks the autoscaling group for new instances until stopped"""
+        while not self.stop_event.wait(SCALER_INTERVAL):
+            try:
+                group = self.autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[SIM_AUTOSCALEGROUP])['AutoScalingGroups'][0]
+            except Exception as e: # moto can fail while an instance is terminated
+                logging.debug(f"Autoscaling group not described: {e}")
+                continue
+            for instance in group['Instances']:
+                if instance['InstanceId'] not in self.workers:
+                    self.launch(instance['InstanceId'])
+
+    def launch(self, instance_id):
+        """Starts the worker of an instance and a thread that reaps it"""
+        job_root = self.work_dir / "instances" / instance_id
+        env = dict(self.worker_env, ENV_JOB_ROOT=str(job_root) + "/", ENV_DNS_RESOLVER_PORT=str(free_port())) # workers share the host
+        if self.ram_dir:
+            disk_path, ram_path = self.work_dir / "instances" / (instance_id + ".disk"), self.ram_dir / instance_id
+            ram_path.mkdir(parents=True)
+            disk_path.mkdir(parents=True)
+            job_root.symlink_to(disk_path)
+            env.update(ENV_WORKSPACE_DISK_PATH=str(disk_path) + "/", ENV_WORKSPACE_RAM_PATH=str(ram_path) + "/")
+        for directory in ("debug/certificates", "certificates", "proxy_streams"): # as made by server_install.sh
+            (job_root / directory).mkdir(parents=True, exist_ok=True)
+        metadata_server, metadata_url = start_metadata_service(instance_id)
+        log_path = self.work_dir / "instances" / (instance_id + ".log")
+        with open(log_path, "w") as log_f:
+            popen = subprocess.Popen([sys.executable, "-c", WORKER_BOOTSTRAP, metadata_url, str(REPO_DIR / "server_application.py"), str(REPO_DIR)],
+                                     stdout=log_f, stderr=subprocess.STDOUT, env=env, cwd=str(job_root), start_new_session=True) # killed with wget
+        worker = {'instance_id': instance_id, 'popen': popen, 'log': log_path, 'started': time.monotonic(), 'metadata_server': metadata_server, 'killed': False}
+        with self.lock:
+            self.workers[instance_id] = worker
+            replacement = self.replacements > 0
+            self.replacements -= replacement
+        threading.Thread(target=self.reap, args=(worker,), daemon=True).start()
+        if self.kill_after and not replacement:
+            threading.Timer(self.kill_after, self.kill, args=(worker,)).start()
+
+    def kill(self, worker):
+        """Kills a worker with its engine like a lost instance. The autoscaling group replaces the instance."""
+        if 'seconds' in worker: # already done
+            return
+        try:
+            os.killpg(worker['popen'].pid, signal.SIGKILL)
+        except ProcessLookupError:
+            return
+        worker['killed'] = True
+        with self.lock:
+            self.replacements += 1
+        try:
+            self.autoscaling.terminate_instance_in_auto_scaling_group(InstanceId=worker['instance_id'], ShouldDecrementDesiredCapacity=False)
+        except Exception as e:
+            logging.debug(f"Instance of killed worker not replaced: {e}")
+
+    def reap(self, worker):
+        """Waits for a worker and collects its resource use and job metrics"""
+        pid, status, usage = os.wait4(worker['popen'].pid, 0) # rusage includes wget and the crawler
+        worker['popen'].returncode = status
+        worker['seconds'] = time.monotonic() - worker['started']
+        worker['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+        worker['max_rss_mb'] = usage.ru_maxrss / 1024 # kilobytes on Linux
+        worker['metrics'] = read_job_metrics(worker['log'])
+        worker['metadata_server'].shutdown()
+
+    def running(self):
+        """Number of workers that have not exited"""
+        with self.lock:
+            return sum(1 for worker in self.workers.values() if 'seconds' not in worker)
+
+def read_job_metrics(log_path):
+    """
+    Finds the CloudWatch Embedded Metric Format record a worker logged
+
+    Args:
+        log_path (Path): output of the worker
+    Returns:
+        dict of the record or None if the worker did not finish a job
+    """
+    with open(log_path, errors="replace") as log_f:
+        for line in log_f:
+            if line.startswith("{") and '"_aws"' in line:
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    continue
+    return None
+
+def run_job(client, api_url, site_url, args, output_dir, base_job=None):
+    """
+    Submits one job like client.py does, follows its status and downloads the results
+
+    Args:
+        base_job (str): job id to recrawl incrementally or None for a full download
+    Returns:
+        dict with job_id, state, seconds from submit to downloaded and archive size. The archives of the shards of a
+        sharded job count towards its size.
+    """
+    started = time.monotonic()
+    job_file_url, job_filename, proxylog_url, job_id = client.submit_website_download_job(
+        apikey="simulation", apiurl=api_url, input_url=site_url, input_useragent=SIM_USERAGENT,
+        input_recursivelevel=str(args.in_recursivelevel) if args.in_downloadtype == "recursive" else None,
+        input_forceipver="ipv4", input_wgetmode=args.in_downloadtype, input_maxbytes=args.in_maxsize << 20 if args.in_maxsize else None,
+        input_engine=args.in_engine, input_basejob=base_job, input_shards=args.in_shards)
+    if not job_id:
+        return {'job_id': None, 'state': 'rejected', 'seconds': time.monotonic() - started, 'bytes': 0}
+
+    job_status = client.wait_for_job(apikey="simulation", apiurl=api_url, job_id=job_id)
+    state = job_status['state'] if job_status else 'unknown'
+    archive_bytes = 0
+    if state == 'complete':
+        client.download_file(signed_url=job_file_url, output_filename=str(output_dir / job_filename))
+        for shard_job, shard_url in job_status.get('shard_urls', {}).items():
+            client.download_file(signed_url=shard_url, output_filename=str(output_dir / (shard_job + '.tar.gz')))
+            archive_bytes += (output_dir / (shard_job + '.tar.gz')).stat().st_size if (output_dir / (shard_job + '.tar.gz')).is_file() else 0
+        if (output_dir / job_filename).is_file():
+            archive_bytes += (output_dir / job_filename).stat().st_size
+        else:
+            state = 'download failed'
+    return {'job_id': job_id, 'state': state, 'seconds': time.monotonic() - started, 'bytes': archive_bytes}
+
+def latency_summary(values):
+    """Returns mean, p50, p95 and max of a list of seconds"""
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    return {'mean': statistics.mean(values), 'p50': statistics.median(values), 'p95': p95, 'max': values[-1]}
+
+def build_report(jobs, workers, wall_seconds, args):
+    """
+    Summarises a simulation run
+
+    Returns:
+        dict of the report. Also written with --report.
+    """
+    completed = [job for job in jobs if job['state'] == 'complete']
+    finished = [worker for worker in workers if 'seconds' in worker]
+    phases = {}
+    for worker in finished:
+        if worker['metrics']:
+            for metric in worker['metrics']['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                if metric['Unit'] == 'Seconds' and metric['Name'] != 'BootToFirstReceive': # boot of a simulated instance is the boot of this host
+                    phases.setdefault(metric['Name'], []).append(worker['metrics'][metric['Name']])
+
+    report = {'settings': {'jobs': args.in_jobs, 'concurrency': args.in_concurrency, 'type': args.in_downloadtype,
+                           'recursivelevel': args.in_recursivelevel, 'engine': args.in_engine, 'pages': args.in_pages,
+                           'assets': args.in_assets, 'asset_bytes': args.in_assetbytes, 'https': args.in_https,
+                           'incremental': args.in_incremental, 'changed_pages': args.in_changedpages if args.in_incremental else None,
+                           'shards': args.in_shards, 'workspace_ram_mb': args.in_workspaceram, 'max_size_mb': args.in_maxsize, 'kill_after': args.in_killafter},
+              'wall_seconds': round(wall_seconds, 2),
+              'jobs_completed': len(completed),
+              'jobs_not_completed': {job['state']: sum(1 for j in jobs if j['state'] == job['state']) for job in jobs if job['state'] != 'complete'},
+              'jobs_per_hour': round(len(completed) / wall_seconds * 3600, 1) if wall_seconds else 0,
+              'job_seconds': latency_summary([job['seconds'] for job in completed]) if completed else None,
+              'phase_seconds': {phase: latency_summary(values) for phase, values in phases.items()},
+              'workers_started': len(workers),
+              'workers_killed': sum(1 for worker in workers if worker.get('killed')),
+              'worker_seconds': latency_summary([worker['seconds'] for worker in finished]) if finished else None,
+              'worker_cpu_seconds': round(sum(worker['cpu_seconds'] for worker in finished), 2),
+              'worker_cpu_seconds_per_job': round(sum(worker['cpu_seconds'] for worker in finished) / len(completed), 3) if completed else None,
+              'worker_max_rss_mb': round(max((worker['max_rss_mb'] for worker in finished), default=0), 1),
+              'archive_bytes_per_job': int(statistics.mean(job['bytes'] for job in completed)) if completed else None}
+    return report
+
+def print_report(report):
+    """Prints the report of build_report() to stdout"""
+    print(f"* Jobs completed: {report['jobs_completed']} in {report['wall_seconds']:.1f}s ({report['jobs_per_hour']} jobs/hour)")
+    if report['jobs_not_completed']:
+        print(f"* Jobs not completed: {report['jobs_not_completed']}")
+    print(f"* Workers started: {report['workers_started']}. Workers without a job wait for the boot grace period and long poll before terminating.")
+    if report['workers_killed']:
+        print(f"* Workers killed: {report['workers_killed']}. Their jobs resumed from the last crawl checkpoint on a replacement.")
+    print(f"* Worker CPU: {report['worker_cpu_seconds']}s total, {report['worker_cpu_seconds_per_job']}s per job. Peak worker RSS {report['worker_max_rss_mb']}MB")
+    if report['archive_bytes_per_job'] is not None:
+        print(f"* Archive size per job: {report['archive_bytes_per_job'] >> 10}KB")
+    print("{:<24} {:>10} {:>10} {:>10} {:>10}".format("LATENCY (s)", "mean", "p50", "p95", "max"))
+    rows = [('job (client)', report['job_seconds']), ('worker', report['worker_seconds'])]
+    rows.extend(report['phase_seconds'].items())
+    for name, summary in rows:
+        if summary:
+            print("{:<24} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(name, summary['mean'], summary['p50'], summary['p95'], summary['max']))
+    return
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='\
+Runs client.py, lambda/lambda_function.py and server_application.py together on this machine against\n\
+a moto server and a generated test website, then reports jobs/hour, phase latencies and worker resource use.\n\
+Nothing is sent to AWS.\n\
+\n\
+Example:\n\
+    $ %(prog)s --jobs 20 --concurrency 5 --pages 20 --assets 10 --type singlepage --engine crawler --report run.json\n\
+')
+
+    groupA = parser.add_argument_group("Jobs")
+    groupA.add_argument('--jobs', dest='in_jobs', type=int, default=10, metavar='<count>', help='Number of jobs to run. Default: 10')
+    groupA.add_argument('--concurrency', dest='in_concurrency', type=int, default=3, metavar='<1-10>',
+                        help='Jobs in flight at a time which is also the maximum number of workers. The lambda refuses jobs once more than 10 are queued. Default: 3')
+    groupA.add_argument('--type', dest='in_downloadtype', choices=['singlepage', 'recursive'], default='singlepage', help='Download type. Default: singlepage')
+    groupA.add_argument('--recursivelevel', dest='in_recursivelevel', type=int, default=2, metavar='<1-20>', help='Use with recursive download type. Default: 2')
+    groupA.add_argument('--engine', dest='in_engine', choices=['wget', 'crawler'], default='wget', help='Download engine. Default: wget')
+    groupA.add_argument('--incremental', dest='in_incremental', action='store_true',
+                        help='Run one full job first (not measured) and then the jobs as incremental recrawls of it after --changed-pages pages changed')
+    groupA.add_argument('--changed-pages', dest='in_changedpages', type=int, default=1, metavar='<count>', help='Use with --incremental. Default: 1')
+    groupA.add_argument('--shards', dest='in_shards', type=int, metavar='<2-10>',
+                        help='Split every recursive crawler job across this many shards. The autoscaling group gets room for the coordinator and its shards.')
+    groupA.add_argument('--workspace-ram', dest='in_workspaceram', type=int, default=0, metavar='<MB>',
+                        help='RAM budget of the job workspace of every worker. Single page jobs and jobs whose --max-size fits run in a directory in /dev/shm and move to disk beyond it. Default: 0 (disk)')
+    groupA.add_argument('--max-size', dest='in_maxsize', type=int, metavar='<MB>',
+                        help='Byte quota of every job like client.py --max-size. Default: set by the deployment')
+    groupA.add_argument('--job-timeout', dest='in_jobtimeout', type=int, default=300, metavar='<seconds>',
+                        help='Give up on a job whose status did not change for this long e.g. when its worker crashed. Default: 300')
+    groupA.add_argument('--kill-after', dest='in_killafter', type=float, metavar='<seconds>',
+                        help=f'Kill every worker this long after it started, like a lost instance, and replace it. Recursive jobs resume from their last crawl checkpoint, taken every {SIM_CHECKPOINT_INTERVAL} seconds.')
+
+    groupB = parser.add_argument_group("Test Website")
+    groupB.add_argument('--pages', dest='in_pages', type=int, default=10, metavar='<count>', help='Pages besides the index. Default: 10')
+    groupB.add_argument('--assets', dest='in_assets', type=int, default=10, metavar='<count>', help='css and image files on every page. Default: 10')
+    groupB.add_argument('--asset-bytes', dest='in_assetbytes', type=int, default=20480, metavar='<bytes>', help='Size of every asset. Default: 20480')
+    groupB.add_argument('--https', dest='in_https', action='store_true', help='Serve the website over HTTPS with a self-signed certificate')
+
+    groupC = parser.add_argument_group("Output")
+    groupC.add_argument('--report', dest='in_report', metavar='<path>', help='Also write the report as JSON e.g. to compare runs')
+    groupC.add_argument('--keep', dest='in_keep', action='store_true', help='Keep the working directory with worker logs, job directories and downloaded archives')
+
+    args = parser.parse_args()
+
+    if not 1 <= args.in_concurrency <= 10:
+        parser.error("--concurrency must be between 1 and 10")
+    if args.in_jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if not 1 <= args.in_recursivelevel <= 20:
+        parser.error("--recursivelevel must be between 1 and 20")
+    if args.in_shards and (not 2 <= args.in_shards <= 10 or args.in_downloadtype != "recursive" or args.in_engine != "crawler" or args.in_recursivelevel < 2 or args.in_incremental):
+        parser.error("--shards must be between 2 and 10 and needs --type recursive --engine crawler and --recursivelevel of at least 2. Not with --incremental.")
+    if args.in_workspaceram < 0:
+        parser.error("--workspace-ram must be 0 or more")
+    if args.in_maxsize is not None and args.in_maxsize < 1:
+        parser.error("--max-size must be at least 1")
+    if args.in_killafter is not None and args.in_killafter <= 0:
+        parser.error("--kill-after must be more than 0")
+    for command in ("wget", "openssl"):
+        if not shutil.which(command):
+            parser.error(f"{command} is required")
+
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        parser.error("moto[server] is required e.g. pip3 install 'moto[server]'")
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL) # moto autoscaling is not thread safe. A failed terminate only shows in the worker log.
+    work_dir = Path(tempfile.mkdtemp(prefix="website-downloader-simulation-"))
+    output_dir = work_dir / "downloads"
+    output_dir.mkdir()
+    bin_dir = work_dir / "bin"
+    bin_dir.mkdir()
+    for name, script in SHIMS.items():
+        (bin_dir / name).write_text(script)
+        (bin_dir / name).chmod(0o755)
+
+    # Every AWS client of this process and the workers goes to moto with throwaway credentials
+    moto_port = free_port()
+    moto_server = ThreadedMotoServer(ip_address='127.0.0.1', port=moto_port, verbose=False)
+    moto_server.start()
+    for variable in ('AWS_PROFILE', 'AWS_SESSION_TOKEN'):
+        os.environ.pop(variable, None)
+    os.environ.update({'AWS_ENDPOINT_URL': f"http://127.0.0.1:{moto_port}",
+                       'AWS_ACCESS_KEY_ID': 'simulation',
+                       'AWS_SECRET_ACCESS_KEY': 'simulation',
+                       'AWS_DEFAULT_REGION': SIM_REGION,
+                       'AWS_REGION': SIM_REGION})
+
+    os.environ['ENV_SQS_URL'] = setup_aws(args.in_concurrency * (args.in_shards + 1 if args.in_shards else 1))
+    api_url = start_api_gateway()
+    site_url, site = start_test_site(args.in_pages, args.in_assets, args.in_assetbytes, args.in_https, work_dir)
+
+    worker_env = dict(os.environ,
+                      PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+                      ENV_CLOUDWATCH_LOG_GROUP=SIM_LOG_GROUP,
+                      ENV_S3_BUCKET_NAME=SIM_BUCKET,
+                      ENV_SQS_BOOT_GRACE=str(SIM_BOOT_GRACE),
+                      ENV_AUTOSCALEGROUP_NAME=SIM_AUTOSCALEGROUP,
+                      ENV_CRAWLER_PATH=str(REPO_DIR / "crawler.py"),
+                      ENV_WORKSPACE_RAM_MB=str(args.in_workspaceram))
+    ram_dir = None
+    if args.in_workspaceram:
+        ram_dir = Path(tempfile.mkdtemp(prefix="website-downloader-simulation-", dir="/dev/shm" if Path("/dev/shm").is_dir() else None))
+    if args.in_killafter: # checkpoints often and jobs of killed workers are retried within seconds
+        worker_env.update(ENV_CHECKPOINT_INTERVAL=str(SIM_CHECKPOINT_INTERVAL), ENV_SQS_VISIBILITY_TIMEOUT=str(SIM_VISIBILITY_TIMEOUT))
+    scaler = Scaler(work_dir, worker_env, ram_dir, args.in_killafter)
+    threading.Thread(target=scaler.run, daemon=True).start()
+
+    sys.path.insert(0, str(REPO_DIR))
+    import client
+    client.JOB_STATUS_STALE = args.in_jobtimeout # the deployment value of hours is meant for real instances
+
+    print(f"* Simulating {args.in_jobs} {args.in_downloadtype} jobs with the {args.in_engine} engine, {args.in_concurrency} at a time, against {site_url}" + (f" in {args.in_shards} shards each" if args.in_shards else ""))
+    print(f"* Working directory: {work_dir}")
+    base_job, base_workers = None, set()
+    if args.in_incremental:
+        with open(work_dir / "client.log", "a") as client_log, contextlib.redirect_stdout(client_log):
+            base = run_job(client, api_url, site_url, args, output_dir)
+        if base['state'] != 'complete':
+            print(f"* Full job to recrawl incrementally did not complete: {base['state']}")
+            moto_server.stop()
+            sys.exit(1)
+        base_job, base_workers = base['job_id'], set(scaler.workers)
+        site.changed, site.changed_pages = int(time.time()), args.in_changedpages
+        print(f"* Full job {base_job} took {base['seconds']:.1f}s with an archive of {base['bytes'] >> 10}KB. {args.in_changedpages} pages changed since.")
+
+    started = time.monotonic()
+    with open(work_dir / "client.log", "a") as client_log, contextlib.redirect_stdout(client_log): # client.py output of every job
+        with ThreadPoolExecutor(max_workers=args.in_concurrency) as executor:
+            jobs = list(executor.map(lambda number: run_job(client, api_url, site_url, args, output_dir, base_job), range(args.in_jobs)))
+    wall_seconds = time.monotonic() - started
+
+    while scaler.running(): # workers finish after the upload the client waits for
+        time.sleep(SCALER_INTERVAL)
+    scaler.stop_event.set()
+
+    report = build_report(jobs, [worker for instance_id, worker in scaler.workers.items() if instance_id not in base_workers], wall_seconds, args)
+    print_report(report)
+    if args.in_report:
+        with open(args.in_report, "w") as report_f:
+            json.dump(report, report_f, indent=1)
+        print(f"* Report written to: {args.in_report}")
+
+    moto_server.stop()
+    if ram_dir: # memory is not kept
+        shutil.rmtree(ram_dir, ignore_errors=True)
+    if args.in_keep:
+        print(f"* Kept working directory: {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
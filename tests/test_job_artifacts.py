@@ -0,0 +1,196 @@
+# Built in Python 3.8
+# Run from the repository root: python3 -m unittest discover tests
+
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import job_artifacts
+import replay_job
+
+
+class ArchivePipelineTest(unittest.TestCase):
+    """Archives written while the crawl runs must match the job directory once finish() returns"""
+
+    def setUp(self):
+        self.job_root = tempfile.mkdtemp() + "/"
+        self.addCleanup(shutil.rmtree, self.job_root, ignore_errors=True)
+        self.archive_path = self.job_root + "job.tar.gz"
+        self.tree = Path(self.job_root, "wget_saved", "example.com")
+        self.tree.mkdir(parents=True)
+        self.pipeline = job_artifacts.ArchivePipeline(self.job_root, self.archive_path, "job")
+
+    def save(self, name, data):
+        path = self.tree / name
+        path.write_bytes(data)
+        return str(path)
+
+    def archived(self):
+        """Returns dict name within the job directory -> content of every file in the archive"""
+        files = {}
+        with tarfile.open(self.archive_path) as archive:
+            for member in archive:
+                if member.isfile():
+                    files[member.name[len("job/"):]] = archive.extractfile(member).read()
+        return files
+
+    def expected(self):
+        files = {}
+        for path in Path(self.job_root).rglob('*'):
+            if path.is_file() and str(path) != self.archive_path:
+                files[path.relative_to(self.job_root).as_posix()] = path.read_bytes()
+        return files
+
+    def assert_archive_complete(self):
+        self.assertEqual(self.archived(), self.expected())
+        if shutil.which("tar"):
+            result = subprocess.run(["tar", "tzf", self.archive_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_file_shorter_while_appended(self):
+        """A file truncated while it is read leaves a partial entry in its member, which finish() must drop"""
+        with mock.patch.object(job_artifacts, "PIPELINE_MEMBER_BYTES", 1 << 30): # all files in one member
+            self.pipeline.start()
+            self.pipeline.add(self.save("first.html", b"a" * 5000))
+            shrinking = self.save("shrinking.html", b"b" * 100000)
+            real_reader = job_artifacts._HashingReader
+
+            class ShrinkingReader(real_reader):
+                def read(self, size=-1):
+                    if self.fileobj.name == shrinking and self.fileobj.tell() == 0:
+                        chunk = self.fileobj.read(1000)
+                        os.truncate(shrinking, 1000)
+                        self.digest.update(chunk)
+                        return chunk
+                    return super().read(size)
+
+            with mock.patch.object(job_artifacts, "_HashingReader", ShrinkingReader):
+                self.pipeline.add(shrinking)
+                self.pipeline.add(self.save("after.html", b"c" * 3000))
+                self.pipeline.drain()
+        Path(self.job_root, "proxy.log").write_bytes(b"written after the crawl")
+        self.pipeline.finish()
+
+        self.assertEqual(self.pipeline.stats['dropped_members'], 2) # the member with the partial entry and the one after it
+        self.assert_archive_complete()
+        self.assertEqual(len(self.archived()["wget_saved/example.com/shrinking.html"]), 1000)
+
+    def test_file_changed_after_appended(self):
+        """A file written again after it was appended is archived with its final content"""
+        with mock.patch.object(job_artifacts, "PIPELINE_MEMBER_BYTES", 4000): # one member per file
+            self.pipeline.start()
+            for number in range(3):
+                self.pipeline.add(self.save(f"{number}.html", bytes([65 + number]) * 5000))
+            self.pipeline.drain()
+        changed = self.tree / "1.html"
+        changed.write_bytes(b"changed")
+        os.utime(changed, ns=(changed.stat().st_atime_ns, changed.stat().st_mtime_ns + 10 ** 9)) # mtime is not always finer than the write
+        self.pipeline.finish()
+
+        self.assertEqual(self.pipeline.stats['dropped_members'], 2) # the changed member and the one after it
+        self.assert_archive_complete()
+        self.assertEqual(self.archived()["wget_saved/example.com/1.html"], b"changed")
+
+    def test_unchanged_members_kept(self):
+        with mock.patch.object(job_artifacts, "PIPELINE_MEMBER_BYTES", 4000):
+            self.pipeline.start()
+            for number in range(3):
+                self.pipeline.add(self.save(f"{number}.html", bytes([65 + number]) * 5000))
+            self.pipeline.drain()
+        self.pipeline.finish()
+
+        self.assertEqual(self.pipeline.stats['dropped_members'], 0)
+        self.assert_archive_complete()
+
+
+class FixedRandom:
+    """Stands in for random.Random in write_synthetic_pcap so the time to first byte of each connection is known"""
+
+    def __init__(self, values):
+        self.values = list(values)
+
+    def uniform(self, low, high):
+        return self.values.pop(0)
+
+
+class NetworkTimingTest(unittest.TestCase):
+    """Request timings from a capture written like SSLsplit does and its proxy.log"""
+
+    TTFB = (0.05, 0.15, 0.25) # seconds, one per connection
+    HOSTS = ("a.example.com", "b.example.com", "a.example.com")
+    RESPONSE_BYTES = (1 << 20) // 3 # write_synthetic_pcap shares 1MB between the connections
+    RESPONSE_PACKETS = -(-RESPONSE_BYTES // 1400)
+
+    def setUp(self):
+        self.job_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.job_root, ignore_errors=True)
+        self.pcap_path = self.job_root / "proxy.pcap"
+        replay_job.write_synthetic_pcap(self.pcap_path, 1, len(self.TTFB), FixedRandom(self.TTFB))
+        self.log_path = self.job_root / "proxy.log"
+        with open(self.log_path, "w") as log_f:
+            for number, host in enumerate(self.HOSTS):
+                log_f.write(f"2021-05-02 17:00:0{number} UTC https [10.0.0.5]:{30000 + number} [93.184.216.{number}]:443 "
+                            f"sni:{host} names:{host} sproto:TLSv1.2:ECDHE-RSA-AES128-GCM-SHA256 dproto:TLSv1.2:ECDHE-RSA-AES128-GCM-SHA256 origcrt:- usedcrt:- "
+                            f"{host} GET /page{number}.html 200 {self.RESPONSE_BYTES}\n")
+
+    def test_request_fields(self):
+        timings = job_artifacts.network_timings(str(self.pcap_path), str(self.log_path))
+
+        self.assertEqual(len(timings), 3)
+        transfer_ms = (self.RESPONSE_PACKETS - 1) * 0.1 # write_synthetic_pcap sends a packet every 0.1ms
+        for number, timing in enumerate(timings):
+            self.assertEqual((timing['conn'], timing['req']), (number, 0))
+            self.assertEqual((timing['proto'], timing['dst_ip'], timing['dst_port']), ('https', f'93.184.216.{number}', 443))
+            self.assertEqual((timing['host'], timing['method'], timing['uri'], timing['status']), (self.HOSTS[number], 'GET', f'/page{number}.html', 200))
+            self.assertAlmostEqual(timing['ttfb_ms'], self.TTFB[number] * 1000, delta=0.1)
+            self.assertAlmostEqual(timing['transfer_ms'], transfer_ms, delta=0.1)
+            self.assertEqual((timing['sent'], timing['received']), (300, self.RESPONSE_BYTES))
+            self.assertAlmostEqual(timing['kbps'], self.RESPONSE_BYTES / 1024 / (self.TTFB[number] + transfer_ms / 1000), delta=5) # from unrounded times
+            self.assertIsNone(timing['dns_ready_ms']) # no dns.jsonl
+
+    def test_summary_per_host(self):
+        summary = job_artifacts.summarize_network_timings(job_artifacts.network_timings(str(self.pcap_path), str(self.log_path)))
+
+        self.assertEqual(sorted(summary['hosts']), ["a.example.com", "b.example.com"])
+        first = summary['hosts']["a.example.com"]
+        self.assertEqual((first['connections'], first['requests'], first['received']), (2, 2, 2 * self.RESPONSE_BYTES))
+        self.assertAlmostEqual(first['ttfb_ms_p50'], 50, delta=0.1) # nearest rank of two values
+        self.assertAlmostEqual(first['ttfb_ms_p95'], 250, delta=0.1)
+        second = summary['hosts']["b.example.com"]
+        self.assertAlmostEqual(second['ttfb_ms_p50'], 150, delta=0.1)
+        self.assertAlmostEqual(second['ttfb_ms_p95'], 150, delta=0.1)
+        self.assertEqual(summary['all']['requests'], 3)
+        self.assertAlmostEqual(summary['all']['ttfb_ms_p50'], 150, delta=0.1)
+        self.assertAlmostEqual(summary['all']['ttfb_ms_p95'], 250, delta=0.1)
+        self.assertIsNone(summary['all']['dns_ready_ms_p50'])
+
+    def test_truncated_capture(self):
+        """A capture cut off in the middle of a packet e.g. SSLsplit killed keeps the requests up to there"""
+        full = job_artifacts.network_timings(str(self.pcap_path), str(self.log_path))
+        size = self.pcap_path.stat().st_size
+        with open(self.pcap_path, "r+b") as pcap_f:
+            pcap_f.truncate(size - size // 6 - 7) # within the response of the last connection, not on a record boundary
+
+        timings = job_artifacts.network_timings(str(self.pcap_path), str(self.log_path))
+
+        self.assertEqual(len(timings), 3)
+        self.assertEqual(timings[:2], full[:2])
+        self.assertTrue(0 < timings[2]['received'] < self.RESPONSE_BYTES)
+        self.assertAlmostEqual(timings[2]['ttfb_ms'], 250, delta=0.1)
+
+    def test_truncated_file_header(self):
+        with open(self.pcap_path, "r+b") as pcap_f:
+            pcap_f.truncate(10)
+        with self.assertRaises(ValueError):
+            job_artifacts.network_timings(str(self.pcap_path), str(self.log_path))
+
+
+if __name__ == "__main__":
+    unittest.main()